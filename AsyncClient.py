@@ -0,0 +1,390 @@
+'''
+    Secure Messenger Application Asyncio Client
+
+    Authors: Hans Prieto, Joshua Fawcett
+
+    AsyncClient is the asyncio counterpart of Client, for programs such as bots and
+    bridges that keep many server sessions open on one event loop:
+
+            client = AsyncClient(userName='bot')
+            if await client.connect():
+                key = await client.get_public_key('alice', '10.0.0.5')
+                await client.send_message('hello', '10.0.0.5', 3, None, key)
+                async for IP, message, sender in client:
+                    ...
+                await client.disconnect()
+
+    The handshakes, request packets, request IDs and message decryption are the ones
+    used by the threaded client (see Client.py); only the socket handling is different.
+    Nothing blocks the event loop on the network, and the RSA operations of the
+    handshake and of decrypting received messages run in an executor.
+'''
+
+import asyncio
+import traceback
+from cipher import *
+from protocol import *
+from Client import (serverName, serverPort, REQUEST_TIMEOUT, KEY_RING, RATCHETS,
+                    RThreadStatus, PendingRequests, handle_frame, message_from_fields, restart_ratchet_if_lost,
+                    get_ip, first_handshake, pin_rsa_only, rsa_hello, rsa_key_transfer, x25519_hello, x25519_session,
+                    message_packet, group_message_packet, group_packet, account_packet, public_key_packet,
+                    DISCONNECT_PACKET)
+
+# Bytes read from the server at once
+RECEIVE_SIZE = 65536
+
+# Seconds between checks for requests the server did not reply to in time
+EXPIRY_INTERVAL = 0.5
+
+# Encryption types whose messages are built without RSA operations, so they are built on
+# the event loop instead of in the executor
+SYMMETRIC_TYPES = (0, 1)
+
+# ================================================================================================================
+
+# ============================================== Async Client Class ==============================================
+class AsyncClient:
+    ''' Asyncio client. The server address, the IP sent to the server and the RSA keys
+        default to those of Client. Requests may be sent concurrently from any number of
+        tasks; each waits for its own reply, matched by request ID. Received messages
+        are read by iterating over the client, in the order they arrived, as the same
+        tuples Client passes to its callback: (IP, message, sender) or, for a group
+        message, (IP, message, sender, group ID). Iteration ends when the connection
+        is closed.
+    '''
+    def __init__(self, userName='', address=None, IP=None, keys=None, transports=AEAD_TRANSPORTS,
+                 handshake=HANDSHAKE_X25519, executor=None):
+        self.userName = userName # Identifies this user to receivers
+        self.address = address if address is not None else (serverName, serverPort)
+        self.IP = IP
+        self.keys = keys
+        self.transports = transports
+        self.handshake = handshake
+        self.executor = executor # Executor for RSA operations. None uses the loop's default executor
+
+        self.connected = False
+        self.reader = None
+        self.writer = None
+        self.sessionKey = None
+        self.pending = PendingRequests() # Requests waiting for a reply from the server
+        self.status = None # RThreadStatus shared with the threaded client's frame handling
+        self.incoming = asyncio.Queue() # Decrypted messages. None once the connection is closed
+        self.tasks = []
+        self.expiry = None # Timer failing requests that were not answered in time
+        self.lastPacket = None # Future done once the last packet built has been written (see build_packet)
+
+    async def connect(self):
+        ''' Connects to the server and runs the handshake. Returns True on success. If
+            the server closes the connection when it receives an X25519 hello and then
+            accepts the RSA handshake, only the RSA handshake is used with it for a while,
+            as with Client
+        '''
+        loop = asyncio.get_running_loop()
+        if self.IP is None:
+            self.IP = get_ip()
+        if self.keys is None: # May load or generate the stored keys
+            self.keys = await loop.run_in_executor(self.executor, KEY_RING.keys)
+
+        connection = await self.open_session(first_handshake(self.address, self.handshake))
+        if connection is False: # Server may not know the X25519 handshake
+            connection = await self.open_session(HANDSHAKE_RSA)
+            if connection:
+                pin_rsa_only(self.address)
+        if not connection:
+            print('Could not connect to server {}:{}'.format(*self.address))
+            return False
+
+        self.reader, self.writer, self.sessionKey, decoder = connection
+        self.connected = True
+        self.incoming = asyncio.Queue()
+        received = asyncio.Queue() # Messages waiting to be decrypted
+
+        # Frames are handled as on the receiving thread. Messages are queued for the
+        # decrypt task instead of a decrypt pool
+        self.status = RThreadStatus()
+        self.status.pending = self.pending
+        self.status.decryptPool = ReceivedMessages(received)
+
+        self.tasks = [loop.create_task(self.receive(decoder, received)),
+                      loop.create_task(self.decrypt(received))]
+        self.expiry = loop.call_later(EXPIRY_INTERVAL, self.expire)
+        return True
+
+    async def open_session(self, handshake):
+        ''' (bytes) -> (StreamReader, StreamWriter, bytes/AEADSession, FrameDecoder)
+            (bytes) -> None/False
+
+            Opens a connection to the server and runs one handshake. Returns None if it
+            fails, or False if the server closed the connection without answering an
+            X25519 hello (see Client.x25519_handshake)
+        '''
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(*self.address), REQUEST_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            return None
+
+        decoder = FrameDecoder()
+        try:
+            if handshake == HANDSHAKE_X25519:
+                session = await asyncio.wait_for(self.x25519_handshake(reader, writer, decoder), REQUEST_TIMEOUT)
+            else:
+                session = await asyncio.wait_for(self.rsa_handshake(reader, writer, decoder), REQUEST_TIMEOUT)
+        except (OSError, asyncio.TimeoutError, ProtocolError, ValueError):
+            session = None
+
+        if session is None or session is False:
+            writer.close()
+            return session
+        return reader, writer, session, decoder
+
+    async def rsa_handshake(self, reader, writer, decoder):
+        loop = asyncio.get_running_loop()
+        hello = await loop.run_in_executor(self.executor, rsa_hello, self.IP, self.keys)
+        writer.write(hello)
+        await writer.drain()
+
+        handshake2 = await read_frame(reader, decoder)
+        reply = await loop.run_in_executor(self.executor, rsa_key_transfer, handshake2, self.keys, self.transports)
+        if reply is None:
+            return None
+        handshake3, session = reply
+        writer.write(handshake3)
+        await writer.drain()
+        return session
+
+    async def x25519_handshake(self, reader, writer, decoder):
+        loop = asyncio.get_running_loop()
+        ephemeralKey, handshakeFields = await loop.run_in_executor(self.executor, x25519_hello, self.IP, self.keys, self.transports)
+        writer.write(encodeFrame(FRAME_HANDSHAKE, handshakeFields))
+        await writer.drain()
+        try:
+            reply = await read_frame(reader, decoder)
+        except ConnectionError: # Reset by a server that does not know this handshake
+            reply = None
+        if reply is None:
+            return False if decoder.pending() == 0 else None
+        return x25519_session(handshakeFields, ephemeralKey, reply, self.transports)
+
+    async def receive(self, decoder, received):
+        # Reader task. Handles every frame from the server until the connection closes
+        try:
+            while True:
+                for frame in decoder.frames():
+                    handle_frame(frame, self.status, self.sessionKey)
+                data = await self.reader.read(RECEIVE_SIZE)
+                if not data:
+                    break
+                decoder.feed(data)
+        except (OSError, ProtocolError):
+            pass
+        except Exception: # Nothing reads from the connection any more, so close it
+            print('Receive task failed')
+            traceback.print_exc()
+            self.writer.close()
+        finally: # Also when the task is cancelled
+            if self.connected:
+                print('Lost connection with server')
+            self.connected = False
+            received.put_nowait(None) # Ends the decrypt task
+            self.pending.failAll(ConnectionError('connection to server closed')) # No more replies will arrive
+        return None
+
+    async def decrypt(self, received):
+        # Decrypt task. Decrypts received messages in order, a batch at a time
+        loop = asyncio.get_running_loop()
+        closed = False
+        while not closed:
+            batch = [await received.get()]
+            while not received.empty():
+                batch.append(received.get_nowait())
+            if batch[-1] is None: # Connection closed
+                closed = True
+                batch.pop()
+            if len(batch) > 0:
+                for message in await loop.run_in_executor(self.executor, decrypt_messages, batch):
+                    self.incoming.put_nowait(message)
+        self.incoming.put_nowait(None)
+        return None
+
+    def expire(self):
+        # Fail requests whose deadline has passed, until the connection closes
+        self.pending.expire()
+        if self.connected:
+            self.expiry = asyncio.get_running_loop().call_later(EXPIRY_INTERVAL, self.expire)
+        return None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.incoming.get()
+        if message is None:
+            self.incoming.put_nowait(None) # Also ends later iterations
+            raise StopAsyncIteration
+        return message
+
+    async def send(self, packet):
+        # Encrypt packet with the session key and send it. Returns False if it could not be sent
+        if not self.connected:
+            return False
+        try:
+            self.writer.write(encodeSessionFrame(packet, self.sessionKey))
+            await asyncio.wait_for(self.writer.drain(), REQUEST_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            print('Failed to send message')
+            return False
+        return True
+
+    async def build_packet(self, rsa, func, *args):
+        ''' Builds a request packet with func(*args), in the executor if it uses RSA
+            (rsa is True) so the event loop is not blocked. Packets are returned in the
+            order they were asked for, so requests made concurrently are still sent in
+            order: each waits until the packet before it has been written
+        '''
+        loop = asyncio.get_running_loop()
+        previous = self.lastPacket
+        built = self.lastPacket = loop.create_future()
+        try:
+            if rsa:
+                packet = await loop.run_in_executor(self.executor, func, *args)
+            else:
+                packet = func(*args)
+            if previous is not None and not previous.done():
+                await asyncio.wait([previous]) # Not cancelled if this task is
+            return packet
+        finally:
+            # Tasks waiting on this future resume on a later pass of the loop, after the
+            # caller has written the packet (request() writes it without yielding)
+            built.set_result(None)
+
+    async def request(self, packet, requestID, future, default=False):
+        # Send a request registered with pending and wait for its reply
+        if packet is None or not await self.send(packet):
+            self.pending.complete(requestID, [b'55'])
+        return await wait_for_reply(future, default)
+
+    async def send_message(self, message, IP, etype, eKey, publicKey, timeout=REQUEST_TIMEOUT):
+        ''' Sends a message to be forwarded to the user at IP. Returns True once the
+            server acknowledges it, or False if it is refused or not acknowledged in
+            time. Messages sent concurrently from several tasks are all in flight at once
+        '''
+        requestID, future = self.pending.add(b'200', timeout) # ID echoed in the server's ACK
+        packet = await self.build_packet(etype not in SYMMETRIC_TYPES, message_packet, message, IP,
+                                         self.userName, etype, eKey, publicKey, requestID)
+        if etype == 6: # The message may carry the key exchange of a new ratchet chain
+            future.add_done_callback(lambda f: restart_ratchet_if_lost(f, publicKey))
+        return await self.request(packet, requestID, future)
+
+    async def send_group_message(self, message, groupID, etype, groupKey, timeout=REQUEST_TIMEOUT):
+        # Send a message to be forwarded to every member of group 'groupID'
+        requestID, future = self.pending.add(b'300', timeout)
+        packet = await self.build_packet(False, group_message_packet, message, groupID, self.userName, etype, groupKey, requestID)
+        return await self.request(packet, requestID, future)
+
+    async def create_group(self, groupID, memberKeys, groupKey, timeout=REQUEST_TIMEOUT):
+        # Create a group chat on the server. Arguments are those of Client.createGroup
+        requestID, future = self.pending.add(b'30', timeout)
+        packet = await self.build_packet(True, group_packet, groupID, memberKeys, groupKey, requestID)
+        return await self.request(packet, requestID, future)
+
+    async def get_public_key(self, receiverName, receiverIP, timeout=REQUEST_TIMEOUT):
+        # Query a user's public key from the server. Returns None if the user does not
+        # exist or the server does not reply in time
+        requestID, future = self.pending.add(b'20', timeout)
+        packet = await self.build_packet(False, public_key_packet, receiverName, receiverIP, requestID)
+        return await self.request(packet, requestID, future, None)
+
+    async def create_account(self, username, password, timeout=REQUEST_TIMEOUT):
+        # Create a user account. On success the username is used for later messages
+        requestID, future = self.pending.add(b'10', timeout)
+        packet = await self.build_packet(False, account_packet, username, password, requestID)
+        status = await self.request(packet, requestID, future)
+        if status:
+            self.userName = username
+        return status
+
+    async def disconnect(self):
+        # Tell the server this client is disconnecting and close the connection
+        if self.writer is None:
+            return None
+        if self.connected:
+            self.connected = False
+            try:
+                self.writer.write(encodeSessionFrame(DISCONNECT_PACKET, self.sessionKey))
+                await asyncio.wait_for(self.writer.drain(), REQUEST_TIMEOUT)
+            except (OSError, asyncio.TimeoutError):
+                pass
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+        await asyncio.gather(*self.tasks) # Deliver the messages already received
+        if self.expiry is not None:
+            self.expiry.cancel()
+        self.writer = None
+        await asyncio.get_running_loop().run_in_executor(self.executor, RATCHETS.save_all) # Save where the receiving ratchets are
+        return None
+
+    async def __aenter__(self):
+        if not await self.connect():
+            raise ConnectionError('could not connect to server')
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.disconnect()
+        return False
+
+class ReceivedMessages:
+    # Takes the place of the receiving thread's DecryptPool: handle_frame adds received
+    # messages to a queue, which the decrypt task reads
+    def __init__(self, queue):
+        self.queue = queue
+
+    def add(self, fields):
+        self.queue.put_nowait(fields)
+        return None
+
+    def flush(self, rCallback=None):
+        return None
+# ================================================================================================================
+
+# =============================================== Helper Functions ===============================================
+async def read_frame(reader, decoder):
+    ''' (StreamReader, FrameDecoder) -> (int, list)
+        (StreamReader, FrameDecoder) -> None
+
+        Waits for a complete frame. Returns None if the connection is closed first
+    '''
+    frame = decoder.nextFrame()
+    while frame is None:
+        data = await reader.read(RECEIVE_SIZE)
+        if not data:
+            return None
+        decoder.feed(data)
+        frame = decoder.nextFrame()
+    return frame
+
+async def wait_for_reply(future, default=False):
+    ''' Wait for a request's (concurrent) Future. Returns default if it timed out or the
+        connection was lost. The Future is shielded so cancelling the waiting task does
+        not cancel it, since the reply may still arrive and complete it
+    '''
+    try:
+        return await asyncio.shield(asyncio.wrap_future(future))
+    except (TimeoutError, asyncio.TimeoutError, ConnectionError): # PendingRequests sets the builtin TimeoutError
+        return default
+
+def decrypt_messages(batch):
+    # Decrypt a list of received messages in order, leaving out those that can not be read
+    messages = []
+    for fields in batch:
+        try:
+            message = message_from_fields(fields)
+        except Exception as e: # Also raised by messages that were not encrypted for this user
+            print('Could not decrypt message: {}'.format(e))
+            continue
+        if message is not None:
+            messages.append(message)
+    return messages
+# ================================================================================================================
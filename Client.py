@@ -8,8 +8,14 @@
 '''
 
 from socket import *
-from threading import Thread
+from threading import Thread, Lock, RLock, Condition
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeout
 from cipher import *
+from protocol import *
+from Database import DATABASE_PATH, connect_database, get_ratchet, set_ratchet
+import os
+import sqlite3
 import time
 import traceback
 import json
@@ -19,66 +25,177 @@ serverName = "54.144.253.235" # IP address of AWS t2.micro instance running the
 #serverName = "127.0.0.1" # Used to test locally
 serverPort = 12000
 
+# Seconds to wait for the server to reply to a request
+REQUEST_TIMEOUT = 3
+
+# Threads decrypting received messages, so the receiving thread keeps reading the
+# socket while they work. 0 decrypts on the receiving thread
+DECRYPT_WORKERS = 2
+
+# Messages sent while earlier ones are waiting for their ACK are held for up to this many
+# seconds, or until this many bytes are waiting, and then sent to the server together
+# in one batch request. 0 sends every message on its own
+SEND_WINDOW = 0.002
+SEND_BATCH_BYTES = 64 * 1024
+
+# This user's RSA keys and the parsed public keys of other users, loaded once instead
+# of for every message
+KEY_RING = KeyRing()
+
+# Saved receiving ratchets may be up to this many messages behind, so the message
+# database is not written for every message
+RATCHET_SAVE_INTERVAL = 64
+
+# Messages sent on a ratchet chain before a new chain (and key exchange) is started
+RATCHET_CHAIN_LENGTH = 10000
+
+# Server addresses that closed the connection when sent an X25519 hello, and then
+# accepted the RSA handshake, mapped to the time (time.monotonic()) until which only the
+# RSA handshake is used with them. X25519 is tried again afterwards, in case the server
+# was updated
+RSA_ONLY_SERVERS = {}
+RSA_ONLY_LIFETIME = 24 * 60 * 60 # Seconds
+
 # ================================================= Client Class =================================================
 class Client:
     # This class servers as an interface to the client module's functionality. 
-    def __init__(self, rThreadCallback=None):
+    def __init__(self, rThreadCallback=None, decryptWorkers=DECRYPT_WORKERS, sendWindow=SEND_WINDOW, sendBatchBytes=SEND_BATCH_BYTES):
         self.profile = read_user_profile() # Get user preferences from JSON file
 
         # Intialize client 
+        self.rThreadCallback = rThreadCallback
+        self.decryptWorkers = decryptWorkers
+        self.sendLimits = (sendWindow, sendBatchBytes)
+        self.pending = PendingRequests() # Requests waiting for a reply from the server
         server_connection = connectToServer() # Attempt to connect to server
         self.rThread = None  
+        self.outbound = None # SendQueue every request to the server is sent through
         self.connected = False
         if server_connection is not None: # connectToServer() succeeded
             self.connected = True
-            self.soc, self.sessionKey = server_connection # Store client socket and session key
-            self.rThread = create_receiving_thread(self.soc, self.sessionKey, rThreadCallback) # Create receiving thread
+            self.soc, self.sessionKey, decoder = server_connection # Store client socket and session key
+            self.rThread = create_receiving_thread(self.soc, self.sessionKey, rThreadCallback, decoder, self.pending, decryptWorkers) # Create receiving thread
+            self.outbound = create_send_queue(self.soc, self.sessionKey, self.rThread, self.pending, *self.sendLimits)
         else: # connectToServer() failed
             self.soc = None
             self.sessionKey = None
 
         # References to implemented encryption algorithms in cipher.py
-        self.encryptionTypes = {'plaintext': 0, 'ROT13': 1, 'vigenere': 2, 'AES': 3, 'RSA': 4, 'Fernet': 5}
-
-    def sendMessage(self, message, IP, etype, eKey, publicKey):
-        # Send message to server to be forwarded to destination 'IP'
+        self.encryptionTypes = {'plaintext': 0, 'ROT13': 1, 'vigenere': 2, 'AES': 3, 'RSA': 4, 'Fernet': 5, 'ratchet': 6}
+
+    def sendMessage(self, message, IP, etype, eKey, publicKey, timeout=REQUEST_TIMEOUT):
+        # Send message to server to be forwarded to destination 'IP'. Returns True once
+        # the server acknowledges it, or False if it is refused or not acknowledged in time
+        return wait_for_reply(self.sendMessageAsync(message, IP, etype, eKey, publicKey, timeout), timeout)
+
+    def sendMessageAsync(self, message, IP, etype, eKey, publicKey, timeout=REQUEST_TIMEOUT):
+        ''' Sends a message without waiting for the server's ACK, so many messages can
+            be in flight at once. Returns a Future that is set to True when the server
+            forwards or stores the message and to False if it is refused; it fails with
+            TimeoutError if no ACK arrives within timeout seconds. Messages sent while
+            others are in flight may be batched (see SendQueue)
+        '''
         if self.soc is None: # Cannot send message if socket is None
-            return False
+            return failed_request(False)
         uName = self.profile['uName'] # Get username to identify self to receiver
-        sendSuccess = sendMessageTo(self.soc, message, IP, uName, etype, eKey, publicKey, self.sessionKey) # Send message to server
-        time.sleep(.25) # Wait for ACK
-        recvAck = self.rThread.status.ACK # Read ACK from receiving thread
-        status = sendSuccess and recvAck # If successful send and received ACK from server
-        self.rThread.status.ACK = False # Reset ACK for next message
-        return status # Report success
-
-    def getPublicKey(self, receiverName, receiverIP):
-        # Query a user's public key from the server using their username
-        sendSuccess = getPublicKeyFromServer(self.soc, self.sessionKey, receiverName, receiverIP)
-
-        # Initialize ACK with none, if the receiving thread receives the public key from the server
-        # it will store the key in ACK for us to read here
-        self.rThread.status.ACK = None 
-        time.sleep(1) # Wait for ACK
-        pubkeybytes = self.rThread.status.ACK # If public key was received, store in pubkeybytes
-        self.rThread.status.ACK = False # Reset ACK for next message
-        return pubkeybytes
+        requestID, future = self.pending.add(b'200', timeout) # ID echoed in the server's ACK
+        packet = message_packet(message, IP, uName, etype, eKey, publicKey, requestID)
+        self.outbound.queue(packet, requestID, future) # Send message to server
+        if etype == 6: # The message may carry the key exchange of a new ratchet chain
+            future.add_done_callback(lambda f: restart_ratchet_if_lost(f, publicKey))
+        return future
+
+    def getPublicKey(self, receiverName, receiverIP, timeout=REQUEST_TIMEOUT):
+        # Query a user's public key from the server using their username. Returns None if
+        # the user does not exist or the server does not reply in time
+        if self.soc is None:
+            return None
+        requestID, future = self.pending.add(b'20', timeout)
+        if not self.outbound.send(public_key_packet(receiverName, receiverIP, requestID)):
+            self.pending.complete(requestID, [b'55'])
+        return wait_for_reply(future, timeout, None) # Public key bytes
+
+    def createGroup(self, groupID, memberKeys, groupKey, timeout=REQUEST_TIMEOUT):
+        ''' Create a group chat on the server. memberKeys maps each member's username to
+            their public key (bytes) and must include this user. groupKey is the AES or
+            Fernet key shared by the group; it is sent encrypted with each member's key
+        '''
+        if self.soc is None:
+            return False
+        requestID, future = self.pending.add(b'30', timeout)
+        if not self.outbound.send(group_packet(groupID, memberKeys, groupKey, requestID)):
+            self.pending.complete(requestID, [b'55'])
+        return wait_for_reply(future, timeout)
+
+    def sendGroupMessage(self, message, groupID, etype, groupKey, timeout=REQUEST_TIMEOUT):
+        # Send message to server to be forwarded to every member of group 'groupID'
+        return wait_for_reply(self.sendGroupMessageAsync(message, groupID, etype, groupKey, timeout), timeout)
+
+    def sendGroupMessageAsync(self, message, groupID, etype, groupKey, timeout=REQUEST_TIMEOUT):
+        # Like sendMessageAsync, for a group message. Returns a Future
+        if self.soc is None:
+            return failed_request(False)
+        uName = self.profile['uName']
+        requestID, future = self.pending.add(b'300', timeout)
+        packet = group_message_packet(message, groupID, uName, etype, groupKey, requestID)
+        if packet is None:
+            self.pending.complete(requestID, [b'55'])
+        else:
+            self.outbound.queue(packet, requestID, future)
+        return future
+
+    def reconnect(self):
+        ''' Reconnect to the server, e.g. after the connection was lost. If the server
+            gave this client a resumption ticket it is used to skip the full handshake,
+            otherwise (or if the ticket is rejected) the full handshake is run
+        '''
+        ticket = None
+        if self.rThread is not None:
+            ticket = self.rThread.status.ticket
+            if self.soc is not None:
+                try:
+                    self.soc.shutdown(SHUT_RDWR) # Wake up the receiving thread
+                except OSError:
+                    pass
+            self.rThread.close()
+        if self.outbound is not None: # Messages still queued fail with the old connection
+            self.outbound.close()
+        if self.soc is not None:
+            self.soc.close()
+
+        server_connection = None
+        if ticket is not None: # Resume with the transport the ticket was issued on
+            server_connection = resumeSession(*ticket, transport=sessionTransport(self.sessionKey))
+        if server_connection is None:
+            server_connection = connectToServer()
+
+        self.rThread = None
+        self.outbound = None
+        self.connected = server_connection is not None
+        if server_connection is not None:
+            self.soc, self.sessionKey, decoder = server_connection
+            self.rThread = create_receiving_thread(self.soc, self.sessionKey, self.rThreadCallback, decoder, self.pending, self.decryptWorkers)
+            self.outbound = create_send_queue(self.soc, self.sessionKey, self.rThread, self.pending, *self.sendLimits)
+        else:
+            self.soc = None
+            self.sessionKey = None
+        return self.connected
 
     def readMessage(self, message):
         return message
 
-    def createAccount(self, username, password):
+    def createAccount(self, username, password, timeout=REQUEST_TIMEOUT):
         # Negotiate with server to create a user account
         if self.soc is None: # Cannot create account if no server connection
             return None
 
         # Send username and password to server
-        sendSuccess = createUserAccount(self.soc, self.sessionKey, username, password)
+        requestID, future = self.pending.add(b'10', timeout)
+        if not self.outbound.send(account_packet(username, password, requestID)):
+            self.pending.complete(requestID, [b'55'])
 
-        time.sleep(2) # Wait for ACK
-        recvAck = self.rThread.status.ACK
-        status = sendSuccess and recvAck # Successful account creation if message sent successfully and received ACK from server
-        self.rThread.status.ACK = False # Reset ACK for next message
+        # Successful account creation if the server replies with an ACK
+        status = wait_for_reply(future, timeout)
 
         # If account creation was successful, store username
         if status:
@@ -107,21 +224,27 @@ class Client:
 
     def disconnect(self):
         # Disconnect from the server
+        if self.outbound is not None: # Send the messages that are still queued
+            self.outbound.close()
         if self.rThread is not None: # Close receiving thread
             self.rThread.close()
         if self.soc is not None: # Close socket
             disconnectServer(self.soc, self.sessionKey)
+        RATCHETS.save_all() # Save where the receiving ratchets are
 # ================================================================================================================
 
 # =============================================== Receiving Thread ===============================================
 class RThreadStatus:
     # This class is used to communicate with the receiving thread. It is passed as
     # an argument to the receiving thread target and can terminate the receiving thread with
-    # the terminate variable, and the receiving thread can pass server responses through the
-    # ACK variable
+    # the terminate variable, and the receiving thread passes server replies to the requests
+    # waiting in pending
     def __init__(self):
         self.terminate = False
-        self.ACK = False
+        self.ticket = None # (ticket, secret) used to resume the session after a reconnect
+        self.pending = None # PendingRequests completed by the server's replies
+        self.decryptPool = None # DecryptPool decrypting received messages, if any
+        self.features = set() # Optional requests the server announced (see protocol.py)
 
 class ReceivingThread:
     # This class is used to manage the receiving thread and its status
@@ -132,45 +255,534 @@ class ReceivingThread:
     def close(self):
         self.status.terminate = True # Stop the receiving thread loop
         self.thread.join() # Join thread
+        if self.status.decryptPool is not None: # Deliver the messages already received
+            self.status.decryptPool.close()
+
+class DecryptPool:
+    ''' Lanes of single worker threads that decrypt received messages and pass them to
+        the callback. The receiving thread only reads frames, removes the session
+        encryption and completes requests, so it keeps reading the socket (and replies
+        are not held up) while a burst of messages is decrypted. A sender is always
+        served by the same lane, and each lane handles its messages in order, so every
+        sender's messages are delivered in the order they were received.
+
+        Messages are collected with add() and handed to the lanes with flush() after
+        every receive, so each lane gets the messages of a whole receive as one job.
+    '''
+    def __init__(self, lanes=DECRYPT_WORKERS):
+        self.lanes = [ThreadPoolExecutor(max_workers=1, thread_name_prefix='decrypt') for i in range(lanes)]
+        self.batches = [[] for lane in self.lanes] # Messages waiting for flush(), per lane
+
+    def add(self, fields):
+        # Queue a message for its sender's lane. fields[1] is the sender's IP
+        self.batches[hash(fields[1]) % len(self.lanes)].append(fields)
+        return None
+
+    def flush(self, rCallback=None):
+        # Start decrypting and delivering the queued messages
+        for i, batch in enumerate(self.batches):
+            if len(batch) > 0:
+                self.lanes[i].submit(deliver_messages, batch, rCallback)
+                self.batches[i] = []
+        return None
+
+    def close(self, wait=True):
+        for lane in self.lanes:
+            lane.shutdown(wait=wait)
+        return None
+
+def acknowledged(fields):
+    # Result of a request answered with an ACK (50 or 51), a dropped code (52) or a failure code (55)
+    return fields[0] in (b'50', b'51')
+
+def public_key_reply(fields):
+    # Result of a public key request: the key, or None if the user does not exist
+    if fields[0] == b'20':
+        return fields[1]
+    return None
 
-def receiving_thread(conn, bufferSize, status, sessionKey, rCallback=None):
-    # Receiving thread target
+# Reply codes the server may answer each request type with, and the function turning
+# the reply fields into the result of the request's Future
+REQUEST_REPLIES = {b'10': ((b'50', b'55'), acknowledged), # Create account
+                   b'20': ((b'20', b'55'), public_key_reply), # Get public key
+                   b'30': ((b'50', b'55'), acknowledged), # Create group
+                   b'200': ((b'50', b'51', b'52', b'55'), acknowledged), # Message
+                   b'300': ((b'50', b'55'), acknowledged) # Group message
+                   }
+
+class PendingRequests:
+    ''' Requests sent to the server that are waiting for a reply. Each request carries
+        a request ID that the server echoes in its (encrypted) reply, and the receiving
+        thread uses the ID to complete the request's Future as soon as the reply arrives.
+        Requests are therefore not limited to one in flight, and a reply can not be taken
+        for another request's: it must echo the ID and have a code that the request's
+        type expects. Requests that are not answered before their deadline fail with
+        TimeoutError
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.requests = {} # request ID -> (Future, deadline, request type)
+        self.nextID = random.randint(0, (2**32) - 1)
+        self.nextExpiry = 0 # Time of the next check for expired requests
+
+    def add(self, requestType, timeout=REQUEST_TIMEOUT):
+        ''' (bytes, float) -> (bytes, Future)
+
+            Registers a new request of requestType (its code, e.g. b'20') and returns
+            its ID and Future
+        '''
+        future = Future()
+        with self.lock:
+            self.nextID = (self.nextID + 1) % (2**32)
+            requestID = str(self.nextID).encode()
+            self.requests[requestID] = (future, time.monotonic() + timeout, requestType)
+        return requestID, future
+
+    def complete(self, requestID, fields):
+        ''' (bytes, list) -> bool
+
+            Completes a request with the fields of its reply (without the request ID).
+            Returns False if the request is unknown, has expired, or does not expect
+            this reply
+        '''
+        with self.lock:
+            request = self.requests.get(requestID)
+            if request is None:
+                return False
+            codes, result = REQUEST_REPLIES[request[2]]
+            if len(fields) == 0 or fields[0] not in codes:
+                return False
+            del self.requests[requestID]
+        request[0].set_result(result(fields))
+        return True
+
+    def expire(self):
+        # Fail requests whose deadline has passed. Checks at most twice a second
+        now = time.monotonic()
+        if now < self.nextExpiry:
+            return None
+        self.nextExpiry = now + 0.5
+        with self.lock:
+            expired = [requestID for requestID, (future, deadline, requestType) in self.requests.items() if deadline <= now]
+            futures = [self.requests.pop(requestID)[0] for requestID in expired]
+        for future in futures:
+            future.set_exception(TimeoutError('no reply from server'))
+        return None
+
+    def failAll(self, error):
+        # Fail every waiting request, e.g. when the connection is lost
+        with self.lock:
+            futures = [request[0] for request in self.requests.values()]
+            self.requests.clear()
+        for future in futures:
+            future.set_exception(error)
+        return None
+
+def receiving_thread(conn, bufferSize, status, sessionKey, rCallback=None, decoder=None):
+    # Receiving thread target. decoder may hold frames received before the thread started
+    if decoder is None:
+        decoder = FrameDecoder(bufferSize) # Reassembles frames from received data
     conn.settimeout(1) # Timeout after 1 second
     while not status.terminate: # Loop until terminate
         try:
-            packet = conn.recv(bufferSize) # Receive packet from server
+            # Handle every complete frame that has been received
+            for frame in decoder.frames():
+                handle_frame(frame, status, sessionKey, rCallback)
+            if status.decryptPool is not None:
+                status.decryptPool.flush(rCallback)
+            if status.pending is not None:
+                status.pending.expire()
+            if decoder.recvFrom(conn) == 0: # Receive data from server
+                print('Lost connection with server')
+                break
         except timeout:
             continue
+        except (OSError, ProtocolError):
+            print('Lost connection with server')
+            break
+    if status.decryptPool is not None: # Messages received before the connection was lost
+        status.decryptPool.flush(rCallback)
+    if status.pending is not None: # No more ACKs will arrive on this connection
+        status.pending.failAll(ConnectionError('connection to server closed'))
+    return None
 
-        # Decrypt packet and separate the values
-        fields = unPack(packet, sessionKey)
-        if fields is None: # Received invalid packet
-            continue
-        if len(fields) != 6:
-            # Check for ACK from server
-            if fields[0] == b'50': # Message ACK
-                status.ACK = True
-            if fields[0] == b'20': # Received a public key from server
-                status.ACK = fields[1] # Pass to Client class through status.ACK (fields[1] holds key)
-            continue
+def handle_frame(frame, status, sessionKey, rCallback=None):
+    # Handle a single frame received from the server. Messages are passed to the
+    # decrypt pool if there is one
+
+    # Decrypt packet and separate the values
+    fields = unPack(frame, sessionKey)
+    if fields is None: # Received invalid packet
+        return None
+    if len(fields) != 6 and len(fields) != 7:
+        # Reply to a request, ending with the request's ID. Only trusted when encrypted
+        # with the session key
+        if len(fields) >= 2 and frame[0] == sessionFrameType(sessionKey) and status.pending is not None:
+            if fields[0] == b'250' and len(fields) == 2: # Replies to the requests of a batch
+                complete_batch(fields[1], status.pending)
+                return None
+            if status.pending.complete(fields[-1], fields[:-1]):
+                return None
+        if fields[0] == b'110' and len(fields) == 4: # Resumption ticket for the next connection
+            status.ticket = (fields[1], fields[2])
+        elif fields[0] == b'130' and len(fields) == 2: # Optional requests the server handles
+            try:
+                status.features = set(unpackFields(fields[1]))
+            except ProtocolError:
+                pass
+        return None
 
-        # If the previous if statements did not execute, then a valid message was received. Extract
-        # relevant information and pass to UI for handling
-        senderName = fields[0].decode() # Username of sender
-        ip = fields[1].decode() # IP address of sender
-        encryptionType = fields[2].decode() # Type of encryption used on the message
+    # If the previous if statements did not execute, then a valid message was received
+    if status.decryptPool is not None:
+        status.decryptPool.add(fields)
+        return None
+    deliver_message(fields, rCallback)
+    return None
+
+def complete_batch(replies, pending):
+    # Complete the requests answered by a batch reply, each with its own reply
+    try:
+        for reply in unpackFields(replies):
+            reply = unpackFields(reply)
+            if len(reply) >= 2:
+                pending.complete(reply[-1], reply[:-1])
+    except ProtocolError:
+        print('Invalid batch reply')
+    return None
+
+def deliver_messages(batch, rCallback=None):
+    # Decrypt pool job: deliver a list of received messages in order
+    for fields in batch:
+        deliver_message(fields, rCallback)
+    return None
+
+def deliver_message(fields, rCallback=None):
+    # Decrypt a received message. Extract relevant information and pass to UI for handling
+    try:
+        message = message_from_fields(fields)
+    except Exception as e: # Also raised by messages that were not encrypted for this user
+        print('Could not decrypt message: {}'.format(e))
+        return None
+    if message is None: # Could not be decrypted
+        return None
+
+    if rCallback is not None:
+        rCallback(message) # Pass message to UI
+    elif len(message) == 4: # Group message
+        print('[{}] {}'.format(message[3], message[1]))
+    else:
+        print(message[1])
+    return None
 
-        IV = fields[3] # Initialization vector (If sender encrypted with AES, otherwise unused)
-        Key = fields[4] # Key used to encrypt message. The key itself is encrypted with receivers public key
-        encMessage = fields[5] # Encrypted message
+def message_from_fields(fields):
+    ''' (list) -> tuple
+        (list) -> None
 
-        message = stripEnc(encryptionType, IV, Key, encMessage) # Decrypt the message
-        
-        if rCallback is not None:
-            rCallback((ip, message, senderName)) # Pass message to UI
+        Decrypts the message in the fields of a received message frame. Returns the
+        tuple passed to the UI: (IP, message, sender) or, for a group message,
+        (IP, message, sender, group ID). None if the message could not be decrypted
+    '''
+    senderName = fields[0].decode() # Username of sender
+    ip = fields[1].decode() # IP address of sender
+    encryptionType = fields[2].decode() # Type of encryption used on the message
+
+    IV = fields[3] # Initialization vector (If sender encrypted with AES, otherwise unused)
+    Key = fields[4] # Key used to encrypt message. The key itself is encrypted with receivers public key
+    encMessage = fields[5] # Encrypted message
+
+    message = stripEnc(encryptionType, IV, Key, encMessage, ip) # Decrypt the message
+    if message is None:
+        return None
+
+    if len(fields) == 7: # Group message. Key holds the group key encrypted for this user
+        groupID = fields[6].decode()
+        return (ip, message, senderName, groupID)
+    return (ip, message, senderName)
+# ================================================================================================================
+
+# ================================================== Send Queue ==================================================
+class SendQueue:
+    ''' Requests waiting to be sent to the server. A message is sent straight away if
+        none of the messages sent before it are still waiting for their ACK, so a user
+        sending one message at a time is never held up. Messages sent while earlier ones
+        are in flight (e.g. by a script) are queued instead, and those queued within
+        window seconds, or until limit bytes are queued, are sent as one batch request:
+        a single encryption and send for the whole batch. The server still handles and
+        acknowledges every message on its own, by its request ID.
+
+        Batches are only sent to servers that announce FEATURE_BATCH; otherwise every
+        request is sent on its own. Every request on the connection is sent through the
+        queue: messages (200) and group messages (300) with queue(), other requests with
+        send(), which sends the queued requests first. So requests reach the server in
+        the order they were made, and frames are encrypted in the order they are sent.
+    '''
+    def __init__(self, soc, sessionKey, status, window=SEND_WINDOW, limit=SEND_BATCH_BYTES):
+        self.soc = soc
+        self.sessionKey = sessionKey
+        self.status = status # RThreadStatus of the receiving thread, which learns the server's features
+        self.window = window
+        self.limit = limit
+
+        self.requests = [] # (packet, packed packet, request ID) waiting to be sent
+        self.queued = 0 # Bytes in requests
+        self.since = 0 # Time the oldest queued request was queued
+        self.inFlight = deque() # Futures of the messages sent or queued, oldest first
+        self.closed = False
+        self.lock = Lock()
+        self.ready = Condition(self.lock) # Notified when requests are queued or the queue is closed
+        self.sendLock = RLock() # Held while a frame is encrypted and sent
+
+        self.thread = Thread(target=send_queue_thread, args=(self,), daemon=True)
+        self.thread.start()
+
+    def queue(self, packet, requestID, future):
+        ''' Sends a message, or queues it to be sent with the next batch. future is the
+            message's Future, done once its ACK arrives. If it can not be sent the
+            request is completed as failed
+        '''
+        if self.window <= 0 or FEATURE_BATCH not in self.status.features:
+            sent = self.send(packet)
         else:
-            print(message)
+            with self.lock:
+                while len(self.inFlight) > 0 and self.inFlight[0].done():
+                    self.inFlight.popleft()
+                idle = len(self.inFlight) == 0
+                self.inFlight.append(future)
+                if not idle and not self.closed:
+                    packed = packFields(packet)
+                    if len(packed) < self.limit: # Larger messages are sent on their own
+                        if len(self.requests) == 0:
+                            self.since = time.monotonic()
+                        self.requests.append((packet, packed, requestID))
+                        self.queued += len(packed)
+                        if len(self.requests) == 1 or self.queued >= self.limit:
+                            self.ready.notify()
+                        return None
+            sent = self.send(packet)
+        if not sent:
+            self.status.pending.complete(requestID, [b'55'])
+        return None
+
+    def send(self, packet):
+        # Encrypt packet with the session key and send it now, after the requests that are
+        # still queued. Returns False if it could not be sent
+        with self.sendLock:
+            self.flush() # Earlier requests go first
+            return self.write(encodeSessionFrame(packet, self.sessionKey))
+
+    def flush(self):
+        # Send the queued requests, as a batch request if there is more than one
+        with self.sendLock:
+            with self.lock:
+                requests = self.requests
+                self.requests = []
+                self.queued = 0
+            if len(requests) == 0:
+                return None
+            if len(requests) == 1:
+                packet = requests[0][0]
+            else:
+                packet = [b'250', packFields([packed for packet, packed, requestID in requests]), b'0', b'0', b'0']
+            sent = self.write(encodeSessionFrame(packet, self.sessionKey))
+        if not sent:
+            for packet, packed, requestID in requests:
+                self.status.pending.complete(requestID, [b'55'])
+        return None
+
+    def write(self, data):
+        try:
+            self.soc.sendall(data)
+        except OSError: # Includes timeouts
+            print("Failed to send message")
+            return False
+        return True
+
+    def close(self):
+        # Send the requests that are still queued and stop the queue's thread
+        with self.lock:
+            self.closed = True
+            self.ready.notify()
+        self.thread.join()
+        return None
+
+def send_queue_thread(queue):
+    # Thread target that sends the queued requests once they have waited for the window
+    while True:
+        with queue.ready:
+            while len(queue.requests) == 0 and not queue.closed:
+                queue.ready.wait()
+            if len(queue.requests) == 0: # Closed
+                return None
+            # Let more requests join the batch until the window ends or the batch is full
+            while not queue.closed and queue.queued < queue.limit:
+                remaining = queue.since + queue.window - time.monotonic()
+                if remaining <= 0:
+                    break
+                queue.ready.wait(remaining)
+        queue.flush()
+# ================================================================================================================
+
+# ================================================= Ratchet Store ================================================
+class RatchetStore:
+    ''' Ratchet chains of the ratchet encryption type (6). The first message to a user
+        starts a chain: the chain key is encrypted with the receiver's public key, signed
+        with this user's private key and sent along with the message (the key exchange).
+        Every later message is encrypted with the next key of the chain, so it costs two
+        HMACs and AES-GCM instead of RSA operations. A new chain is started every
+        RATCHET_CHAIN_LENGTH messages.
+
+        Received chains are found by their chain ID. A key exchange must be signed with
+        the public key stored for the sender's chat, or for a sender without a chat, with
+        the key that signed their first chain. Receiving chains are saved in the keys table
+        of the message database when they start, every RATCHET_SAVE_INTERVAL messages and
+        when the client disconnects, so messages that arrive after a restart can still be
+        read. Sending chains are kept in memory only: a restarted client starts new chains,
+        so a message key is never used twice.
+    '''
+    def __init__(self, path=DATABASE_PATH):
+        self.path = path
+        self.sending = {} # Receiver's public key bytes -> HashRatchet
+        self.receiving = {} # Chain ID -> [ReceivingRatchet, sender IP, chain index when saved]
+        self.peers = {} # Sender IP -> public key bytes that signed its chains, for senders without a chat
+        self.lock = Lock()
+        self.connection = None
+        self.cursor = None
+
+    def encrypt(self, message, publicKey):
+        ''' (string, bytes) -> (bytes, bytes, bytes)
+
+            Encrypts message for the owner of publicKey. Returns the encrypted message,
+            the message header and the key exchange (b'0' unless the message starts a
+            new chain)
+        '''
+        with self.lock:
+            chain = self.sending.get(publicKey)
+            exchange = b'0'
+            if chain is None or chain.index >= RATCHET_CHAIN_LENGTH:
+                chain = self.sending[publicKey] = HashRatchet()
+                exchange = ratchet_exchange(chain, publicKey)
+            header = chain.header()
+            messageKey = chain.step()
+        return ratchet_encrypt(message, messageKey, header), header, exchange
+
+    def decrypt(self, IP, header, exchange, encMessage):
+        ''' (string, bytes, bytes, bytes) -> string
+            (string, bytes, bytes, bytes) -> None
+
+            Decrypts a message from the user at IP. Returns None if the chain is unknown,
+            the key exchange is not valid or the message is not authentic
+        '''
+        parsed = ratchet_parse_header(header)
+        if parsed is None:
+            return None
+        chainID, index = parsed
+        with self.lock:
+            entry = self.receiving.get(chainID)
+            if entry is None:
+                if exchange != b'0':
+                    entry = self.accept(IP, chainID, exchange)
+                else: # Chain started before a restart
+                    entry = self.load(IP, chainID)
+            if entry is None:
+                print('Ratchet Error: no key for message from {}'.format(IP))
+                return None
+            plaintext = entry[0].open(index, header, encMessage)
+            if plaintext is None:
+                print('Ratchet Error: rejected message from {}'.format(IP))
+                return None
+            if entry[0].chain.index - entry[2] >= RATCHET_SAVE_INTERVAL:
+                self.save(entry)
+        return plaintext.decode()
+
+    def accept(self, IP, chainID, exchange):
+        # Check a key exchange and start receiving its chain. Returns the chain's entry,
+        # or None if the exchange is not signed by the sender or not meant for this user
+        try:
+            wrapped, senderKey, signature = unpackFields(exchange, count=3)
+            chat = self.chat(IP)
+            known = chat[1] if chat is not None else self.peers.get(IP)
+            if known is not None and known != senderKey:
+                print('Ratchet Error: key exchange from {} is not signed by its user'.format(IP))
+                return None
+            if not RSA_verify(signature, RATCHET_EXCHANGE_LABEL + wrapped, KEY_RING.public_key(senderKey)):
+                return None
+            secret = RSA_private_key_decrypt(wrapped, KEY_RING.private_key())
+        except (ProtocolError, ValueError, TypeError):
+            return None
+        if secret[:RATCHET_ID_SIZE] != chainID:
+            return None
+
+        self.peers.setdefault(IP, senderKey)
+        chain = HashRatchet(secret[RATCHET_ID_SIZE:], chainID)
+        entry = self.receiving[chainID] = [ReceivingRatchet(chain), IP, 0]
+        self.save(entry)
+        return entry
+
+    def load(self, IP, chainID):
+        # Entry of the chain saved for the chat with IP, if it is the chain chainID
+        chat = self.chat(IP)
+        chain = HashRatchet.from_bytes(chat[2]) if chat is not None else None
+        if chain is None or chain.chainID != chainID:
+            return None
+        entry = self.receiving[chainID] = [ReceivingRatchet(chain), IP, chain.index]
+        return entry
+
+    def save(self, entry):
+        # Save a receiving chain in its chat's row of the keys table. Chains of senders
+        # without a chat are kept in memory only
+        ratchet, IP, saved = entry
+        entry[2] = ratchet.chain.index
+        chat = self.chat(IP)
+        if chat is None:
+            return None
+        try:
+            set_ratchet(self.cursor, chat[0], ratchet.chain.to_bytes())
+            self.connection.commit()
+        except sqlite3.Error as e:
+            print('Ratchet Error: {}'.format(e))
+        return None
+
+    def save_all(self):
+        # Save every receiving chain that has moved since it was saved
+        with self.lock:
+            for entry in list(self.receiving.values()):
+                if entry[0].chain.index != entry[2]:
+                    self.save(entry)
+        return None
+
+    def chat(self, IP):
+        # (chat name, public key, saved ratchet) of the chat with IP, or None
+        try:
+            if self.cursor is None:
+                self.connection, self.cursor = connect_database(self.path, check_same_thread=False)
+            return get_ratchet(self.cursor, IP)
+        except sqlite3.Error as e:
+            print('Ratchet Error: {}'.format(e))
+            return None
+
+    def restart(self, publicKey):
+        # Start a new chain with the next message to the owner of publicKey
+        with self.lock:
+            self.sending.pop(publicKey, None)
+        return None
+
+def ratchet_exchange(chain, publicKey):
+    # Key exchange of a new sending chain: the chain ID and key encrypted for the
+    # receiver, this user's public key and a signature over the encrypted key
+    pubKey, privKey = KEY_RING.keys()
+    wrapped = RSA_public_key_encrypt(chain.chainID + chain.chainKey, KEY_RING.public_key(publicKey))
+    signature = RSA_sign(RATCHET_EXCHANGE_LABEL + wrapped, privKey)
+    return packFields([wrapped, RSA_get_bytes_from_key(pubKey), signature])
+
+def restart_ratchet_if_lost(future, publicKey):
+    # Done callback of a ratchet message. If it was not delivered the receiver may not
+    # have the chain's key exchange, so the next message starts a new chain
+    if future.exception() is not None or not future.result():
+        RATCHETS.restart(publicKey)
     return None
+
+# Ratchet chains of this user, shared by its connections like KEY_RING
+RATCHETS = RatchetStore()
 # ================================================================================================================
 
 # =============================================== Helper Functions ===============================================
@@ -214,13 +826,16 @@ def read_user_profile():
 
         return data
 
-def create_receiving_thread(cSock, sessionKey, callback=None):
+def create_receiving_thread(cSock, sessionKey, callback=None, decoder=None, pending=None, decryptWorkers=DECRYPT_WORKERS):
     # Helper function to create and start the receiving thread. Returns a
     # ReceivingThread class instance
     status = RThreadStatus()
+    status.pending = pending
+    if decryptWorkers > 0:
+        status.decryptPool = DecryptPool(decryptWorkers)
     rThread = None
     try:
-        rThread = Thread(target=receiving_thread, args=(cSock, 4096, status, sessionKey, callback))
+        rThread = Thread(target=receiving_thread, args=(cSock, 4096, status, sessionKey, callback, decoder))
         rThread.start()
     except Exception:
         print('Receiving thread did not start')
@@ -230,13 +845,36 @@ def create_receiving_thread(cSock, sessionKey, callback=None):
         return None
     return ReceivingThread(rThread, status)
 
-def stripEnc(encryptionType, IV, encKey, encMessage):
-    ''' (string, bytes, bytes, bytes) -> string
+def create_send_queue(cSock, sessionKey, rThread, pending, window=SEND_WINDOW, limit=SEND_BATCH_BYTES):
+    # Helper function to create the SendQueue of a connection. rThread is its
+    # ReceivingThread, which learns whether the server accepts batches
+    if rThread is not None:
+        status = rThread.status
+    else:
+        status = RThreadStatus()
+        status.pending = pending
+    return SendQueue(cSock, sessionKey, status, window, limit)
+
+def failed_request(result):
+    # Future for a request that could not be sent
+    future = Future()
+    future.set_result(result)
+    return future
+
+def wait_for_reply(future, timeout=REQUEST_TIMEOUT, default=False):
+    # Wait for a request's Future. Returns default if it timed out or the connection was lost
+    try:
+        return future.result(timeout + 1) # The receiving thread fails it after timeout
+    except (TimeoutError, FutureTimeout, ConnectionError):
+        return default
+
+def stripEnc(encryptionType, IV, encKey, encMessage, IP=None):
+    ''' (string, bytes, bytes, bytes, string) -> string
 
-        Decrypts 'encMessage' based on encryption type
+        Decrypts 'encMessage' based on encryption type. IP is the sender's IP address,
+        used to find the chat of a ratchet message. Returns None if a ratchet or long RSA
+        message can not be decrypted
     '''
-    privKey = RSA_load_private_key() # Load private key from file
-    
     if encryptionType == '0': # Encrypted message is plaintext
         return encMessage.decode() # Convert bytes to string
 
@@ -248,126 +886,348 @@ def stripEnc(encryptionType, IV, encKey, encMessage):
 
     elif encryptionType == '3': # Encrypted with AES
         # Decrypt the AES encryption key with own private key
-        key = RSA_private_key_decrypt(encKey, privKey)
+        key = RSA_private_key_decrypt(encKey, KEY_RING.private_key())
         # Decrypt the message with AES key
         message = AES_decrypt(encMessage, IV, key).decode()
 
     elif encryptionType == '4': # Encrypted with RSA
-        message = RSA_private_key_decrypt(encMessage, privKey).decode()
+        if encKey == b'0': # Short message, encrypted with RSA itself
+            message = RSA_private_key_decrypt(encMessage, KEY_RING.private_key()).decode()
+        else: # AES-GCM encrypted message. encKey holds its key encrypted with RSA, IV the nonce prefix
+            message = RSA_hybrid_decrypt(encKey, IV, encMessage, KEY_RING.private_key())
+            if message is not None:
+                message = message.decode()
 
     elif encryptionType == '5': # Encrypted with Fernet
         # Decrypt the Fernet encryption key with own private key
-        key = RSA_private_key_decrypt(encKey, privKey)
+        key = RSA_private_key_decrypt(encKey, KEY_RING.private_key())
         # Decrypt the message with Fernet key
         message = Fernet_decrypt(encMessage, key)
+
+    elif encryptionType == '6': # Encrypted with a ratchet chain. IV holds the message header
+        message = RATCHETS.decrypt(IP, IV, encKey, encMessage)
     
     return message
 
-def connectToServer():
-    ''' () -> (socket, bytes)
+def connectToServer(address=None, IP=None, keys=None, transports=AEAD_TRANSPORTS, handshake=HANDSHAKE_X25519):
+    ''' () -> (socket, bytes/AEADSession, FrameDecoder)
         () -> None
 
         Connects to the server and establishes session key. Returns appropriate
-        socket and session key on success and returns None on failure. 
+        socket, session key and the decoder holding any frames the server sent right
+        after the handshake on success and returns None on failure. The server
+        address, the IP sent to the server and the RSA keys default to serverName and
+        serverPort, this machine's IP and the stored keys.
+
+        The first of transports (AEAD transports in order of preference) that the
+        server offers is used, in which case an AEADSession is returned in place of
+        the session key. Otherwise the session uses CBC.
+
+        handshake is HANDSHAKE_X25519 or HANDSHAKE_RSA. If the server closes the
+        connection when it receives an X25519 hello the RSA handshake is tried. If that
+        succeeds the server only knows the RSA handshake, which is then used for every
+        connection to that address for RSA_ONLY_LIFETIME seconds
     '''
+    if address is None:
+        address = (serverName, serverPort)
+
+    # Get client IP (IP of machine before NAT)
+    if IP is None:
+        IP = get_ip()
+
+    # Retrieve stored RSA keys (Or generate and store RSA keys if no RSA key exists)
+    if keys is None:
+        keys = KEY_RING.keys()
+
     print('Connecting to server ... ', end='')
+    connection = run_handshake(address, first_handshake(address, handshake), IP, keys, transports)
+    if connection is False: # Server may not know the X25519 handshake
+        connection = run_handshake(address, HANDSHAKE_RSA, IP, keys, transports)
+        if connection:
+            pin_rsa_only(address)
+    if not connection:
+        print('Failed')
+        return None
+
+    print('Success')
+    return connection
+
+def first_handshake(address, handshake):
+    # Handshake to try first with the server at address
+    expiry = RSA_ONLY_SERVERS.get(address)
+    if expiry is not None and time.monotonic() < expiry:
+        return HANDSHAKE_RSA
+    return handshake
+
+def pin_rsa_only(address):
+    # Use only the RSA handshake with the server at address for RSA_ONLY_LIFETIME seconds.
+    # Called once it has refused an X25519 hello and accepted the RSA handshake
+    RSA_ONLY_SERVERS[address] = time.monotonic() + RSA_ONLY_LIFETIME
+
+def run_handshake(address, handshake, IP, keys, transports):
+    ''' (tuple, bytes, string, tuple, tuple) -> (socket, bytes/AEADSession, FrameDecoder)
+        (tuple, bytes, string, tuple, tuple) -> None/False
+
+        Opens a connection to the server and runs one handshake. Returns None if it
+        fails, or False if the server closed the connection without answering an
+        X25519 hello (see x25519_handshake)
+    '''
     # Create client socket
     clientSocket = socket(AF_INET, SOCK_STREAM)
 
     # Establish TCP connection with server
     clientSocket.settimeout(3)
+    decoder = FrameDecoder()
     try:
-        clientSocket.connect((serverName, serverPort))
-    except Exception:
-        print('Failed')
-        return None
+        clientSocket.connect(address)
+        if handshake == HANDSHAKE_X25519:
+            sessionKey = x25519_handshake(clientSocket, decoder, IP, keys, transports)
+        else:
+            sessionKey = rsa_handshake(clientSocket, decoder, IP, keys, transports)
+    except (timeout, OSError, ProtocolError, ValueError):
+        sessionKey = None
+
+    if sessionKey is None or sessionKey is False:
+        clientSocket.close()
+        return sessionKey
     clientSocket.settimeout(None)
+    return clientSocket, sessionKey, decoder
 
-    # Get client IP (IP of machine before NAT)
-    IP = get_ip()
+def rsa_handshake(clientSocket, decoder, IP, keys, transports):
+    ''' (socket, FrameDecoder, string, tuple, tuple) -> bytes/AEADSession
+        (socket, FrameDecoder, string, tuple, tuple) -> None
 
-    # Retrieve stored RSA keys (Or generate and store RSA keys if no RSA key exists)
-    publicKey, privateKey = RSA_get_keys()
+        Runs the RSA handshake on a connected socket and returns the session key
+    '''
+    # Send client public key to server
+    clientSocket.sendall(rsa_hello(IP, keys))
+
+    # Receive server handshake message with server public key
+    handshake2 = recvFrame(clientSocket, decoder)
+    reply = rsa_key_transfer(handshake2, keys, transports)
+    if reply is None:
+        return None
+    handshake3, session = reply
+
+    # Send encrypted session key with signature to server
+    clientSocket.sendall(handshake3)
+    return session
+
+def rsa_hello(IP, keys):
+    # First frame of the RSA handshake: the client's public key, signed
+    publicKey, privateKey = keys
 
     # Convert client public key object into bytes for transmission to server
     pubkeyBytes = RSA_get_bytes_from_key(publicKey)
 
     # Construct handshake message to send client public key to server
-    handshakeMessage = f"100\r\n{IP}\r\n".encode() + pubkeyBytes + b'\r\n0'
+    handshakeFields = [b'100', IP, pubkeyBytes, HANDSHAKE_RSA]
 
-    signature = RSA_sign(handshakeMessage, privateKey)
+    signature = RSA_sign(packFields(handshakeFields), privateKey)
 
     # Send handshake and signature for verification
-    handshake1 = handshakeMessage + b'\r\n' + signature
+    return encodeFrame(FRAME_HANDSHAKE, handshakeFields + [signature])
 
-    clientSocket.settimeout(3)
-    try:
-        # Send client public key to server
-        clientSocket.send(handshake1)
+def rsa_key_transfer(handshake2, keys, transports):
+    ''' ((int, list), tuple, tuple) -> (bytes, bytes/AEADSession)
+        ((int, list), tuple, tuple) -> None
 
-        # Receive server handshake message with server public key
-        handshake2 = clientSocket.recv(4096)
+        Checks the server's reply to the RSA hello and chooses the transport and session
+        key. Returns the frame sending them to the server and the session, or None if
+        the reply is not valid
+    '''
+    publicKey, privateKey = keys
+    if handshake2 is None or handshake2[0] != FRAME_HANDSHAKE or len(handshake2[1]) != 4:
+        print('Invalid Server Response')
+        return None
+    fields = list(handshake2[1])
 
-        fields = handshake2.split(b'\r\n')
+    # Convert server public key from bytes to public key object
+    serverPubKey = RSA_get_key_from_bytes(fields[1])
 
-        if len(fields) != 4:
-            print('Invalid Server Response')
-            return None
+    # Retrieve and remove signature from header fields
+    signature = fields.pop(-1)
 
-        # Convert server public key from bytes to public key object
-        serverPubKey = RSA_get_key_from_bytes(fields[1])
+    # Pack header fields into bytes to test signature
+    message = packFields(fields)
 
-        # Retrieve and remove signature from header fields
-        signature = fields.pop(-1)
+    # Verify the message using the signature
+    if not RSA_verify(signature, message, serverPubKey):
+        print("Invalid signature")
+        return None
 
-        # Join header fields into bytes to test signature
-        message = b'\r\n'.join(fields)
+    # Choose the transport. Servers that do not offer any send b'0'
+    try:
+        offered = unpackFields(fields[2])
+    except ProtocolError:
+        offered = []
+    transport = TRANSPORT_CBC
+    for t in transports:
+        if t in offered:
+            transport = t
+            break
+
+    # Create AES session key
+    sessionKey = AES_generate_key()
+
+    # Construct handshake message to send the transport and session key to server
+    key_transfer = packFields([b'100', transport, sessionKey])
+
+    # Encrypt session key message with server public key and use client private key to sign message
+    enc_message, signature = RSA_encrypt(key_transfer, serverPubKey, privateKey)
+
+    handshake3 = encodeFrame(FRAME_HANDSHAKE, [enc_message, signature])
+    return handshake3, createSession(sessionKey, transport, initiator=True)
+
+def x25519_handshake(clientSocket, decoder, IP, keys, transports):
+    ''' (socket, FrameDecoder, string, tuple, tuple) -> bytes/AEADSession
+        (socket, FrameDecoder, string, tuple, tuple) -> None/False
+
+        Runs the X25519 handshake on a connected socket and returns the session key.
+        The hello carries an ephemeral X25519 key and is signed with the Ed25519
+        identity key, which the RSA key vouches for. Returns False if the server closes
+        or resets the connection after receiving the hello without sending any of a
+        reply, as servers that do not know this handshake do. Returns None on other
+        failures, such as a connection lost before the hello was sent or during the reply
+    '''
+    ephemeralKey, handshakeFields = x25519_hello(IP, keys, transports)
+    clientSocket.sendall(encodeFrame(FRAME_HANDSHAKE, handshakeFields))
+    try:
+        reply = recvFrame(clientSocket, decoder)
+    except ConnectionError: # Reset by a server that does not know this handshake
+        reply = None
+    if reply is None:
+        return False if decoder.pending() == 0 else None
+    return x25519_session(handshakeFields, ephemeralKey, reply, transports)
 
-        # Verify the message using the signature
-        if not RSA_verify(signature, message, serverPubKey):
-            print("Invalid signature")
-            return None
+def x25519_hello(IP, keys, transports):
+    ''' (string, tuple, tuple) -> (X25519PrivateKey, list)
 
-        # Create AES session key
-        sessionKey = AES_generate_key()
+        Returns the ephemeral key and the fields of the X25519 client hello
+    '''
+    publicKey, privateKey = keys
+    identityKey, binding = KEY_RING.identity(privateKey)
+    ephemeralKey, ephemeral = X25519_gen_key()
+
+    # Client hello, with the transports the server may choose from
+    handshakeFields = [b'100', IP, RSA_get_bytes_from_key(publicKey), HANDSHAKE_X25519,
+                       Ed25519_get_bytes_from_key(identityKey.public_key()), binding, ephemeral,
+                       packFields(transports)]
+    handshakeFields.append(Ed25519_sign(packFields(handshakeFields), identityKey))
+    return ephemeralKey, handshakeFields
+
+def x25519_session(handshakeFields, ephemeralKey, reply, transports):
+    ''' (list, X25519PrivateKey, (int, list), tuple) -> bytes/AEADSession
+        (list, X25519PrivateKey, (int, list), tuple) -> None
+
+        Checks the server's reply to the X25519 hello and returns the session, or None
+        if the reply is not valid
+    '''
+    if reply[0] != FRAME_HANDSHAKE or len(reply[1]) != 5:
+        print('Invalid Server Response')
+        return None
+    replyFields = reply[1][:-1]
+    code, serverIdentity, serverEphemeral, transport = replyFields
 
-        # Construct handshake message to send session key to server
-        key_transfer = b'100\r\n0\r\n' + sessionKey
+    # The server signs both hellos with its identity key
+    transcript = packFields(handshakeFields + replyFields)
+    if not Ed25519_verify(reply[1][-1], transcript, serverIdentity):
+        print("Invalid signature")
+        return None
 
-        # Encrypt session key message with server public key and use client private key to sign message
-        enc_message, signature = RSA_encrypt(key_transfer, serverPubKey, privateKey)
+    if transport != TRANSPORT_CBC and transport not in transports:
+        print('Invalid transport: {}'.format(transport))
+        return None
 
-        # Send encrypted session key with signature to server
-        handshake3 = enc_message + b'\r\n' + signature
-        clientSocket.send(handshake3)
-        
-    except timeout:
+    sessionKey = handshakeSessionKey(X25519_exchange(ephemeralKey, serverEphemeral), transcript)
+    return createSession(sessionKey, transport, initiator=True)
+
+def resumeSession(ticket, secret, address=None, transport=TRANSPORT_CBC):
+    ''' (bytes, bytes, tuple, bytes) -> (socket, bytes/AEADSession, FrameDecoder)
+        (bytes, bytes, tuple, bytes) -> None
+
+        Connects to the server and resumes a previous session with a ticket the server
+        issued. No RSA operations are needed: the client proves it knows the ticket's
+        secret and both sides derive the new session key from the secret and their
+        nonces. transport is the transport of the session the ticket was issued on.
+        Returns the socket, the session key (or AEAD session) and the decoder holding
+        any frames the server sent after its reply, or None if the server rejects the
+        ticket (e.g. it has expired)
+    '''
+    if address is None:
+        address = (serverName, serverPort)
+
+    print('Resuming session ... ', end='')
+    clientSocket = socket(AF_INET, SOCK_STREAM)
+    clientSocket.settimeout(3)
+    try:
+        clientSocket.connect(address)
+
+        clientNonce = os.urandom(NONCE_SIZE)
+        fields = [b'120', ticket, clientNonce]
+        proof = HMAC_sign(packFields(fields), secret)
+        clientSocket.sendall(encodeFrame(FRAME_HANDSHAKE, fields + [proof]))
+
+        # Server replies with its nonce and proof that it could open the ticket
+        decoder = FrameDecoder()
+        reply = recvFrame(clientSocket, decoder)
+        if reply is None or reply[0] != FRAME_HANDSHAKE or len(reply[1]) != 3:
+            print('Rejected')
+            clientSocket.close()
+            return None
+        code, serverNonce, serverProof = reply[1]
+        if not HMAC_verify(serverProof, packFields([b'121', clientNonce, serverNonce]), secret):
+            print('Invalid server proof')
+            clientSocket.close()
+            return None
+    except (timeout, OSError, ProtocolError):
         print('Failed')
+        clientSocket.close()
         return None
     clientSocket.settimeout(None)
 
+    sessionKey = derive_key(secret, b'session', clientNonce + serverNonce)
     print('Success')
-    return clientSocket, sessionKey
+    return clientSocket, createSession(sessionKey, transport, initiator=True), decoder
 
-def unPack(message, sessionKey):
-    # Split header fields of message
-    fields = message.split(b'\r\n')
+def unPack(frame, sessionKey):
+    # Get header fields of a frame
+    frameType, fields = frame
 
-    # Either improper format of header fields or message ACK from server
-    if len(fields) != 2:
+    # Unencrypted reply from server (ACK or public key)
+    if frameType != FRAME_SESSION and frameType != FRAME_AEAD:
         return fields
+    if frameType != sessionFrameType(sessionKey): # Not encrypted the way this session is
+        return None
+
+    # Decrypt message with client/server AES session key and return message header fields
+    return decodeSessionFrame(fields, sessionKey)
+
+def sendMessageTo(soc, message, destination, uName, encryptionType, encryptionKey, publicKey, sessionKey, requestID=None):
+    # Create Packet with the encrypted message
+    packet = message_packet(message, destination, uName, encryptionType, encryptionKey, publicKey, requestID)
+
+    # Encrypt packet with client/server session key
+    new_packet = encodeSessionFrame(packet, sessionKey)
+
+    # Send encrypted message and initialization vector to server
+    soc.settimeout(3)
+    try:
+        soc.sendall(new_packet)
+    except timeout:
+        print("Failed to send message")
+        return False
 
-    # Decrypt message with client/server AES session key
-    plaintext = AES_decrypt(fields[1], fields[0], sessionKey)
-    # Split and return message header fields
-    return plaintext.split(b'\r\n')
+    return True
+
+def encryptMessage(message, encryptionType, encryptionKey, publicKey):
+    ''' (string, int, bytes, bytes) -> (bytes, bytes, bytes)
 
-def sendMessageTo(soc, message, destination, uName, encryptionType, encryptionKey, publicKey, sessionKey):
-    # Encrypt message
+        Encrypts message based on encryption type. Returns the encrypted message, the
+        AES initialization vector and the encryption key encrypted with publicKey
+    '''
     iv = b'0' # Default value for IV if AES is not used
 
-    publicKey = RSA_get_key_from_bytes(publicKey)
-    
     if encryptionType == 0: # Plaintext
         encMessage = message.encode() # Convert to bytes for transmission
         encKey = b'0'
@@ -378,77 +1238,87 @@ def sendMessageTo(soc, message, destination, uName, encryptionType, encryptionKe
 
     elif encryptionType == 2: # Vigenere
         encMessage = vig_encrypt(message).encode()
-        encKey = RSA_public_key_encrypt(encryptionKey, publicKey)
+        encKey = RSA_public_key_encrypt(encryptionKey, KEY_RING.public_key(publicKey))
 
     elif encryptionType == 3: # AES
         encMessage, iv = AES_encrypt(message, encryptionKey)
-        encKey = RSA_public_key_encrypt(encryptionKey, publicKey)
+        encKey = RSA_public_key_encrypt(encryptionKey, KEY_RING.public_key(publicKey))
 
     elif encryptionType == 4: # RSA
-        rsaKey = RSA_get_key_from_bytes(encryptionKey)
-        encMessage = RSA_public_key_encrypt(message, rsaKey)
-        encKey = b'0'
+        rcvPub = KEY_RING.public_key(encryptionKey)
+        messageBytes = message.encode()
+        if len(messageBytes) <= RSA_max_message_size(rcvPub): # Fits in one RSA block, readable by older clients
+            encMessage = RSA_public_key_encrypt(messageBytes, rcvPub)
+            encKey = b'0'
+        else: # Encrypt a message key with RSA and the message with AES-GCM
+            encKey, iv, encMessage = RSA_hybrid_encrypt(messageBytes, rcvPub)
 
     elif encryptionType == 5: # Fernet
         encMessage = Fernet_encrypt(message.encode(), encryptionKey)
-        encKey = RSA_public_key_encrypt(encryptionKey, publicKey)
+        encKey = RSA_public_key_encrypt(encryptionKey, KEY_RING.public_key(publicKey))
+
+    elif encryptionType == 6: # Ratchet. encKey is the key exchange if this starts a chain
+        encMessage, iv, encKey = RATCHETS.encrypt(message, publicKey)
+
+    return encMessage, iv, encKey
 
-    # Create Packet
-    packet = f'200\r\n{destination}\r\n{uName}\r\n{encryptionType}'.encode() + b'\r\n' + iv + b'\r\n' + encKey + b'\r\n' + encMessage
+def createGroupChat(soc, sessionKey, groupID, memberKeys, groupKey, requestID=None):
+    packet = group_packet(groupID, memberKeys, groupKey, requestID)
 
     # Encrypt packet with client/server session key
-    packet_enc, iv = AES_encrypt(packet, sessionKey)
+    new_packet = encodeSessionFrame(packet, sessionKey)
 
-    new_packet = iv + b'\r\n' + packet_enc
+    soc.settimeout(3)
+    try:
+        soc.sendall(new_packet)
+    except timeout:
+        return False
+    return True
+
+def sendGroupMessageTo(soc, message, groupID, uName, encryptionType, groupKey, sessionKey, requestID=None):
+    packet = group_message_packet(message, groupID, uName, encryptionType, groupKey, requestID)
+    if packet is None:
+        return False
+
+    # Encrypt packet with client/server session key
+    new_packet = encodeSessionFrame(packet, sessionKey)
 
-    # Send encrypted message and initialization vector to server
     soc.settimeout(3)
     try:
-        soc.send(new_packet)
+        soc.sendall(new_packet)
     except timeout:
         print("Failed to send message")
         return False
-
     return True
 
-def createUserAccount(soc, sessionKey, username, password):
-    # Create hash of password
-    hashedPass = hashPassword(password) # Create password hash to send to server
-
-    # Sequence number. Not really used in this implementation. Future updates will use to prevent replay attack
-    seq = random.randint(0, (2**32) - 1)
-    
+def createUserAccount(soc, sessionKey, username, password, requestID=None):
     # Create packet with username and hash password
-    packet = b'10\r\n' + username.encode() + b'\r\n' + hashedPass + b'\r\n' + str(seq).encode() + b'\r\n0'
+    packet = account_packet(username, password, requestID)
 
     # Encrypt packet with client/server session key
-    packet_enc, iv = AES_encrypt(packet, sessionKey)
-
-    new_packet = iv + b'\r\n' + packet_enc
+    new_packet = encodeSessionFrame(packet, sessionKey)
 
     # Send packet to server
     soc.settimeout(3)
     try:
-        soc.send(new_packet)
+        soc.sendall(new_packet)
     except timeout:
         return False # Send failure
     soc.settimeout(1)
     # If no failure, return send success
     return True
 
-def getPublicKeyFromServer(soc, sessionKey, receiverName, receiverIP):
+def getPublicKeyFromServer(soc, sessionKey, receiverName, receiverIP, requestID=None):
     # Create packet
-    packet = b'20\r\n' + f"{receiverName}\r\n{receiverIP}".encode() + b'\r\n0\r\n0'
+    packet = public_key_packet(receiverName, receiverIP, requestID)
 
     # Encrypt packet with client session key
-    packet_enc, iv = AES_encrypt(packet, sessionKey)
-
-    new_packet = iv + b'\r\n' + packet_enc
+    new_packet = encodeSessionFrame(packet, sessionKey)
 
     # Send packet to server
     soc.settimeout(3)
     try:
-        soc.send(new_packet)
+        soc.sendall(new_packet)
     except timeout:
         return False
     soc.settimeout(1)
@@ -456,16 +1326,85 @@ def getPublicKeyFromServer(soc, sessionKey, receiverName, receiverIP):
 
 def disconnectServer(soc, sessionKey):
     # Create and encrypt packet to inform server of disconnect
-    packet = "0\r\n0\r\n0\r\n0\r\n0"
-    packet_enc, iv = AES_encrypt(packet, sessionKey)
+    new_packet = encodeSessionFrame(DISCONNECT_PACKET, sessionKey)
 
     # Send packet to server
-    new_packet = iv + b'\r\n' + packet_enc
     try:
-        soc.send(new_packet)
+        soc.sendall(new_packet)
         time.sleep(0.5)
         soc.close()
     except Exception:
         pass
     return None
 # ================================================================================================================
+
+# ==================================================== Packets ===================================================
+# Fields of the requests sent to the server, shared by Client and AsyncClient. The
+# server echoes the request ID (if any) in its reply
+
+# Tells the server the client is disconnecting
+DISCONNECT_PACKET = [b'0', b'0', b'0', b'0', b'0']
+
+def message_packet(message, destination, uName, encryptionType, encryptionKey, publicKey, requestID=None):
+    # Message to be forwarded to destination, encrypted for its receiver
+    encMessage, iv, encKey = encryptMessage(message, encryptionType, encryptionKey, publicKey)
+    packet = [b'200', destination, uName, str(encryptionType), iv, encKey, encMessage]
+    if requestID is not None:
+        packet.append(requestID)
+    return packet
+
+def group_message_packet(message, groupID, uName, encryptionType, groupKey, requestID=None):
+    # Message to every member of a group. None if the encryption type can not be used
+    # for groups
+
+    # Encrypt message with the group key. The server sends each member the group key
+    # encrypted with their own public key, so no key is sent here
+    iv = b'0'
+    if encryptionType == 0: # Plaintext
+        encMessage = message.encode()
+    elif encryptionType == 1: # ROT13
+        encMessage = rot13_encrypt(message).encode()
+    elif encryptionType == 2: # Vigenere
+        encMessage = vig_encrypt(message).encode()
+    elif encryptionType == 3: # AES
+        encMessage, iv = AES_encrypt(message, groupKey)
+    elif encryptionType == 5: # Fernet
+        encMessage = Fernet_encrypt(message.encode(), groupKey)
+    else: # RSA and ratchets need a different key for every member and are not used for groups
+        print('Encryption type {} is not supported for group messages'.format(encryptionType))
+        return None
+
+    packet = [b'300', groupID, uName, str(encryptionType), iv, b'0', encMessage]
+    if requestID is not None:
+        packet.append(requestID)
+    return packet
+
+def group_packet(groupID, memberKeys, groupKey, requestID=None):
+    # Encrypt the group key with every member's public key so only members can read it
+    names = list(memberKeys)
+    groupKeys = [RSA_public_key_encrypt(groupKey, KEY_RING.public_key(memberKeys[name])) for name in names]
+
+    # Member names and keys are packed as lists of fields
+    packet = [b'30', groupID, packFields(names), packFields(groupKeys), b'0']
+    if requestID is not None:
+        packet.append(requestID)
+    return packet
+
+def account_packet(username, password, requestID=None):
+    # Create hash of password
+    hashedPass = hashPassword(password) # Create password hash to send to server
+
+    # Sequence number. Not really used in this implementation. Future updates will use to prevent replay attack
+    seq = random.randint(0, (2**32) - 1)
+
+    packet = [b'10', username, hashedPass, str(seq), b'0']
+    if requestID is not None:
+        packet.append(requestID)
+    return packet
+
+def public_key_packet(receiverName, receiverIP, requestID=None):
+    packet = [b'20', receiverName, receiverIP, b'0', b'0']
+    if requestID is not None:
+        packet.append(requestID)
+    return packet
+# ================================================================================================================
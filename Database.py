@@ -13,6 +13,8 @@
 import sqlite3
 import random
 import string
+
+DATABASE_PATH = 'data/MessageDB.db'
 # ================================================================================================================
 
 # ================================================ Database Class ================================================
@@ -27,12 +29,12 @@ class DataBase:
     def store_sent_message(self, chat_name, message):
         # Store a sent message in the approriate message table and return
         # status code (success/failure)
-        return add_message(self.cursor, chat_name, 1, message)
+        return self.commit(add_message(self.cursor, chat_name, 1, message))
 
     def store_received_message(self, chat_name, message):
         # Store a received message in the approriate message table and return
         # status code (success/failure)
-        return add_message(self.cursor, chat_name, 0, message)
+        return self.commit(add_message(self.cursor, chat_name, 0, message))
 
     def get_chats_list(self):
         # Get the list of chats the user has created
@@ -49,19 +51,19 @@ class DataBase:
 
     def create_chat(self, chat_name, receiverIP, receiverName, keys):
         # Create a new chat
-        return create_chat(self.cursor, chat_name, receiverIP, receiverName, keys)
+        return self.commit(create_chat(self.cursor, chat_name, receiverIP, receiverName, keys))
 
     def delete_chat(self, chat_name):
         # Delete a chat
-        return delete_chat(self.cursor, chat_name)
+        return self.commit(delete_chat(self.cursor, chat_name))
     
     def update_chatname(self, cur_chat_name, new_chat_name):
         # Update the chat name for a chat
-        return rename_chat(self.cursor, cur_chat_name, new_chat_name)
+        return self.commit(rename_chat(self.cursor, cur_chat_name, new_chat_name))
 
     def update_ip(self, cur_chat_name, new_IP):
         # Update the IP address of a chat
-        return change_ip_address(self.cursor, cur_chat_name, new_IP)
+        return self.commit(change_ip_address(self.cursor, cur_chat_name, new_IP))
 
     def get_chat_by_ip(self, IP):
         # Find a chat in the database with the specified IP address
@@ -71,6 +73,13 @@ class DataBase:
         # Return the IP address of a chat with chat name 'chat_name'
         return get_ip_address(self.cursor, chat_name)
 
+    def commit(self, result):
+        # Save a change right away and return result. The client's ratchet store writes
+        # to the keys table from its own connection, which an open transaction here
+        # would lock out
+        self.connection.commit()
+        return result
+
     def disconnect(self):
         self.connection.commit() # Save changes
         self.connection.close() # Close connection
@@ -95,10 +104,10 @@ def is_valid_ip(IP):
             return False
     return True
 
-def connect_database():
+def connect_database(path=DATABASE_PATH, check_same_thread=True):
     # Creates database connection and cursor objects and initializes the chats
     # table and keys table
-    con = sqlite3.connect('data/MessageDB.db')
+    con = sqlite3.connect(path, check_same_thread=check_same_thread)
     cur = con.cursor()
     init_chats_table(cur)
     create_keys_table(cur)
@@ -213,6 +222,16 @@ def get_chat_key(cur, chat_name, keyType):
     if val is not None:
         return val[index]
     return val
+
+def get_ratchet(cur, IP):
+    # Returns (chat name, receiver's public key, stored receiving ratchet) for the chat
+    # with IP address 'IP', or None if there is no such chat
+    cur.execute(''' SELECT chats.chatName, keys.RSAPubKey, keys.RatchetKey
+                    FROM chats JOIN keys ON keys.chatName = chats.chatName
+                    WHERE chats.receiverIP=?
+                ''', (IP,)
+                )
+    return cur.fetchone()
 # ================================================================================================================
 
 # ======================================= Table/Row Modification Functions =======================================
@@ -434,8 +453,13 @@ def create_keys_table(cur):
     if cur.fetchone()[0] == 0:
         print("Creating table: keys")
         command = f'''CREATE TABLE keys
-                        (chatName TEXT, RSAPubKey BLOB, FernetKey BLOB, AESKey BLOB, VigenereKey BLOB)'''
+                        (chatName TEXT, RSAPubKey BLOB, FernetKey BLOB, AESKey BLOB, VigenereKey BLOB, RatchetKey BLOB)'''
         cur.execute(command)
+
+    # Add the ratchet column to keys tables created before it existed
+    cur.execute('PRAGMA table_info(keys)')
+    if 'RatchetKey' not in [column[1] for column in cur.fetchall()]:
+        cur.execute('ALTER TABLE keys ADD COLUMN RatchetKey BLOB')
     return None
 
 def insert_keys(cur, chat_name, keys):
@@ -459,6 +483,15 @@ def insert_keys(cur, chat_name, keys):
                     VALUES (?, ?, ?, ?, ?)
                ''', (chat_name, pubkey, fernetkey, aeskey, vigenerekey))
     return True
+
+def set_ratchet(cur, chat_name, ratchet):
+    # Store the receiving ratchet (bytes) of a chat
+    cur.execute(''' UPDATE keys
+                    SET RatchetKey=?
+                    WHERE chatName=?
+                ''', (ratchet, chat_name)
+                )
+    return cur.rowcount > 0
 # ================================================================================================================
 
 # ===================================================== Main =====================================================
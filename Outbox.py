@@ -0,0 +1,180 @@
+'''
+    Secure Messenger Application Outbox
+
+    Authors: Hans Prieto, Joshua Fawcett
+
+    The outbox is a durable store-and-forward queue on the server. Messages whose
+    recipient is not connected are stored in a local (server side) database file,
+    keyed by the recipient's IP address, and are delivered when the recipient connects.
+
+    A single writer thread owns the database connection. Requests are queued to it and
+    every request waiting in the queue is handled in one transaction, so a burst of
+    messages costs one commit (group commit) instead of one per message. Reads go
+    through the same thread and therefore always see earlier writes.
+'''
+
+import queue
+import sqlite3
+from threading import Thread, Lock
+from concurrent.futures import Future
+
+OUTBOX_PATH = 'data/Outbox.db'
+
+# Largest number of queued requests handled in one transaction
+MAX_BATCH = 1000
+
+# ================================================================================================================
+
+# ================================================= Outbox Class =================================================
+class Outbox:
+    # This class is an interface for the server to store messages for offline
+    # recipients and retrieve them when the recipient connects
+    def __init__(self, path=OUTBOX_PATH):
+        con, cur = connect_outbox(path)
+        self.connection = con
+        self.cursor = cur
+
+        # Number of stored messages per recipient, so the server can check for a
+        # backlog without a query
+        self.counts = dict(count_messages(cur))
+        self.lock = Lock()
+
+        self.requests = queue.SimpleQueue()
+        self.thread = Thread(target=writerThread, args=(self,), daemon=True)
+        self.thread.start()
+
+    def enqueue(self, recipient, message):
+        # Store a message (bytes) for recipient. Returns without waiting for the commit
+        with self.lock:
+            self.counts[recipient] = self.counts.get(recipient, 0) + 1
+        self.requests.put(('put', (recipient, message), None))
+        return None
+
+    def pending(self, recipient):
+        # Number of messages waiting for recipient
+        return self.counts.get(recipient, 0)
+
+    def take(self, recipient, limit):
+        ''' (string, int) -> list
+
+            Returns up to limit (id, message) rows for recipient, oldest first. The rows
+            stay stored until they are removed with delete()
+        '''
+        future = Future()
+        self.requests.put(('take', (recipient, limit), future))
+        return future.result()
+
+    def delete(self, recipient, ids):
+        # Remove delivered messages
+        with self.lock:
+            count = self.counts.get(recipient, 0) - len(ids)
+            if count > 0:
+                self.counts[recipient] = count
+            else:
+                self.counts.pop(recipient, None)
+        future = Future()
+        self.requests.put(('delete', ids, future))
+        return future.result()
+
+    def close(self):
+        future = Future()
+        self.requests.put(('close', None, future))
+        future.result()
+        self.thread.join()
+        return None
+# ================================================================================================================
+
+# ================================================= Writer Thread ================================================
+def writerThread(outbox):
+    ''' Thread target that owns the outbox database connection. Handles every queued
+        request in order, committing once per batch of requests
+    '''
+    cur = outbox.cursor
+    running = True
+    while running:
+        batch = [outbox.requests.get()] # Block until there is a request
+        while len(batch) < MAX_BATCH:
+            try:
+                batch.append(outbox.requests.get_nowait())
+            except queue.Empty:
+                break
+
+        results = []
+        for kind, args, future in batch:
+            try:
+                if kind == 'put':
+                    result = add_message(cur, *args)
+                elif kind == 'take':
+                    result = get_messages(cur, *args)
+                elif kind == 'delete':
+                    result = delete_messages(cur, args)
+                else:
+                    running = False
+                    result = None
+                results.append((future, result, None))
+            except sqlite3.Error as e:
+                print('Outbox Error: {}'.format(e))
+                results.append((future, None, e))
+
+        outbox.connection.commit() # One commit for the whole batch
+
+        # Report results once the batch is saved
+        for future, result, error in results:
+            if future is None:
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    outbox.connection.close()
+    return None
+# ================================================================================================================
+
+# =============================================== Helper Functions ===============================================
+def connect_outbox(path=OUTBOX_PATH):
+    # Create and return database connection and cursor objects. The connection is
+    # created here and then used only by the writer thread
+    con = sqlite3.connect(path, check_same_thread=False)
+    cur = con.cursor()
+    cur.execute('PRAGMA journal_mode=WAL')
+    init_outbox_table(cur)
+    con.commit()
+    return con, cur
+
+def init_outbox_table(cur):
+    cur.execute(''' CREATE TABLE IF NOT EXISTS outbox
+                        (mID INTEGER PRIMARY KEY AUTOINCREMENT, recipient TEXT, message BLOB)
+                ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS outbox_recipient ON outbox (recipient, mID)')
+
+def count_messages(cur):
+    # Number of stored messages for every recipient
+    cur.execute(''' SELECT recipient, count(*)
+                    FROM outbox
+                    GROUP BY recipient
+                ''')
+    return cur.fetchall()
+
+def add_message(cur, recipient, message):
+    cur.execute(''' INSERT INTO outbox (recipient, message)
+                    VALUES (?, ?)
+                ''', (recipient, message))
+    return None
+
+def get_messages(cur, recipient, limit):
+    # Oldest messages stored for a recipient
+    cur.execute(''' SELECT mID, message
+                    FROM outbox
+                    WHERE recipient=?
+                    ORDER BY mID ASC
+                    LIMIT ?
+                ''', (recipient, limit))
+    return cur.fetchall()
+
+def delete_messages(cur, ids):
+    cur.executemany(''' DELETE FROM outbox
+                        WHERE mID=?
+                    ''', [(i,) for i in ids])
+    return None
+# ================================================================================================================
@@ -0,0 +1,289 @@
+'''
+    Secure Messenger Application Server Statistics
+
+    Authors: Hans Prieto, Joshua Fawcett
+
+    Counters and latency histograms recorded by the server while it handles clients.
+    The server times each stage of forwarding a message (decrypting the client's frame,
+    looking up the destination, encrypting for the destination and sending) and counts
+    connections, handshakes, dropped frames and bytes.
+
+    The statistics can be read while the server is running from a local-only stats
+    socket, which answers every connection with a JSON snapshot (plain HTTP, so both
+    curl and nc work):
+
+            curl http://127.0.0.1:12001/
+
+    and can be written to a JSON file at a fixed interval. A disabled Stats object
+    records nothing, so collection can be switched off entirely.
+'''
+
+import os
+import json
+import time
+from socket import *
+from collections import defaultdict
+from threading import Thread, Lock, Event, local, current_thread
+
+STATS_PORT = 12001
+STATS_PATH = 'data/stats.json'
+
+# Seconds between writes of the statistics file
+STATS_INTERVAL = 60
+
+# One in this many operations of each stage is timed
+STATS_SAMPLE = 16
+
+# Histogram bucket i counts durations of less than 2**i nanoseconds
+HISTOGRAM_BUCKETS = 48
+
+# ================================================================================================================
+
+# =================================================== Histogram ==================================================
+class Histogram:
+    ''' Latency histogram with power of two buckets. Recording is a few integer
+        operations, and percentiles are reported as the upper bound of the bucket
+        they fall in (so they are accurate to within a factor of two).
+    '''
+    def __init__(self):
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, ns):
+        self.buckets[min(ns.bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += ns
+        if ns > self.max:
+            self.max = ns
+
+    def merge(self, other):
+        # Add the durations recorded by other to this histogram
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, p):
+        # Upper bound (nanoseconds) of the bucket holding the p-th percentile
+        if self.count == 0:
+            return 0
+        rank = self.count * p / 100
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(2 ** i, self.max)
+        return self.max
+
+    def summary(self):
+        # Durations in microseconds
+        return {'count': self.count,
+                'mean_us': round(self.total / self.count / 1000, 1) if self.count else 0,
+                'p50_us': round(self.percentile(50) / 1000, 1),
+                'p99_us': round(self.percentile(99) / 1000, 1),
+                'max_us': round(self.max / 1000, 1)
+                }
+# ================================================================================================================
+
+# ================================================== Stats Class =================================================
+class Stats:
+    ''' Server counters and stage latencies. Stages are timed with:
+
+            start = stats.clock()
+            ...
+            stats.record('decrypt', start)
+
+        Only one in every sample calls to clock() starts a timer (the others return 0
+        and the matching record() does nothing), so the stage counts in a snapshot are
+        numbers of samples. Counters are exact. When disabled, every method returns
+        immediately and nothing is stored.
+
+        Every thread records into its own shard of counters and histograms, so the hot
+        path takes no locks. Shards are added together when a snapshot is taken, and the
+        shards of threads that have exited are folded into a retired total.
+    '''
+    def __init__(self, enabled=True, sample=STATS_SAMPLE):
+        self.enabled = enabled
+        self.sample = sample
+        self.ticks = 0 # Calls to clock(). Not exact when threads race, which only shifts the samples
+        self.started = time.time()
+        self.local = local()
+        self.shards = [] # (thread, counters, histograms) for every thread that recorded
+        self.retired = ({}, {}) # Totals of threads that have exited
+        self.gauges = {} # Values read when a snapshot is taken, e.g. connected clients
+        self.lock = Lock() # Protects shards and retired
+
+        self.socket = None
+        self.stopped = Event()
+        self.threads = []
+
+    def clock(self, always=False):
+        # Start a timer. Rare operations pass always=True to time every call
+        if not self.enabled:
+            return 0
+        self.ticks += 1
+        if self.ticks % self.sample != 0 and not always: # Not sampled
+            return 0
+        return time.perf_counter_ns()
+
+    def shard(self):
+        # Create the counters and histograms of the calling thread
+        self.local.shard = (defaultdict(int), {})
+        with self.lock:
+            self.shards.append((current_thread(),) + self.local.shard)
+        return self.local.shard
+
+    def record(self, stage, start):
+        # Record the time since start (a value returned by clock()) for stage
+        if start == 0: # Disabled or not sampled
+            return None
+        elapsed = time.perf_counter_ns() - start
+        try:
+            histograms = self.local.shard[1]
+        except AttributeError: # First record from this thread
+            histograms = self.shard()[1]
+        histogram = histograms.get(stage)
+        if histogram is None:
+            histogram = histograms[stage] = Histogram()
+        histogram.add(elapsed)
+        return None
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return None
+        try:
+            counters = self.local.shard[0]
+        except AttributeError: # First record from this thread
+            counters = self.shard()[0]
+        counters[name] += n
+        return None
+
+    def gauge(self, name, func):
+        # Report func() under name in every snapshot
+        self.gauges[name] = func
+        return None
+
+    def snapshot(self):
+        ''' () -> dict
+
+            Returns the current counters, gauges and stage latencies
+        '''
+        with self.lock:
+            # Fold the shards of exited threads into the retired totals
+            for shard in [s for s in self.shards if not s[0].is_alive()]:
+                self.shards.remove(shard)
+                addShard(self.retired, shard[1:])
+
+            total = ({}, {})
+            addShard(total, self.retired)
+            for thread, counters, histograms in self.shards:
+                addShard(total, (counters, histograms))
+        counters = total[0]
+        stages = {stage: h.summary() for stage, h in total[1].items()}
+
+        gauges = {}
+        for name, func in self.gauges.items():
+            try:
+                gauges[name] = func()
+            except Exception:
+                gauges[name] = None
+        return {'enabled': self.enabled,
+                'sample': self.sample,
+                'time': time.time(),
+                'uptime': round(time.time() - self.started, 1),
+                'counters': counters,
+                'gauges': gauges,
+                'stages': stages
+                }
+
+    def serve(self, port=STATS_PORT):
+        # Start answering stats requests on a socket that only accepts local connections
+        self.socket = socket(AF_INET, SOCK_STREAM)
+        self.socket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.socket.bind(('127.0.0.1', port))
+        self.socket.listen(8)
+        self.startThread(statsSocketThread)
+        return self.socket.getsockname()[1]
+
+    def dump(self, path=STATS_PATH, interval=STATS_INTERVAL):
+        # Start writing snapshots to path every interval seconds
+        self.startThread(statsFileThread, path, interval)
+        return None
+
+    def startThread(self, target, *args):
+        thread = Thread(target=target, args=(self,) + args, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def close(self):
+        self.stopped.set()
+        if self.socket is not None:
+            try:
+                self.socket.shutdown(SHUT_RDWR) # Wake up the stats socket thread
+            except OSError:
+                pass
+            self.socket.close()
+        for thread in self.threads:
+            thread.join(1)
+        return None
+
+def addShard(total, shard):
+    # Add the counters and histograms of shard to total
+    counters, histograms = total
+    for name, n in dict(shard[0]).items(): # Copy, the owning thread may be recording
+        counters[name] = counters.get(name, 0) + n
+    for stage, histogram in dict(shard[1]).items():
+        if stage not in histograms:
+            histograms[stage] = Histogram()
+        histograms[stage].merge(histogram)
+    return None
+
+# Stats object used when statistics are disabled
+NO_STATS = Stats(enabled=False)
+# ================================================================================================================
+
+# ================================================ Thread Targets ================================================
+def statsSocketThread(stats):
+    ''' Thread target that answers each connection to the stats socket with a JSON
+        snapshot and closes it
+    '''
+    while not stats.stopped.is_set():
+        try:
+            connection, addr = stats.socket.accept()
+        except OSError: # Socket was closed
+            break
+        try:
+            connection.settimeout(1)
+            try:
+                connection.recv(4096) # Read (and ignore) an HTTP request if one was sent
+            except timeout:
+                pass
+            body = json.dumps(stats.snapshot(), indent=4).encode()
+            header = 'HTTP/1.0 200 OK\r\nContent-Type: application/json\r\nContent-Length: {}\r\n\r\n'.format(len(body))
+            connection.sendall(header.encode() + body)
+        except OSError:
+            pass
+        finally:
+            connection.close()
+    return None
+
+def statsFileThread(stats, path, interval):
+    # Thread target that writes a snapshot to path every interval seconds
+    while not stats.stopped.wait(interval):
+        writeSnapshot(stats, path)
+    writeSnapshot(stats, path) # Final snapshot on shutdown
+    return None
+
+def writeSnapshot(stats, path):
+    # Write to a temporary file first so readers never see a partial file
+    try:
+        with open(path + '.tmp', 'w') as f:
+            json.dump(stats.snapshot(), f, indent=4)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        print('Stats Error: {}'.format(e))
+    return None
+# ================================================================================================================
@@ -7,7 +7,15 @@
     (server side) database file. 
 '''
 
+import queue
 import sqlite3
+from contextlib import contextmanager
+
+DATABASE_PATH = 'data/UserDB.db'
+
+# Schema of the users table (formatted with the table's name)
+USERS_TABLE = '''CREATE TABLE {}
+                    (uID INTEGER PRIMARY KEY, uIP TEXT, pubkey BLOB, uName TEXT, password BLOB)'''
 
 # ================================================================================================================
 
@@ -15,13 +23,17 @@ import sqlite3
 class UserDataBase:
     # This class is an interface for the server to use to add users and retrieve
     # their information
-    def __init__(self):
-        con, cur = connect_database()
+    def __init__(self, path=DATABASE_PATH):
+        con, cur = connect_database(path)
         self.connection = con
         self.cursor = cur
 
     def addUser(self, username, userIP, pubkeyBytes, passwordBytes):
-        return add_user(self.cursor, username, userIP, pubkeyBytes, passwordBytes)
+        success = add_user(self.cursor, username, userIP, pubkeyBytes, passwordBytes)
+        # Save new user so other connections can see it. A refused user also ends the
+        # transaction, which would otherwise keep the database locked for other writers
+        self.connection.commit()
+        return success
 
     def getUserPublicKey(self, username):
         return query_user(self.cursor, username, 0)
@@ -32,6 +44,21 @@ class UserDataBase:
     def getUserIP(self, username):
         return query_user(self.cursor, username, 2)
 
+    def getUserName(self, pubkeyBytes):
+        return query_user_by_key(self.cursor, pubkeyBytes)
+
+    def createGroup(self, groupID, members):
+        success = add_group(self.cursor, groupID, members)
+        # The group's ID and members are saved together, or not at all
+        if success:
+            self.connection.commit()
+        else:
+            self.connection.rollback()
+        return success
+
+    def getGroupMembers(self, groupID):
+        return query_group(self.cursor, groupID)
+
     def printUsers(self):
         print_users(self.cursor)
         return None
@@ -40,13 +67,49 @@ class UserDataBase:
         self.connection.commit() # Save changes made to database
         self.connection.close() # Close connection
         return None
+
+class UserDataBasePool:
+    ''' Pool of long-lived UserDataBase connections shared by the server's threads. Each
+        connection is used by one thread at a time:
+
+            with pool.connection() as db:
+                db.getUserPublicKey(username)
+
+        The connections stay open for the lifetime of the server, so a request only pays
+        for its query instead of opening the database and checking the schema again.
+    '''
+    def __init__(self, size=4, path=DATABASE_PATH):
+        self.databases = []
+        self.available = queue.Queue()
+        for i in range(size):
+            db = UserDataBase(path)
+            self.databases.append(db)
+            self.available.put(db)
+
+    @contextmanager
+    def connection(self):
+        # Borrow a connection, blocking until one is free
+        db = self.available.get()
+        try:
+            yield db
+        finally:
+            self.available.put(db)
+
+    def close(self):
+        for db in self.databases:
+            db.disconnect()
+        return None
 # ================================================================================================================
 
 # =============================================== Helper Functions ===============================================
-def connect_database():
-    # Create and return database connection and cursor objects
-    con = sqlite3.connect('data/UserDB.db')
+def connect_database(path=DATABASE_PATH):
+    # Create and return database connection and cursor objects. The connection may be
+    # handed between threads by UserDataBasePool, but is only used by one at a time
+    con = sqlite3.connect(path, check_same_thread=False)
     cur = con.cursor()
+    # Write-ahead logging lets readers run while another connection is writing
+    cur.execute('PRAGMA journal_mode=WAL')
+    cur.execute('PRAGMA synchronous=NORMAL')
     init_users_table(cur)
     return con, cur
     
@@ -56,47 +119,76 @@ def init_users_table(cur):
                    AND name='users'
                 ''')
 
-    # If table 'users' does not exist, create it 
+    # If table 'users' does not exist, create it. SQLite assigns each user the next uID
     if cur.fetchone()[0] == 0:
         print(f"Creating table: users")
-        command = '''CREATE TABLE users
-                        (uID INTEGER, uIP TEXT, pubkey BLOB, uName TEXT, password BLOB)'''
-        cur.execute(command)
+        cur.execute(USERS_TABLE.format('users'))
     else:
         print(f"Table: users exists")
+        migrate_users_table(cur)
+
+    # Indices used to look users up by username and public key. Usernames are unique,
+    # so two connections adding the same username can not both succeed
+    cur.execute('DROP INDEX IF EXISTS users_uName')
+    cur.execute('CREATE UNIQUE INDEX IF NOT EXISTS users_uName_unique ON users (uName)')
+    cur.execute('CREATE INDEX IF NOT EXISTS users_pubkey ON users (pubkey)')
+
+    # Group chat members. groupKey is the group's secret key encrypted with the
+    # member's public key
+    cur.execute('''CREATE TABLE IF NOT EXISTS groups
+                        (groupID TEXT, uName TEXT, groupKey BLOB)''')
+    cur.execute('CREATE INDEX IF NOT EXISTS groups_groupID ON groups (groupID)')
+
+    # One row per group. Group IDs are unique, so two connections creating the same
+    # group can not both add members to it
+    cur.execute('''SELECT count(name) FROM sqlite_master WHERE type='table'
+                   AND name='group_ids'
+                ''')
+    if cur.fetchone()[0] == 0:
+        cur.execute('CREATE TABLE group_ids (groupID TEXT PRIMARY KEY)')
+        cur.execute('INSERT INTO group_ids (groupID) SELECT DISTINCT groupID FROM groups')
+        cur.connection.commit()
+
+def migrate_users_table(cur):
+    # Rebuild a users table from before uID was its primary key. If a username was
+    # added twice only its first account is kept
+    cur.execute('PRAGMA table_info(users)')
+    if any(column[1] == 'uID' and column[5] == 1 for column in cur.fetchall()):
+        return None
+    print(f"Migrating table: users")
+    cur.execute('DROP INDEX IF EXISTS users_uID')
+    cur.execute(USERS_TABLE.format('users_new'))
+    cur.execute(''' INSERT OR IGNORE INTO users_new (uID, uIP, pubkey, uName, password)
+                    SELECT uID, uIP, pubkey, uName, password
+                    FROM users
+                    WHERE uName NOT IN (SELECT uName FROM users AS u WHERE u.uID < users.uID)
+                    ORDER BY uID
+                ''')
+    cur.execute('DROP TABLE users')
+    cur.execute('ALTER TABLE users_new RENAME TO users')
+    cur.connection.commit()
+    return None
 
 def user_exists(cur, username):
     # Check if a username exists in the users table
-    cur.execute(''' SELECT uName
+    cur.execute(''' SELECT 1
                     FROM users
-                '''
+                    WHERE uName=?
+                ''', (username,)
                 )
-    val = cur.fetchall()
-    if (username,) in val: # Username already exists
+    if cur.fetchone() is not None: # Username already exists
         return True
     else:
         return False
 
 def add_user(cur, username, userIP, pubkeyBytes, passwordBytes):
-    # Add a user
-    if user_exists(cur, username): # Username already exists
+    # Add a user. Returns False if the username already exists
+    try:
+        cur.execute(''' INSERT INTO users (uIP, pubkey, uName, password)
+                        VALUES (?, ?, ?, ?)
+                    ''', (userIP, pubkeyBytes, username, passwordBytes))
+    except sqlite3.IntegrityError: # Username already exists
         return False
-
-    cur.execute(''' SELECT uID
-                    FROM users
-                    ORDER BY uID DESC
-                '''
-                )
-    val = cur.fetchone()
-    
-    if val == None:
-        newv = 0
-    else:
-        newv = val[0] + 1
-    # Create new chat with appropriate values
-    cur.execute(''' INSERT INTO users (uID, uIP, pubkey, uName, password)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (newv, userIP, pubkeyBytes, username, passwordBytes))
     return True
 
 def print_users(cur):
@@ -113,15 +205,14 @@ def print_users(cur):
 
 def query_user(cur, username, queryvalue):
     # Query a specific column for a user
-    if not user_exists(cur, username): # Username does not exist
-        return None
-
     cur.execute(''' SELECT *
                     FROM users
                     WHERE uName=?
                 ''', (username,)
                 )
     val = cur.fetchone()
+    if val is None: # Username does not exist
+        return None
 
     if queryvalue == 0: # Query user public key
         return val[2]
@@ -132,6 +223,45 @@ def query_user(cur, username, queryvalue):
     elif queryvalue == 3: # Query all values
         return val
     return None
+
+def add_group(cur, groupID, members):
+    # Add a group chat. members is a list of (username, encrypted group key) tuples.
+    # Returns False if the group already exists. The caller commits, or rolls back
+    try:
+        cur.execute(''' INSERT INTO group_ids (groupID)
+                        VALUES (?)
+                    ''', (groupID,))
+    except sqlite3.IntegrityError: # Group already exists
+        return False
+
+    cur.executemany(''' INSERT INTO groups (groupID, uName, groupKey)
+                        VALUES (?, ?, ?)
+                    ''', [(groupID, uName, groupKey) for uName, groupKey in members])
+    return True
+
+def query_group(cur, groupID):
+    # Returns the list of (username, encrypted group key) for a group, or None
+    cur.execute(''' SELECT uName, groupKey
+                    FROM groups
+                    WHERE groupID=?
+                ''', (groupID,)
+                )
+    val = cur.fetchall()
+    if len(val) == 0: # Group does not exist
+        return None
+    return val
+
+def query_user_by_key(cur, pubkeyBytes):
+    # Find the username registered with a public key
+    cur.execute(''' SELECT uName
+                    FROM users
+                    WHERE pubkey=?
+                ''', (pubkeyBytes,)
+                )
+    val = cur.fetchone()
+    if val is None: # No account uses this public key
+        return None
+    return val[0]
 # ================================================================================================================
 
 # ===================================================== Main =====================================================
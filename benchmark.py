@@ -0,0 +1,1338 @@
+'''
+    Secure Messenger Application Benchmarks
+
+    Authors: Hans Prieto, Joshua Fawcett
+
+    This module contains micro and macro benchmarks for the server and client. Each
+    benchmark is a subcommand and prints a readable table, or JSON with --json so that
+    results can be compared between commits. Example:
+
+            python benchmark.py routing --json
+'''
+
+import io
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+import selectors
+import threading
+import contextlib
+import subprocess
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+# ================================================================================================================
+
+# =============================================== Helper Functions ===============================================
+def timePerOp(func, n):
+    ''' (function, int) -> float
+
+        Calls func(n) and returns the average time per operation in nanoseconds
+    '''
+    start = time.perf_counter()
+    func(n)
+    return (time.perf_counter() - start) / n * 1e9
+
+def timeFor(func, minTime):
+    ''' (function, float) -> (int, float)
+
+        Calls func() repeatedly for at least minTime seconds (and at least 3 times).
+        Returns the number of calls and the time they took
+    '''
+    calls = 0
+    batch = 1
+    start = time.perf_counter()
+    elapsed = 0
+    while elapsed < minTime or calls < 3:
+        for i in range(batch):
+            func()
+        calls += batch
+        elapsed = time.perf_counter() - start
+        batch = min(batch * 2, 1000)
+    return calls, elapsed
+
+def allocationPeak(func, calls=3):
+    ''' (function, int) -> int
+
+        Largest amount of memory (bytes) allocated by Python during one call of func,
+        above what was allocated before the call. Memory allocated inside C libraries
+        (e.g. OpenSSL) is not seen
+    '''
+    func() # Warm up caches so they are not counted
+    tracemalloc.start()
+    try:
+        peak = 0
+        for i in range(calls):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            func()
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - before)
+    finally:
+        tracemalloc.stop()
+    return peak
+
+def percentile(values, p):
+    # p-th percentile of a list of numbers (0 if the list is empty)
+    if len(values) == 0:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def freePort():
+    # Returns a local TCP port that is not in use
+    from socket import socket
+    with socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def readRSS(pid):
+    ''' (int) -> (float, float)
+
+        Returns the current and peak resident set size of a process in MiB, read from
+        /proc (Linux only). Returns (None, None) if it is not available
+    '''
+    values = {}
+    try:
+        with open('/proc/{}/status'.format(pid)) as f:
+            for line in f:
+                if line.startswith('VmRSS:') or line.startswith('VmHWM:'):
+                    values[line[:5]] = int(line.split()[1]) / 1024
+    except OSError:
+        return None, None
+    return values.get('VmRSS'), values.get('VmHWM')
+
+def printResults(name, results, asJSON):
+    # Print a list of result dictionaries as a table or as JSON
+    if asJSON:
+        print(json.dumps({'benchmark': name, 'results': results}, indent=4))
+        return None
+
+    print(name)
+    columns = list(results[0])
+    rows = [['{:.1f}'.format(row[c]) if type(row[c]) == float else str(row[c]) for c in columns] for row in results]
+    widths = [max([12, len(c)] + [len(row[i]) for row in rows]) for i, c in enumerate(columns)]
+    print('  '.join('{:>{}}'.format(c, w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print('  '.join('{:>{}}'.format(v, w) for v, w in zip(row, widths)))
+    return None
+# ================================================================================================================
+
+# ================================================== Benchmarks ==================================================
+def bench_routing(args):
+    ''' Per-message cost of finding the destination connection for a forwarded
+        message with the server's RoutingTable, compared with a linear scan over
+        every connection
+    '''
+    from server import RoutingTable, Client_Connection
+
+    results = []
+    for n in args.sizes:
+        table = RoutingTable()
+        clients = []
+        for i in range(n):
+            IP = '10.{}.{}.{}'.format(i // 65536, (i // 256) % 256, i % 256)
+            client = Client_Connection(None, ('127.0.0.1', i), IP, None)
+            table.add(client)
+            clients.append(client)
+
+        targets = [random.choice(clients).IP for i in range(1000)]
+
+        def lookup(count):
+            for i in range(count):
+                for conn in table.lookupIP(targets[i % 1000]):
+                    pass
+
+        def scan(count):
+            for i in range(count):
+                receiverIP = targets[i % 1000]
+                for conn in clients:
+                    if conn.IP == receiverIP:
+                        pass
+
+        results.append({'connections': n,
+                        'table_ns_per_msg': timePerOp(lookup, args.messages),
+                        'scan_ns_per_msg': timePerOp(scan, max(10, args.messages * 10 // n))
+                        })
+    return results
+
+def bench_userdb(args):
+    ''' Public key lookups per second against a user database of a given size, opening
+        a UserDataBase for every request compared with the server's connection pool and
+        with the pool behind the server's public key cache
+    '''
+    from UserDatabase import UserDataBase, UserDataBasePool
+    from server import PublicKeyCache
+
+    results = []
+    for n in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'UserDB.db')
+            with contextlib.redirect_stdout(io.StringIO()): # UserDataBase prints on connect
+                db = UserDataBase(path)
+                for i in range(n):
+                    db.addUser('user{}'.format(i), '10.0.0.1', os.urandom(294), os.urandom(32))
+                db.disconnect()
+
+                names = ['user{}'.format(random.randrange(n)) for i in range(1000)]
+
+                def perRequest(count):
+                    for i in range(count):
+                        db = UserDataBase(path)
+                        db.getUserPublicKey(names[i % 1000])
+                        db.disconnect()
+
+                pool = UserDataBasePool(1, path)
+                def pooled(count):
+                    for i in range(count):
+                        with pool.connection() as db:
+                            db.getUserPublicKey(names[i % 1000])
+
+                cache = PublicKeyCache()
+                def cached(count):
+                    for i in range(count):
+                        pubkeyBytes = cache.get(names[i % 1000])
+                        if pubkeyBytes is None:
+                            with pool.connection() as db:
+                                cache.put(names[i % 1000], db.getUserPublicKey(names[i % 1000]))
+
+                perRequestTime = timePerOp(perRequest, args.lookups // 10)
+                pooledTime = timePerOp(pooled, args.lookups)
+                cachedTime = timePerOp(cached, args.lookups * 10)
+                pool.close()
+
+        results.append({'users': n,
+                        'per_request_lookups_per_sec': 1e9 / perRequestTime,
+                        'pooled_lookups_per_sec': 1e9 / pooledTime,
+                        'cached_lookups_per_sec': 1e9 / cachedTime,
+                        'cache_hit_rate': cache.hits / (cache.hits + cache.misses)
+                        })
+    return results
+
+def bench_cipher(args):
+    ''' Time to encrypt and decrypt one message with AES and Fernet, creating the
+        cipher objects for every message (as cipher.py did before it kept them per key)
+        compared with reusing the objects kept for the key
+    '''
+    from cipher import AES_PADDING, AES_generate_key, AES_encrypt, AES_decrypt
+    from cipher import Cipher, algorithms, modes
+    from cipher import Fernet, Fernet_generate_key, Fernet_encrypt, Fernet_decrypt_token
+
+    aesKey = AES_generate_key()
+    fernetKey = Fernet_generate_key()
+    results = []
+    for size in args.sizes:
+        message = os.urandom(size)
+        ciphertext, iv = AES_encrypt(message, aesKey)
+        token = Fernet_encrypt(message, fernetKey)
+        count = max(10, args.messages * 1024 // max(size, 1024))
+
+        padded = message + AES_PADDING[15 - size % 16]
+        def aesEncryptNew(n):
+            for i in range(n):
+                enc = Cipher(algorithms.AES(aesKey), modes.CBC(os.urandom(16))).encryptor()
+                enc.update(padded) + enc.finalize()
+
+        def aesEncrypt(n):
+            for i in range(n):
+                AES_encrypt(message, aesKey)
+
+        def aesDecryptNew(n):
+            for i in range(n):
+                dec = Cipher(algorithms.AES(aesKey), modes.CBC(iv)).decryptor()
+                plaintext = dec.update(ciphertext) + dec.finalize()
+                plaintext[:-(int(plaintext[-1:].decode(), 16) + 1)]
+
+        def aesDecrypt(n):
+            for i in range(n):
+                AES_decrypt(ciphertext, iv, aesKey)
+
+        def fernetEncryptNew(n):
+            for i in range(n):
+                Fernet(fernetKey).encrypt(message)
+
+        def fernetEncrypt(n):
+            for i in range(n):
+                Fernet_encrypt(message, fernetKey)
+
+        def fernetDecryptNew(n):
+            for i in range(n):
+                Fernet(fernetKey).decrypt(token)
+
+        def fernetDecrypt(n):
+            for i in range(n):
+                Fernet_decrypt_token(token, fernetKey)
+
+        result = {'message_size': size}
+        for name, func in [('aes_encrypt_new_us', aesEncryptNew), ('aes_encrypt_us', aesEncrypt),
+                           ('aes_decrypt_new_us', aesDecryptNew), ('aes_decrypt_us', aesDecrypt),
+                           ('fernet_encrypt_new_us', fernetEncryptNew), ('fernet_encrypt_us', fernetEncrypt),
+                           ('fernet_decrypt_new_us', fernetDecryptNew), ('fernet_decrypt_us', fernetDecrypt)]:
+            result[name] = timePerOp(func, count) / 1000
+        results.append(result)
+    return results
+
+def bench_crypto(args):
+    ''' Operations per second, MB/s and the Python memory allocated per operation for
+        every cipher in cipher.py (both directions) over a sweep of message sizes, and
+        for RSA signatures, RSA-OAEP key wrapping and hashPassword. Keys are created in
+        memory, so nothing is read from or written to disk. RSA message encryption only
+        fits messages of up to 190 bytes and is skipped for larger sizes; the hybrid
+        envelope (an RSA encrypted key and an AES-GCM encrypted message) is measured for
+        every size
+    '''
+    from cipher import (rot13_encrypt, rot13_decrypt, vig_encrypt, vig_decrypt, AES_generate_key,
+                        AES_encrypt, AES_decrypt, Fernet_generate_key, Fernet_encrypt,
+                        Fernet_decrypt_token, RSA_gen_key_pair, RSA_public_key_encrypt,
+                        RSA_private_key_decrypt, RSA_max_message_size, RSA_hybrid_encrypt,
+                        RSA_hybrid_decrypt, RSA_sign, RSA_verify, hashPassword)
+
+    random.seed(1)
+    pubKey, privKey = RSA_gen_key_pair()
+    aesKey = AES_generate_key()
+    fernetKey = Fernet_generate_key()
+
+    def operations(size):
+        # (group, operation, bytes processed, function) for one message size
+        text = classicMessage(size, 0)
+        data = text.encode()
+        rot13 = rot13_encrypt(text)
+        vig = vig_encrypt(text)
+        aes = AES_encrypt(data, aesKey)
+        fernet = Fernet_encrypt(data, fernetKey)
+        signature = RSA_sign(data, privKey)
+        hybrid = RSA_hybrid_encrypt(data, pubKey)
+        ops = [('plaintext', 'plaintext_encode', lambda: text.encode()),
+               ('plaintext', 'plaintext_decode', lambda: data.decode()),
+               ('rot13', 'rot13_encrypt', lambda: rot13_encrypt(text)),
+               ('rot13', 'rot13_decrypt', lambda: rot13_decrypt(rot13)),
+               ('vigenere', 'vig_encrypt', lambda: vig_encrypt(text)),
+               ('vigenere', 'vig_decrypt', lambda: vig_decrypt(vig)),
+               ('aes', 'AES_encrypt', lambda: AES_encrypt(data, aesKey)),
+               ('aes', 'AES_decrypt', lambda: AES_decrypt(aes[0], aes[1], aesKey)),
+               ('fernet', 'Fernet_encrypt', lambda: Fernet_encrypt(data, fernetKey)),
+               ('fernet', 'Fernet_decrypt', lambda: Fernet_decrypt_token(fernet, fernetKey)),
+               ('sign', 'RSA_sign', lambda: RSA_sign(data, privKey)),
+               ('sign', 'RSA_verify', lambda: RSA_verify(signature, data, pubKey)),
+               ('rsa', 'RSA_hybrid_encrypt', lambda: RSA_hybrid_encrypt(data, pubKey)),
+               ('rsa', 'RSA_hybrid_decrypt', lambda: RSA_hybrid_decrypt(*hybrid, privKey))]
+        if size <= RSA_max_message_size(pubKey):
+            rsa = RSA_public_key_encrypt(data, pubKey)
+            ops += [('rsa', 'RSA_encrypt', lambda: RSA_public_key_encrypt(data, pubKey)),
+                    ('rsa', 'RSA_decrypt', lambda: RSA_private_key_decrypt(rsa, privKey))]
+        return [(group, name, size, func) for group, name, func in ops]
+
+    # Operations whose cost does not depend on the message size: wrapping a 32 byte
+    # chat key for the recipient (as types 2, 3 and 5 do) and hashing a password
+    wrapped = RSA_public_key_encrypt(aesKey, pubKey)
+    fixed = [('oaep', 'OAEP_wrap_key', len(aesKey), lambda: RSA_public_key_encrypt(aesKey, pubKey)),
+             ('oaep', 'OAEP_unwrap_key', len(aesKey), lambda: RSA_private_key_decrypt(wrapped, privKey)),
+             ('hash', 'hashPassword', len('password123'), lambda: hashPassword('password123'))]
+
+    results = []
+    for group, name, size, func in [op for size in args.sizes for op in operations(size)] + fixed:
+        if args.only and group not in args.only:
+            continue
+        calls, elapsed = timeFor(func, args.min_time)
+        results.append({'operation': name,
+                        'message_size': size,
+                        'ops_per_sec': calls / elapsed,
+                        'mb_per_sec': calls * size / elapsed / 1e6,
+                        'alloc_kb_per_op': allocationPeak(func) / 1024})
+    return results
+
+def bench_keys(args):
+    ''' Time to decrypt a received message (stripEnc) and to encrypt a message for a
+        recipient (encryptMessage) for each encryption type, loading the private key
+        from its file and parsing the recipient's public key for every message (as the
+        client did before it kept them in a key ring) compared with the key ring
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory) # The client keeps its keys under data/
+        os.mkdir('data')
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                return keysResults(args)
+        finally:
+            os.chdir(cwd)
+
+def keysResults(args):
+    import Client
+    from cipher import (RSA_load_private_key, RSA_get_key_from_bytes, RSA_get_bytes_from_key,
+                        RSA_private_key_decrypt, AES_generate_key, AES_decrypt, Fernet_generate_key,
+                        Fernet_decrypt)
+
+    publicKey, privateKey = Client.KEY_RING.keys()
+    pubkeyBytes = RSA_get_bytes_from_key(publicKey)
+    keys = {0: None, 1: None, 2: b'defaultvigenerekeyfornow', 3: AES_generate_key(),
+            4: pubkeyBytes, 5: Fernet_generate_key()}
+    message = 'x' * args.size
+
+    def stripEncOld(encryptionType, IV, encKey, encMessage):
+        # stripEnc as it was, loading the private key for every message
+        privKey = RSA_load_private_key()
+        if encryptionType == '3':
+            return AES_decrypt(encMessage, IV, RSA_private_key_decrypt(encKey, privKey)).decode()
+        elif encryptionType == '4':
+            return RSA_private_key_decrypt(encMessage, privKey).decode()
+        elif encryptionType == '5':
+            return Fernet_decrypt(encMessage, RSA_private_key_decrypt(encKey, privKey))
+        return Client.stripEnc(encryptionType, IV, encKey, encMessage)
+
+    def encryptOld(encryptionType, encryptionKey):
+        # Parse the recipient's public key (and the RSA message key) for every message
+        RSA_get_key_from_bytes(pubkeyBytes)
+        if encryptionType == 4:
+            RSA_get_key_from_bytes(encryptionKey)
+        return Client.encryptMessage(message, encryptionType, encryptionKey, pubkeyBytes)
+
+    results = []
+    for encryptionType, key in keys.items():
+        encMessage, iv, encKey = Client.encryptMessage(message, encryptionType, key, pubkeyBytes)
+        received = (str(encryptionType), iv, encKey, encMessage)
+
+        def receiveOld(n):
+            for i in range(n):
+                stripEncOld(*received)
+
+        def receive(n):
+            for i in range(n):
+                Client.stripEnc(*received)
+
+        def sendOld(n):
+            for i in range(n):
+                encryptOld(encryptionType, key)
+
+        def send(n):
+            for i in range(n):
+                Client.encryptMessage(message, encryptionType, key, pubkeyBytes)
+
+        results.append({'encryption_type': encryptionType,
+                        'receive_old_us': timePerOp(receiveOld, args.messages) / 1000,
+                        'receive_us': timePerOp(receive, args.messages) / 1000,
+                        'send_old_us': timePerOp(sendOld, args.messages) / 1000,
+                        'send_us': timePerOp(send, args.messages) / 1000})
+    return results
+
+def bench_ratchet(args):
+    ''' Messages per second a client can encrypt (encryptMessage) and decrypt
+        (stripEnc) in a conversation, for the types that encrypt a key with RSA for
+        every message (vigenere, AES, Fernet) and for the ratchet type, which uses RSA
+        once per chain. The messages belong to a chat in the message database, so saving
+        the receiving ratchet is included
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory) # The client keeps its keys and chats under data/
+        os.mkdir('data')
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                return ratchetResults(args)
+        finally:
+            os.chdir(cwd)
+
+def ratchetResults(args):
+    import Client
+    from Database import DataBase
+    from cipher import RSA_get_bytes_from_key, AES_generate_key, Fernet_generate_key
+
+    pubkeyBytes = RSA_get_bytes_from_key(Client.KEY_RING.keys()[0])
+    keys = {2: b'defaultvigenerekeyfornow', 3: AES_generate_key(), 5: Fernet_generate_key(), 6: None}
+    db = DataBase()
+    db.create_chat('bench', '10.0.0.1', 'bench', (pubkeyBytes, keys[5], keys[3], keys[2]))
+    message = 'x' * args.size
+
+    results = []
+    for encryptionType, key in keys.items():
+        start = time.perf_counter()
+        sent = [Client.encryptMessage(message, encryptionType, key, pubkeyBytes) for i in range(args.messages)]
+        sendTime = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for encMessage, iv, encKey in sent:
+            received = Client.stripEnc(str(encryptionType), iv, encKey, encMessage, '10.0.0.1')
+        receiveTime = time.perf_counter() - start
+        assert received == message
+
+        results.append({'encryption_type': encryptionType,
+                        'messages': args.messages,
+                        'send_msgs_per_sec': args.messages / sendTime,
+                        'receive_msgs_per_sec': args.messages / receiveTime,
+                        'exchanges': sum(1 for m in sent if encryptionType == 6 and m[2] != b'0')})
+    db.disconnect()
+    Client.RATCHETS.save_all()
+    return results
+
+def bench_classic(args):
+    ''' Time to encrypt and decrypt a large message with rot13 and vigenere, going
+        through the message one character at a time (as cipher.py did before it used
+        translation tables) compared with the table based functions. Each message is
+        made of words separated by spaces and punctuation, with --non-ascii of the words
+        followed by a non-ASCII symbol
+    '''
+    from cipher import rot13_encrypt, rot13_decrypt, vig_encrypt, vig_decrypt, enc_key
+
+    random.seed(1)
+    results = []
+    for size in args.sizes:
+        message = classicMessage(size, args.non_ascii)
+        result = {'message_size': size}
+        for name, oldFunc, func in [('rot13_encrypt', rot13CharByChar, rot13_encrypt),
+                                    ('rot13_decrypt', rot13CharByChar, rot13_decrypt),
+                                    ('vig_encrypt', lambda s: vigCharByChar(s, enc_key, 1), vig_encrypt),
+                                    ('vig_decrypt', lambda s: vigCharByChar(s, enc_key, -1), vig_decrypt)]:
+            start = time.perf_counter()
+            expected = oldFunc(message)
+            result[name + '_old_ms'] = (time.perf_counter() - start) * 1000
+            start = time.perf_counter()
+            output = func(message)
+            result[name + '_ms'] = (time.perf_counter() - start) * 1000
+            if output != expected:
+                raise AssertionError('{} output differs from the character by character version'.format(name))
+        results.append(result)
+    return results
+
+def classicMessage(size, nonASCII):
+    # Random words of 1 to 10 letters (a fraction nonASCII of them followed by a non-ASCII symbol)
+    words = []
+    length = 0
+    while length < size:
+        word = ''.join(random.choice('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ') for i in range(random.randint(1, 10)))
+        if random.random() < nonASCII:
+            word += random.choice('€£«»')
+        word += random.choice('     ,.!?0')
+        words.append(word)
+        length += len(word)
+    return ''.join(words)[:size]
+
+def rot13CharByChar(text):
+    # rot13 one character at a time, as cipher.py did before it used a translation table
+    plain = 'abcdefghijklmnopqrstuvwxyz'
+    rotated = plain[13:] + plain[:13]
+    result = ''
+    for cur in text:
+        if cur.isalpha() and cur.isupper():
+            result += plain[rotated.index(cur.lower())].upper()
+        elif cur.isalpha() and cur.islower():
+            result += plain[rotated.index(cur)]
+        else:
+            result += cur
+    return result
+
+def vigCharByChar(text, key, direction):
+    # Vigenere one character at a time, as cipher.py did before it used translation
+    # tables. direction is 1 to encrypt and -1 to decrypt
+    plain = 'abcdefghijklmnopqrstuvwxyz'
+    expanded = key
+    while len(expanded) < len(text):
+        expanded = expanded + key
+    result = ''
+    keyPos = 0
+    for cur in text:
+        if cur.isalpha() and (cur.isupper() or cur.islower()):
+            upper = cur.isupper()
+            newPos = plain.find(cur.lower() if upper else cur) + direction * plain.find(expanded[keyPos])
+            keyPos += 1
+            if newPos >= 26:
+                newPos -= 26
+            result += plain[newPos].upper() if upper else plain[newPos]
+        else:
+            result += cur
+    return result
+
+def bench_transport(args):
+    ''' Bytes per second one core can encrypt into session frames and decrypt from them,
+        for each session transport (CBC and the AEADs). Sealing is encodeSessionFrame,
+        opening is decodeSessionFrame, as used by the server for every message
+    '''
+    from cipher import AES_generate_key
+    from protocol import (TRANSPORT_NAMES, FRAME_HEADER, createSession, encodeSessionFrame,
+                          decodeSessionFrame, unpackFields)
+
+    key = AES_generate_key()
+    results = []
+    for size in args.sizes:
+        fields = [b'200', '10.0.0.1', 'user', '0', b'0', b'0', os.urandom(size)]
+        count = max(10, args.messages * 1024 // max(size, 1024))
+        result = {'message_size': size}
+        for name, transport in TRANSPORT_NAMES.items():
+            sender = createSession(key, transport, initiator=True)
+            receiver = createSession(key, transport, initiator=False)
+
+            frames = [unpackFields(encodeSessionFrame(fields, sender)[FRAME_HEADER.size:]) for i in range(count)]
+            def seal(n):
+                for i in range(n):
+                    encodeSessionFrame(fields, sender)
+
+            def unseal(n):
+                for i in range(n):
+                    decodeSessionFrame(frames[i], receiver)
+
+            result[name + '_seal_mb_per_sec'] = size / timePerOp(seal, count) * 1e9 / 1e6
+            result[name + '_open_mb_per_sec'] = size / timePerOp(unseal, count) * 1e9 / 1e6
+        results.append(result)
+    return results
+
+def bench_handshake(args):
+    ''' CPU time used by the client and by the server for one handshake, and the bytes
+        each side sends, for the RSA and the X25519 handshake. The client functions
+        talk to the threaded server's handshake worker over a socket pair, and each
+        side's CPU time is measured with its thread's clock
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory) # The client and server keep their keys under data/
+        os.mkdir('data')
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                return handshakeResults(args)
+        finally:
+            os.chdir(cwd)
+
+def handshakeResults(args):
+    from socket import socketpair
+    import Client
+    import server
+    from protocol import FrameDecoder, AEAD_TRANSPORTS
+
+    keys = Client.KEY_RING.keys()
+    Client.KEY_RING.identity() # The identity key is signed once per process, not per handshake
+
+    results = []
+    for name, handshake in [('rsa', Client.rsa_handshake), ('x25519', Client.x25519_handshake)]:
+        clientCPU = []
+        serverCPU = []
+        sent = []
+        received = []
+        for i in range(args.handshakes):
+            clientSide, serverSide = socketpair()
+            accepted = []
+            def serverThread():
+                start = time.thread_time()
+                server.handshakeWorker(serverSide, ('client', i), lambda *client: accepted.append(client))
+                serverCPU.append(time.thread_time() - start)
+
+            thread = threading.Thread(target=serverThread)
+            thread.start()
+            counter = CountingSocket(clientSide)
+            start = time.thread_time()
+            sessionKey = handshake(counter, FrameDecoder(), '10.0.0.1', keys, AEAD_TRANSPORTS)
+            clientCPU.append(time.thread_time() - start)
+            thread.join()
+            if sessionKey is None or len(accepted) != 1:
+                raise RuntimeError('{} handshake failed'.format(name))
+            sent.append(counter.sent)
+            received.append(counter.received)
+            clientSide.close()
+            serverSide.close()
+
+        results.append({'handshake': name,
+                        'client_cpu_ms': sum(clientCPU) / len(clientCPU) * 1000,
+                        'server_cpu_ms': sum(serverCPU) / len(serverCPU) * 1000,
+                        'client_bytes_sent': sum(sent) // len(sent),
+                        'server_bytes_sent': sum(received) // len(received),
+                        'handshakes_per_core_sec': len(serverCPU) / sum(serverCPU)})
+    return results
+
+class CountingSocket:
+    # Socket wrapper counting the bytes sent and received through it
+    def __init__(self, sock):
+        self.sock = sock
+        self.sent = 0
+        self.received = 0
+
+    def sendall(self, data):
+        self.sent += len(data)
+        return self.sock.sendall(data)
+
+    def recv_into(self, buffer):
+        n = self.sock.recv_into(buffer)
+        self.received += n
+        return n
+
+def bench_fanout(args):
+    ''' Time for a group message to reach every member of a group through the server's
+        fan-out lanes, compared with the sender sending one direct message per member.
+        Members are connected to the server through socket pairs and a reader thread
+        counts the frames they receive
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.getcwd()
+        os.chdir(directory) # The server keeps its keys and databases under data/
+        os.mkdir('data')
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                return fanoutResults(args)
+        finally:
+            os.chdir(cwd)
+
+def fanoutResults(args):
+    from socket import socketpair
+    from cipher import AES_generate_key
+    from protocol import FRAME_SESSION, FRAME_HEADER, FrameDecoder, unpackFields, encodeSessionFrame
+    from server import Server, Client_Connection, createServerSocket, handlePacket
+
+    server = Server(createServerSocket(0))
+    results = []
+    for n in args.sizes:
+        # Connect the sender and n members to the server
+        readers = {}
+        sender = None
+        members = []
+        for i in range(n + 1):
+            serverSide, memberSide = socketpair()
+            memberSide.setblocking(False)
+            readers[memberSide] = FrameDecoder()
+            conn = Client_Connection(serverSide, ('member', i), '10.{}.{}.{}'.format(n % 256, i // 256, i % 256),
+                                     None, AES_generate_key())
+            conn.userName = 'member{}-{}'.format(n, i)
+            server.routes.add(conn)
+            if sender is None:
+                sender = conn
+            else:
+                members.append(conn)
+
+        groupID = 'group{}'.format(n)
+        with server.userDB.connection() as db:
+            db.createGroup(groupID, [(conn.userName, os.urandom(256)) for conn in [sender] + members])
+
+        received = [0]
+        target = [0]
+        done = threading.Event()
+        stop = threading.Event()
+        def reader():
+            # Count the frames received by the members (and the sender's ACKs)
+            selector = selectors.DefaultSelector()
+            for sock in readers:
+                selector.register(sock, selectors.EVENT_READ)
+            while not stop.is_set():
+                for key, mask in selector.select(0.1):
+                    decoder = readers[key.fileobj]
+                    decoder.recvFrom(key.fileobj)
+                    for frameType, fields in decoder.frames():
+                        if frameType == FRAME_SESSION:
+                            received[0] += 1
+                if received[0] >= target[0] > 0:
+                    done.set()
+            selector.close()
+        thread = threading.Thread(target=reader, daemon=True)
+        thread.start()
+
+        def measure(frames):
+            # Average seconds from the sender's frames arriving until every member has them,
+            # and the time the server spent handling the sender's frames
+            total = handling = 0
+            for i in range(args.messages):
+                received[0] = 0
+                target[0] = n
+                done.clear()
+                start = time.perf_counter()
+                for frame in frames:
+                    handlePacket(server, sender, frame)
+                handling += time.perf_counter() - start
+                done.wait(30)
+                total += time.perf_counter() - start
+            return total / args.messages, handling / args.messages
+
+        def sessionFrame(fields):
+            iv, ciphertext = unpackFields(encodeSessionFrame(fields, sender.sessionKey)[FRAME_HEADER.size:])
+            return FRAME_SESSION, [iv, ciphertext]
+
+        message = os.urandom(args.message_size)
+        groupFrames = [sessionFrame([b'300', groupID, sender.userName, '3', os.urandom(16), b'0', message])]
+        directFrames = [sessionFrame([b'200', conn.IP, sender.userName, '3', os.urandom(16), os.urandom(256), message])
+                        for conn in members]
+
+        groupTime, groupHandling = measure(groupFrames)
+        directTime, directHandling = measure(directFrames)
+
+        stop.set()
+        thread.join()
+        for conn in [sender] + members:
+            server.routes.remove(conn)
+            conn.close()
+        for sock in readers:
+            sock.close()
+
+        results.append({'members': n,
+                        'group_delivered_ms': groupTime * 1000,
+                        'group_handling_ms': groupHandling * 1000,
+                        'direct_delivered_ms': directTime * 1000,
+                        'direct_handling_ms': directHandling * 1000
+                        })
+    server.socket.close()
+    server.exit()
+    return results
+
+def bench_load(args):
+    ''' End-to-end load test of a local server.py process. Synthetic clients perform the
+        real client handshake, create accounts, and then send messages to each other
+        (client i to client i + 1) at a fixed rate, or as fast as the server allows
+        with --rate 0. Reports handshakes, accounts and messages per second, end-to-end
+        message latency, and the server's memory use
+    '''
+    with serverProcess(args, max(128, args.clients)) as (port, server):
+        result = runLoad(args, port)
+        result['server_rss_mb'], result['server_peak_rss_mb'] = readRSS(server.pid)
+    return [result]
+
+@contextlib.contextmanager
+def serverProcess(args, backlog=128):
+    ''' Runs server.py in a temporary directory for the duration of a benchmark and
+        yields its port and process. The benchmark runs in another temporary directory
+        so that the clients have their own keys
+    '''
+    with tempfile.TemporaryDirectory() as directory:
+        serverDirectory = os.path.join(directory, 'server')
+        os.makedirs(os.path.join(serverDirectory, 'data'))
+        os.makedirs(os.path.join(directory, 'data')) # Client keys
+
+        port = args.port if args.port > 0 else freePort()
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py'),
+                   '--port', str(port), '--backlog', str(backlog),
+                   '--stats-port', '0', '--stats-interval', '0']
+        if args.threaded:
+            command.append('--threaded')
+        server = subprocess.Popen(command, cwd=serverDirectory, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            waitForServer(port, server)
+            yield port, server
+        finally:
+            server.terminate()
+            server.wait()
+            os.chdir(cwd)
+
+def readCPU(pid):
+    # User plus system CPU seconds used by a process, read from /proc (Linux only)
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+def bench_reconnect(args):
+    ''' Time for a client to reconnect to a local server.py with the full RSA or X25519
+        handshake, compared with resuming its session with a ticket, and the server CPU time used
+        per reconnect. A reconnect is complete when the server's next ticket arrives,
+        which is sent once the connection is ready for messages
+    '''
+    with serverProcess(args) as (port, server), contextlib.redirect_stdout(io.StringIO()):
+        import Client
+        from cipher import RSA_get_keys
+        from protocol import recvFrame, sessionTransport, HANDSHAKE_RSA, HANDSHAKE_X25519
+
+        address = ('127.0.0.1', port)
+        keys = RSA_get_keys()
+
+        def readTicket(connection):
+            # Wait for the ticket frame and return (ticket, secret, transport)
+            sock, sessionKey, decoder = connection
+            while True:
+                frame = recvFrame(sock, decoder)
+                if frame is None:
+                    return None
+                fields = Client.unPack(frame, sessionKey)
+                if fields is not None and fields[0] == b'110':
+                    return fields[1], fields[2], sessionTransport(sessionKey)
+
+        def rsa():
+            return Client.connectToServer(address, '10.0.0.1', keys, handshake=HANDSHAKE_RSA)
+
+        def x25519():
+            return Client.connectToServer(address, '10.0.0.1', keys, handshake=HANDSHAKE_X25519)
+
+        ticket = [readTicket(x25519())] # Also makes the client's identity key, once per process
+        def resume():
+            tkt, secret, transport = ticket[0]
+            return Client.resumeSession(tkt, secret, address, transport)
+
+        results = []
+        for name, connect in [('rsa_handshake', rsa), ('x25519_handshake', x25519), ('ticket', resume)]:
+            latencies = []
+            cpu = readCPU(server.pid)
+            start = time.perf_counter()
+            for i in range(args.reconnects):
+                begin = time.perf_counter()
+                connection = connect()
+                ticket[0] = readTicket(connection)
+                latencies.append(time.perf_counter() - begin)
+                connection[0].close()
+            elapsed = time.perf_counter() - start
+            time.sleep(0.2) # Let the server finish handling the last disconnect
+            cpu = readCPU(server.pid) - cpu if cpu is not None else None
+
+            results.append({'mode': name,
+                            'reconnects_per_sec': args.reconnects / elapsed,
+                            'latency_p50_ms': percentile(latencies, 50) * 1000,
+                            'latency_p99_ms': percentile(latencies, 99) * 1000,
+                            'server_cpu_ms_per_reconnect': cpu / args.reconnects * 1000 if cpu is not None else None
+                            })
+    return results
+
+def bench_backlog(args):
+    ''' Time for a client to receive a backlog of messages that a local server.py stored
+        while it was offline, with messages decrypted on the receiving thread (0 decrypt
+        workers) and by decrypt pools of different sizes. Also reports how long a
+        request made while the backlog arrives (after a tenth of it is delivered)
+        waits for its reply
+    '''
+    with serverProcess(args) as (port, server), contextlib.redirect_stdout(io.StringIO()):
+        import Client
+        from cipher import RSA_get_keys, RSA_get_bytes_from_key, AES_generate_key, Fernet_generate_key
+
+        address = ('127.0.0.1', port)
+        keys = RSA_get_keys()
+        pubkeyBytes = RSA_get_bytes_from_key(keys[0])
+        key = {3: AES_generate_key(), 4: pubkeyBytes, 5: Fernet_generate_key()}.get(args.type)
+        message = 'x' * args.size
+
+        results = []
+        for workers in args.workers:
+            # Store the backlog: the sender waits for the ACK of its last message, which
+            # the server sends after storing every earlier one
+            sock, sessionKey, decoder = Client.connectToServer(address, '10.0.1.1', keys)
+            pending = Client.PendingRequests()
+            sender = Client.create_receiving_thread(sock, sessionKey, None, decoder, pending, 0)
+            for i in range(args.messages - 1):
+                Client.sendMessageTo(sock, message, '10.0.1.2', 'sender', args.type, key, pubkeyBytes, sessionKey)
+            requestID, stored = pending.add(b'200', 60)
+            Client.sendMessageTo(sock, message, '10.0.1.2', 'sender', args.type, key, pubkeyBytes, sessionKey, requestID)
+            stored.result(60)
+            sender.close()
+            Client.disconnectServer(sock, sessionKey)
+
+            received = []
+            started = threading.Event() # Part of the backlog has been delivered
+            done = threading.Event()
+            def callback(message):
+                received.append(message)
+                if len(received) == args.messages // 10:
+                    started.set()
+                if len(received) == args.messages:
+                    done.set()
+
+            start = time.perf_counter()
+            sock, sessionKey, decoder = Client.connectToServer(address, '10.0.1.2', keys)
+            pending = Client.PendingRequests()
+            receiver = Client.create_receiving_thread(sock, sessionKey, callback, decoder, pending, workers)
+            started.wait(300)
+            requestID, reply = pending.add(b'20', 60)
+            begin = time.perf_counter()
+            Client.getPublicKeyFromServer(sock, sessionKey, 'nobody', '10.0.1.3', requestID)
+            reply.result(60)
+            replyTime = time.perf_counter() - begin
+            done.wait(300)
+            elapsed = time.perf_counter() - start
+            read = len(received)
+
+            receiver.close()
+            Client.disconnectServer(sock, sessionKey)
+            results.append({'decrypt_workers': workers,
+                            'messages': read,
+                            'msgs_per_sec': read / elapsed,
+                            'request_reply_ms': replyTime * 1000})
+    return results
+
+def bench_send(args):
+    ''' Messages per second a scripted sender gets from a local server.py, with every
+        message sent on its own (window 0) and with the send queue batching the messages
+        sent while others wait for their ACK, and the client and server CPU time used per
+        message. Also reports how long a single message waits for its ACK when the queue
+        is idle, as when a user types one message at a time. The receiver is offline, so
+        the server stores the messages
+    '''
+    with serverProcess(args) as (port, server), contextlib.redirect_stdout(io.StringIO()):
+        import Client
+        from cipher import RSA_get_keys, RSA_get_bytes_from_key, AES_generate_key, Fernet_generate_key
+        from protocol import FEATURE_BATCH
+
+        address = ('127.0.0.1', port)
+        keys = RSA_get_keys()
+        pubkeyBytes = RSA_get_bytes_from_key(keys[0])
+        key = {3: AES_generate_key(), 4: pubkeyBytes, 5: Fernet_generate_key()}.get(args.type)
+        message = 'x' * args.size
+
+        results = []
+        for window in args.windows:
+            sock, sessionKey, decoder = Client.connectToServer(address, '10.0.2.1', keys)
+            pending = Client.PendingRequests()
+            receiver = Client.create_receiving_thread(sock, sessionKey, None, decoder, pending, 0)
+            outbound = Client.create_send_queue(sock, sessionKey, receiver, pending, window, args.batch_bytes)
+            deadline = time.monotonic() + 5
+            while FEATURE_BATCH not in receiver.status.features and time.monotonic() < deadline:
+                time.sleep(0.01) # Wait for the server's features frame
+
+            def send():
+                requestID, future = pending.add(b'200', 60)
+                packet = Client.message_packet(message, '10.0.2.2', 'sender', args.type, key, pubkeyBytes, requestID)
+                outbound.queue(packet, requestID, future)
+                return future
+
+            cpu = readCPU(server.pid)
+            clientCPU = time.process_time()
+            start = time.perf_counter()
+            futures = [send() for i in range(args.messages)]
+            acked = sum(1 for future in futures if future.result(60))
+            elapsed = time.perf_counter() - start
+            clientCPU = time.process_time() - clientCPU
+            cpu = readCPU(server.pid) - cpu if cpu is not None else None
+
+            latencies = []
+            for i in range(args.idle):
+                time.sleep(0.01) # Nothing in flight, as between a user's messages
+                begin = time.perf_counter()
+                send().result(60)
+                latencies.append(time.perf_counter() - begin)
+
+            outbound.close()
+            receiver.close()
+            Client.disconnectServer(sock, sessionKey)
+            results.append({'window_ms': window * 1000,
+                            'messages': acked,
+                            'msgs_per_sec': acked / elapsed,
+                            'client_cpu_us_per_msg': clientCPU / args.messages * 1e6,
+                            'server_cpu_us_per_msg': cpu / args.messages * 1e6 if cpu is not None else None,
+                            'idle_latency_p50_ms': percentile(latencies, 50) * 1000,
+                            'idle_latency_p99_ms': percentile(latencies, 99) * 1000})
+    return results
+
+def waitForServer(port, server, wait=30):
+    # Block until the server accepts connections
+    from socket import create_connection
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError('server exited with code {}'.format(server.returncode))
+        try:
+            create_connection(('127.0.0.1', port), 1).close()
+            return None
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('server did not start')
+
+def runLoad(args, port):
+    # Run the load test in one or more processes and combine the results
+    from cipher import RSA_get_keys
+    with contextlib.redirect_stdout(io.StringIO()):
+        RSA_get_keys() # Create the client keys once, before any worker loads them
+
+    processes = max(1, min(args.processes, args.clients))
+    ranges = [(args.clients * i // processes, args.clients * (i + 1) // processes) for i in range(processes)]
+    if processes == 1:
+        parts = [loadWorker(port, ranges[0], args, None)]
+    else:
+        context = multiprocessing.get_context('spawn')
+        barrier = context.Barrier(processes)
+        queue = context.Queue()
+        workers = [context.Process(target=loadProcess, args=(port, r, args, barrier, queue)) for r in ranges]
+        for worker in workers:
+            worker.start()
+        parts = [queue.get(timeout=args.duration + 300) for worker in workers]
+        for worker in workers:
+            worker.join()
+
+    def rate(phase, count):
+        elapsed = max(p['phases'][phase][1] for p in parts) - min(p['phases'][phase][0] for p in parts)
+        return count / elapsed if elapsed > 0 else 0.0
+
+    latencies = [l for p in parts for l in p['latencies']]
+    sent = sum(p['sent'] for p in parts)
+    received = len(latencies)
+    return {'clients': args.clients,
+            'processes': processes,
+            'message_size': args.size,
+            'transport': args.transport,
+            'handshake': args.handshake,
+            'handshakes_per_sec': rate('handshakes', sum(p['connected'] for p in parts)),
+            'accounts_per_sec': rate('accounts', sum(p['accounts'] for p in parts)),
+            'messages_per_sec': rate('messages', received),
+            'latency_p50_ms': percentile(latencies, 50) * 1000,
+            'latency_p99_ms': percentile(latencies, 99) * 1000,
+            'sent': sent,
+            'lost': sent - received,
+            'stalled': args.stalled,
+            'failed_handshakes': args.clients - sum(p['connected'] for p in parts)
+            }
+
+class LoadClient:
+    # State of one synthetic client in the load test
+    def __init__(self, index, connection):
+        self.index = index
+        self.IP = loadIP(index)
+        self.name = 'load{}'.format(index)
+        self.socket, self.sessionKey, self.decoder = connection
+        self.window = None # Limits messages waiting for an ACK
+        self.stalled = False # Stops reading from the server, like a client on a dead network
+
+def loadIP(index):
+    return '10.{}.{}.{}'.format(index // 65536, (index // 256) % 256, index % 256)
+
+def loadProcess(port, clientRange, args, barrier, queue):
+    # Process target running loadWorker and returning its result through queue
+    queue.put(loadWorker(port, clientRange, args, barrier))
+
+def loadWorker(port, clientRange, args, barrier):
+    ''' Runs the synthetic clients numbered clientRange[0] to clientRange[1] - 1.
+        Returns the start and end (perf_counter) of each phase, the number of messages
+        sent and the end-to-end latency of every message received. When several
+        processes are used the barrier keeps their phases in step
+    '''
+    import Client
+    from cipher import RSA_get_keys, RSA_get_bytes_from_key, rot13_decrypt
+    from protocol import FRAME_PLAIN, ProtocolError, TRANSPORT_NAMES, TRANSPORT_CBC, HANDSHAKE_RSA, HANDSHAKE_X25519
+
+    keys = RSA_get_keys()
+    pubkeyBytes = RSA_get_bytes_from_key(keys[0])
+    transport = TRANSPORT_NAMES[args.transport]
+    transports = () if transport == TRANSPORT_CBC else (transport,)
+    first, last = clientRange
+    result = {'latencies': [], 'sent': 0, 'phases': {}}
+    def sync():
+        if barrier is not None:
+            barrier.wait()
+
+    # Handshakes, several at a time like independent clients
+    sync()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()), ThreadPoolExecutor(min(32, last - first)) as pool:
+        handshake = HANDSHAKE_X25519 if args.handshake == 'x25519' else HANDSHAKE_RSA
+        connections = list(pool.map(lambda i: Client.connectToServer(('127.0.0.1', port), loadIP(i), keys, transports, handshake),
+                                    range(first, last)))
+    result['phases']['handshakes'] = (start, time.perf_counter())
+    clients = [LoadClient(i, c) for i, c in zip(range(first, last), connections) if c is not None]
+    result['connected'] = len(clients)
+
+    # One thread receives for every client
+    selector = selectors.DefaultSelector()
+    acks = threading.Semaphore(0)
+    stop = threading.Event()
+    lastReceived = [0]
+    for client in clients:
+        client.window = threading.Semaphore(args.window)
+        selector.register(client.socket, selectors.EVENT_READ, client)
+
+    def receive():
+        while not stop.is_set():
+            for key, mask in selector.select(0.1):
+                client = key.data
+                if client.stalled:
+                    selector.unregister(client.socket)
+                    continue
+                try:
+                    if client.decoder.recvFrom(client.socket) == 0:
+                        selector.unregister(client.socket)
+                        continue
+                    frames = list(client.decoder.frames())
+                except (OSError, ProtocolError):
+                    selector.unregister(client.socket)
+                    continue
+                now = time.perf_counter()
+                for frame in frames:
+                    fields = Client.unPack(frame, client.sessionKey)
+                    if fields is None:
+                        continue
+                    if frame[0] == FRAME_PLAIN: # ACK for an account or a message
+                        client.window.release()
+                        acks.release()
+                        continue
+                    if len(fields) != 6: # Not a message, e.g. a resumption ticket
+                        continue
+                    message = fields[5].decode()
+                    if fields[2] == b'1':
+                        message = rot13_decrypt(message)
+                    result['latencies'].append(now - float(message.split(' ')[1]))
+                    lastReceived[0] = now
+        return None
+    receiver = threading.Thread(target=receive, daemon=True)
+    receiver.start()
+
+    # Create an account for every client and wait for the server's replies
+    sync()
+    start = time.perf_counter()
+    for client in clients:
+        client.window.acquire()
+        Client.createUserAccount(client.socket, client.sessionKey, client.name, 'password')
+    accounts = 0
+    while accounts < len(clients) and acks.acquire(timeout=10):
+        accounts += 1
+    result['accounts'] = accounts
+    result['phases']['accounts'] = (start, time.perf_counter())
+
+    # Stalled clients keep receiving messages but never read them
+    for client in clients:
+        client.stalled = client.index < args.stalled
+
+    # Send messages for the duration of the test
+    sync()
+    start = time.perf_counter()
+    end = start + args.duration
+    senders = [(client, clients[(i + 1) % len(clients)]) for i, client in enumerate(clients) if not client.stalled]
+    interval = 1 / (args.rate * len(senders)) if args.rate > 0 and len(senders) > 0 else 0
+    sent = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        while len(senders) > 0 and time.perf_counter() < end:
+            client, destination = senders[sent % len(senders)]
+            if interval > 0:
+                delay = start + sent * interval - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            if not client.window.acquire(timeout=max(0, end - time.perf_counter())):
+                break
+            message = '{} {:.9f} '.format(sent, time.perf_counter())
+            message += 'x' * max(0, args.size - len(message))
+            Client.sendMessageTo(client.socket, message, destination.IP, client.name, args.etype, None, pubkeyBytes, client.sessionKey)
+            sent += 1
+    result['sent'] = sent
+
+    # Wait for messages that are still in flight
+    deadline = time.perf_counter() + 5
+    while len(result['latencies']) < sent and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    result['phases']['messages'] = (start, max(lastReceived[0], start))
+    stop.set()
+    receiver.join()
+    for client in clients:
+        client.socket.close()
+    return result
+# ================================================================================================================
+
+# ===================================================== Main =====================================================
+def main():
+    parser = argparse.ArgumentParser(description='Secure messenger benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    # Options shared by every benchmark
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--json', action='store_true', help='print results as JSON')
+
+    routing = subparsers.add_parser('routing', parents=[common], help='server message routing cost')
+    routing.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 50000],
+                         help='numbers of connected clients to test')
+    routing.add_argument('--messages', type=int, default=100000,
+                         help='lookups to time for each size')
+    routing.set_defaults(func=bench_routing)
+
+    userdb = subparsers.add_parser('userdb', parents=[common], help='user database public key lookups')
+    userdb.add_argument('--sizes', type=int, nargs='+', default=[100, 10000, 100000],
+                        help='numbers of registered users to test')
+    userdb.add_argument('--lookups', type=int, default=20000,
+                        help='lookups to time for each size')
+    userdb.set_defaults(func=bench_userdb)
+
+    crypto = subparsers.add_parser('crypto', parents=[common], help='throughput and allocations of every cipher in cipher.py')
+    crypto.add_argument('--sizes', type=int, nargs='+', default=[64, 1024, 16384, 262144],
+                        help='message sizes in bytes to test')
+    crypto.add_argument('--min-time', type=float, default=0.2,
+                        help='seconds to run each operation for')
+    crypto.add_argument('--only', nargs='+', default=None,
+                        choices=['plaintext', 'rot13', 'vigenere', 'aes', 'fernet', 'rsa', 'sign', 'oaep', 'hash'],
+                        help='cipher groups to run (default: all)')
+    crypto.set_defaults(func=bench_crypto)
+
+    cipher = subparsers.add_parser('cipher', parents=[common], help='AES and Fernet cost per message')
+    cipher.add_argument('--sizes', type=int, nargs='+', default=[64, 1024, 65536],
+                        help='message sizes in bytes to test')
+    cipher.add_argument('--messages', type=int, default=20000,
+                        help='messages to time for sizes up to 1 KB (fewer for larger sizes)')
+    cipher.set_defaults(func=bench_cipher)
+
+    keys = subparsers.add_parser('keys', parents=[common], help='client cost of encrypting and decrypting a message')
+    keys.add_argument('--messages', type=int, default=100, help='messages to time for each encryption type')
+    keys.add_argument('--size', type=int, default=100, help='message size in characters')
+    keys.set_defaults(func=bench_keys)
+
+    ratchet = subparsers.add_parser('ratchet', parents=[common], help='messages per second with RSA-wrapped keys and with the ratchet type')
+    ratchet.add_argument('--messages', type=int, default=1000, help='messages to send and receive for each encryption type')
+    ratchet.add_argument('--size', type=int, default=100, help='message size in characters')
+    ratchet.set_defaults(func=bench_ratchet)
+
+    classic = subparsers.add_parser('classic', parents=[common], help='rot13 and vigenere cost on large messages')
+    classic.add_argument('--sizes', type=int, nargs='+', default=[1024, 1048576],
+                         help='message sizes in characters to test')
+    classic.add_argument('--non-ascii', type=float, default=0,
+                         help='fraction of words followed by a non-ASCII symbol')
+    classic.set_defaults(func=bench_classic)
+
+    transport = subparsers.add_parser('transport', parents=[common], help='session frame encryption throughput per core')
+    transport.add_argument('--sizes', type=int, nargs='+', default=[64, 1024, 16384, 65536],
+                           help='message sizes in bytes to test')
+    transport.add_argument('--messages', type=int, default=20000,
+                           help='messages to time for sizes up to 1 KB (fewer for larger sizes)')
+    transport.set_defaults(func=bench_transport)
+
+    handshake = subparsers.add_parser('handshake', parents=[common], help='CPU time and bytes of each handshake')
+    handshake.add_argument('--handshakes', type=int, default=200, help='handshakes to time for each mode')
+    handshake.set_defaults(func=bench_handshake)
+
+    fanout = subparsers.add_parser('fanout', parents=[common], help='group message delivery to every member')
+    fanout.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000],
+                        help='numbers of group members to test')
+    fanout.add_argument('--messages', type=int, default=20,
+                        help='group messages to time for each size')
+    fanout.add_argument('--message-size', type=int, default=1024,
+                        help='size of each message in bytes')
+    fanout.set_defaults(func=bench_fanout)
+
+    load = subparsers.add_parser('load', parents=[common], help='end-to-end load test of a local server')
+    load.add_argument('--clients', type=int, default=100, help='number of synthetic clients')
+    load.add_argument('--processes', type=int, default=1, help='processes to run the clients in')
+    load.add_argument('--duration', type=float, default=5, help='seconds to send messages for')
+    load.add_argument('--rate', type=float, default=0,
+                      help='messages per second sent by each client (0 for as fast as possible)')
+    load.add_argument('--size', type=int, default=256, help='message size in bytes')
+    load.add_argument('--window', type=int, default=8,
+                      help='messages each client may have waiting for an ACK')
+    load.add_argument('--etype', type=int, choices=[0, 1], default=0,
+                      help='encryption type of the messages (0: plaintext, 1: ROT13)')
+    load.add_argument('--stalled', type=int, default=0,
+                      help='clients that stop reading once their account is created')
+    load.add_argument('--transport', choices=['aes-gcm', 'chacha20', 'cbc'], default='aes-gcm',
+                      help='session encryption used by the clients')
+    load.add_argument('--handshake', choices=['x25519', 'rsa'], default='x25519',
+                      help='handshake used by the clients')
+    load.add_argument('--threaded', action='store_true', help='run the server in threaded mode')
+    load.add_argument('--port', type=int, default=0, help='server port (default: a free port)')
+    load.set_defaults(func=bench_load)
+
+    reconnect = subparsers.add_parser('reconnect', parents=[common], help='reconnect cost with and without tickets')
+    reconnect.add_argument('--reconnects', type=int, default=200, help='reconnects to time for each mode')
+    reconnect.add_argument('--threaded', action='store_true', help='run the server in threaded mode')
+    reconnect.add_argument('--port', type=int, default=0, help='server port (default: a free port)')
+    reconnect.set_defaults(func=bench_reconnect)
+
+    backlog = subparsers.add_parser('backlog', parents=[common], help='receiving a stored backlog with and without decrypt workers')
+    backlog.add_argument('--messages', type=int, default=5000, help='messages in the backlog')
+    backlog.add_argument('--size', type=int, default=100, help='message size in characters')
+    backlog.add_argument('--type', type=int, default=3, choices=[0, 1, 3, 4, 5], help='encryption type of the messages')
+    backlog.add_argument('--workers', type=int, nargs='+', default=[0, 1, 2, 4], help='decrypt worker counts to test')
+    backlog.add_argument('--threaded', action='store_true', help='run the server in threaded mode')
+    backlog.add_argument('--port', type=int, default=0, help='server port (default: a free port)')
+    backlog.set_defaults(func=bench_backlog)
+
+    send = subparsers.add_parser('send', parents=[common], help='scripted sender throughput with and without send batching')
+    send.add_argument('--messages', type=int, default=20000, help='messages sent as fast as possible')
+    send.add_argument('--idle', type=int, default=200, help='single messages timed with an idle queue')
+    send.add_argument('--size', type=int, default=100, help='message size in characters')
+    send.add_argument('--type', type=int, default=0, choices=[0, 1, 3, 4, 5], help='encryption type of the messages')
+    send.add_argument('--windows', type=float, nargs='+', default=[0, 0.002], help='batch windows in seconds to test (0: no batching)')
+    send.add_argument('--batch-bytes', type=int, default=64 * 1024, help='bytes at which a batch is sent before its window ends')
+    send.add_argument('--threaded', action='store_true', help='run the server in threaded mode')
+    send.add_argument('--port', type=int, default=0, help='server port (default: a free port)')
+    send.set_defaults(func=bench_send)
+
+    args = parser.parse_args()
+    results = args.func(args)
+    printResults(args.benchmark, results, args.json)
+    return None
+
+if __name__ == "__main__":
+    main()
@@ -13,76 +13,111 @@
 '''
 
 import string
+import hmac
+import hashlib
 
 import os
-from cryptography.fernet import Fernet
+import time
+from functools import lru_cache
+from itertools import accumulate, chain
+from threading import Lock
+from cryptography.fernet import Fernet, InvalidToken
 from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.exceptions import InvalidSignature
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.exceptions import InvalidSignature, InvalidTag
+from cryptography.hazmat.primitives.asymmetric import rsa, padding, ed25519, x25519
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
 # ===================================================== ROT13 ====================================================
 plain_alpha = "abcdefghijklmnopqrstuvwxyz"
 rotated_alpha = plain_alpha[13:] + plain_alpha[0:13]    # alphabet rotated 13 shifts to left
 
+# Translation table for rot13. Each letter maps to the letter 13 places away in the
+# alphabet (keeping its case), every other character is unchanged
+ROT13_TABLE = str.maketrans(rotated_alpha + rotated_alpha.upper(), plain_alpha + plain_alpha.upper())
+ROT13_BYTES = bytes.maketrans((rotated_alpha + rotated_alpha.upper()).encode(), (plain_alpha + plain_alpha.upper()).encode())
+
 # encryption method for rot13
 def rot13_encrypt(plaintext):
-    result = ""
-    # iterate through plaintext message, and encrypt
-    for i in range(len(plaintext)):
-        cur = plaintext[i]
-        if cur != ' ':  # determine if current character is not a space
-            if cur.isalpha() and cur.isupper(): # determine if current character is uppercase
-                cur = cur.lower()   # convert current character to lowercase
-                pos = rotated_alpha.index(cur)  # find the position of the current character in the rotated alphabet
-                result +=  plain_alpha[pos].upper() # use position to find character in plain alphabet associated with that position, convert to uppercase
-            elif cur.isalpha() and cur.islower():   # determine if current character is lowercase
-                pos = rotated_alpha.index(cur)  # find the position of the current character in the rotated alphabet
-                result +=  plain_alpha[pos] # use position to find character in plain alphabet associated with that position
-            else:
-                result += cur   # if current character is not an alpha, just add it to result
-        else:
-            result += cur   # if current character is a space, just add it to result
-    return result   # return result
+    return rot13_translate(plaintext)
 
 def rot13_decrypt(enc_text):
-    result = ""
-    # iterated through encrypted text, and decrypt
-    for i in range(len(enc_text)):
-        cur = enc_text[i]
-        if cur != ' ':  # determine if current character is not a space
-            if cur.isalpha() and cur.isupper(): # determine if current character is uppercase
-                cur = cur.lower()   # convert current character to lowercase
-                pos = rotated_alpha.index(cur)  # find the position of the current character in the rotated alphabet
-                result += plain_alpha[pos].upper()  # use position to find character in plain alphabet associated with that position, convert to uppercase
-            elif cur.isalpha() and cur.islower():   # determine if current character is lowercase
-                pos = rotated_alpha.index(cur)  # find the position of the current character in the rotated alphabet
-                result +=  plain_alpha[pos] # use position to find character in plain alphabet associated with that position
-            else:
-                result += cur # if current character is not an alpha, just add it to result
-        else:
-            result += cur   # if current character is a space, just add it to result
-    return result   # return result
+    return rot13_translate(enc_text)
+
+def rot13_translate(text):
+    # rot13 is its own inverse, so encryption and decryption are the same translation
+    if text.isascii():
+        return text.translate(ROT13_TABLE)
+
+    # Non-ASCII characters are rotated (or rejected) one by one as before. Almost all of
+    # them are unchanged, and then the text can be translated as UTF-8, which leaves
+    # ASCII characters as single bytes
+    changed = {}
+    for cur in set(text):
+        if not cur.isascii():
+            new_char = rot13_char(cur)
+            if new_char != cur:
+                changed[ord(cur)] = new_char
+    if changed:
+        return text.translate({**ROT13_TABLE, **changed})
+    return text.encode('utf-8', 'surrogatepass').translate(ROT13_BYTES).decode('utf-8', 'surrogatepass')
+
+def rot13_char(cur):
+    # Rotate a single character. Raises ValueError for letters that are not in the alphabet
+    if cur.isalpha() and cur.isupper(): # determine if current character is uppercase
+        pos = rotated_alpha.index(cur.lower())  # find the position of the lowercase character in the rotated alphabet
+        return plain_alpha[pos].upper() # use position to find character in plain alphabet associated with that position, convert to uppercase
+    elif cur.isalpha() and cur.islower():   # determine if current character is lowercase
+        pos = rotated_alpha.index(cur)  # find the position of the current character in the rotated alphabet
+        return plain_alpha[pos] # use position to find character in plain alphabet associated with that position
+    return cur  # if current character is not a letter, it is unchanged
 # ================================================================================================================
 
 # ==================================================== Fernet ====================================================
 FERNET_KEY = b'wsKKhitf9F-1_oFjIUh1z-JUL7ZFqHVHUfgDo5GPG9w='
 
+# Number of keys whose cipher objects are kept by Fernet_cipher and AES_cipher (about
+# 2.3 KB per AES key). The server uses one AES key per connected client
+CIPHER_CACHE_SIZE = 4096
+
 def Fernet_generate_key():
     return Fernet.generate_key()
 
+@lru_cache(maxsize=CIPHER_CACHE_SIZE)
+def Fernet_cipher(key):
+    ''' (bytes) -> cryptography.fernet.Fernet
+
+        Returns the Fernet object for a key, creating it on first use. Fernet objects
+        can be used by several threads at once
+    '''
+    return Fernet(key)
+
 def Fernet_encrypt(plaintext, key=FERNET_KEY):
     ''' (bytes, bytes) -> bytes 
     '''
-    f = Fernet(key)
-    ciphertext = f.encrypt(plaintext)
-    return ciphertext
+    if type(plaintext) != bytes: # Fernet only accepts bytes
+        plaintext = bytes(plaintext)
+    return Fernet_cipher(bytes(key)).encrypt(plaintext)
 
 def Fernet_decrypt(ciphertext, key=FERNET_KEY):
     ''' (bytes, bytes) -> string
     '''
-    f = Fernet(key)
-    plaintext = f.decrypt(ciphertext)
+    if type(ciphertext) != bytes:
+        ciphertext = bytes(ciphertext)
+    plaintext = Fernet_cipher(bytes(key)).decrypt(ciphertext)
     return plaintext.decode()
+
+def Fernet_decrypt_token(ciphertext, key, ttl=None):
+    ''' (bytes, bytes, int) -> bytes
+        (bytes, bytes, int) -> None
+
+        Decrypts a Fernet token, returning None if it is invalid or older than ttl seconds
+    '''
+    if type(ciphertext) != bytes:
+        ciphertext = bytes(ciphertext)
+    try:
+        return Fernet_cipher(bytes(key)).decrypt(ciphertext, ttl=ttl)
+    except InvalidToken:
+        return None
 # ================================================================================================================
 
 # ===================================================== AES ======================================================
@@ -91,59 +126,190 @@ AES_KEY = b'g\x15\xd1\x91OU\xbe\xc8\x8d\x96\xbfg\xe1B;\xb6(\xd5\x95\x13\x88v1Zty
 def AES_generate_key():
     return os.urandom(32)
 
+# Padding added to fill the last block, indexed by the number of '0' bytes needed. Note:
+# padding is of the form: '000000X' where X is the hexidecimal number of '0' bytes
+AES_PADDING = [b'0' * n + '{:x}'.format(n).encode() for n in range(16)]
+
+class AESCipher:
+    ''' AES in Cipher Block Chaining mode with one key, for encrypting and decrypting
+        many messages, e.g. every frame of a session. Creating a cipher context costs
+        more than encrypting a short message, so one encryption and one decryption
+        context are created with the key and reused for every message.
+
+        A CBC context continues the chain from the last block it processed. Masking the
+        first block of each message with that block and the message's (random) IV gives
+        exactly the ciphertext a new context with that IV would produce, and the same
+        works in reverse for decryption. Messages may be bytes, bytearray or memoryview
+        and are not copied, except for the last block which is padded.
+    '''
+    def __init__(self, key):
+        cipher = Cipher(algorithms.AES(key), modes.CBC(bytes(16)))
+        self.encryptor = cipher.encryptor()
+        self.decryptor = cipher.decryptor()
+        self.encryptedBlock = 0 # Last block output by the encryptor, as an integer
+        self.decryptedBlock = 0 # Last ciphertext block given to the decryptor, as an integer
+        self.encryptLock = Lock() # The contexts hold state, one message at a time
+        self.decryptLock = Lock()
+
+    def encrypt(self, plaintext):
+        ''' (string/bytes, ) -> (bytes, bytes)
+
+            Returns the ciphertext and the initialization vector
+        '''
+        if isinstance(plaintext, str):
+            plaintext = plaintext.encode()
+        iv = os.urandom(16) # Generate initialization vector
+
+        # Add padding to fill block size
+        length = len(plaintext)
+        whole = length - length % 16 # Bytes in complete blocks
+        last = bytes(memoryview(plaintext)[whole:]) + AES_PADDING[15 - length % 16]
+        if whole == 0:
+            first, middle, last = last, b'', b''
+        else:
+            first = memoryview(plaintext)[:16]
+            middle = memoryview(plaintext)[16:whole]
+
+        mask = int.from_bytes(iv, 'big') ^ int.from_bytes(first, 'big')
+        with self.encryptLock:
+            first = (mask ^ self.encryptedBlock).to_bytes(16, 'big')
+            enc = self.encryptor
+            if whole <= 16: # No middle blocks
+                ciphertext = enc.update(first) + enc.update(last)
+            else:
+                ciphertext = b''.join((enc.update(first), enc.update(middle), enc.update(last)))
+            self.encryptedBlock = int.from_bytes(ciphertext[-16:], 'big')
+        # Return ciphertext and initialization vector
+        return ciphertext, iv
+
+    def decrypt(self, ciphertext, iv):
+        ''' (bytes, bytes) -> bytes
+        '''
+        length = len(ciphertext)
+        if length == 0 or length % 16 != 0 or len(iv) != 16:
+            raise ValueError('The length of the ciphertext is not a multiple of the block length')
+
+        with self.decryptLock:
+            plaintext = self.decryptor.update(ciphertext)
+            mask = self.decryptedBlock
+            self.decryptedBlock = int.from_bytes(memoryview(ciphertext)[-16:], 'big')
+        first = (int.from_bytes(plaintext[:16], 'big') ^ mask ^ int.from_bytes(iv, 'big')).to_bytes(16, 'big')
+
+        # Remove padding
+        if length == 16:
+            return first[:15 - int(first[-1:].decode(), 16)]
+        end = length - int(plaintext[-1:].decode(), 16) - 1
+        if end <= 16:
+            return first[:end]
+        return b''.join((first, memoryview(plaintext)[16:end]))
+
+@lru_cache(maxsize=CIPHER_CACHE_SIZE)
+def AES_cipher(key):
+    ''' (bytes) -> AESCipher
+
+        Returns the AESCipher for a key, creating it on first use
+    '''
+    return AESCipher(key)
+
 def AES_encrypt(plaintext, key=AES_KEY):
     ''' (string/bytes, bytes) -> (bytes, bytes)
     '''
-    # Generate initialization vector
-    iv = os.urandom(16)
-
-    # Create AES cipher object in Cipher Block Chaining mode
-    aesCipher = Cipher(algorithms.AES(key), modes.CBC(iv))
+    if type(key) != bytes: # Cache keys must be hashable
+        key = bytes(key)
+    return AES_cipher(key).encrypt(plaintext)
 
-    # Add padding to fill block size. Note: padding is of the form: '000000X'
-    # Where X is the hexidecimal number indicating how much padding was added
-    padding = 16 - (len(plaintext) % 16) - 1
+def AES_decrypt(ciphertext, iv, key=AES_KEY):
+    ''' (bytes, bytes, bytes) -> bytes
+    '''
+    if type(key) != bytes:
+        key = bytes(key)
+    return AES_cipher(key).decrypt(ciphertext, iv)
+# ================================================================================================================
 
-    if type(plaintext) != bytes:
-        plaintext = plaintext.encode()
+# ===================================================== AEAD =====================================================
+# Authenticated encryption: the ciphertext is encrypted and authenticated in one pass, and
+# decryption fails before any of the plaintext is used if the ciphertext was modified
+AEAD_ALGORITHMS = {'AES-GCM': AESGCM, 'ChaCha20-Poly1305': ChaCha20Poly1305}
+AEAD_NONCE_SIZE = 12
+AEAD_TAG_SIZE = 16
 
-    for i in range(padding):
-        plaintext += b'0'
+# Long messages are encrypted as a stream of segments of this many bytes, each with its
+# own tag, so a receiver can check and decrypt a message one segment at a time
+AEAD_SEGMENT_SIZE = 64 * 1024
+AEAD_STREAM_PREFIX_SIZE = 7
 
-    if padding + 1 > 0:
-        numpadding = hex(padding).replace('0x', '')
-        plaintext += numpadding.encode()
+def AEAD_cipher(algorithm, key):
+    ''' (string, bytes) -> AESGCM/ChaCha20Poly1305
 
-    # Encrypt plaintext
-    enc = aesCipher.encryptor()
+        Returns the cipher object for an AEAD algorithm (a key of AEAD_ALGORITHMS) and
+        a 32 byte key. The object can be reused for every message with that key
+    '''
+    return AEAD_ALGORITHMS[algorithm](key)
 
-    
-    ciphertext = enc.update(plaintext) + enc.finalize()
-    # Return ciphertext and initialization vector
-    return ciphertext, iv
+def AEAD_encrypt(aead, nonce, plaintext, associatedData=None):
+    ''' (AESGCM/ChaCha20Poly1305, bytes, bytes, bytes) -> bytes
 
-def AES_decrypt(ciphertext, iv, key=AES_KEY):
-    ''' (bytes, bytes, bytes) -> bytes
+        Encrypts plaintext and appends the authentication tag. A nonce must never be
+        used twice with the same key
     '''
-    # Create AES cipher object in Cipher Block Chaining mode
-    aesCipher = Cipher(algorithms.AES(key), modes.CBC(iv))
+    return aead.encrypt(nonce, plaintext, associatedData)
 
-    # Decrypt ciphertext
-    dec = aesCipher.decryptor()
+def AEAD_decrypt(aead, nonce, ciphertext, associatedData=None):
+    ''' (AESGCM/ChaCha20Poly1305, bytes, bytes, bytes) -> bytes
+        (AESGCM/ChaCha20Poly1305, bytes, bytes, bytes) -> None
 
-    plaintext = dec.update(ciphertext) + dec.finalize()
+        Decrypts ciphertext, returning None if it fails authentication
+    '''
+    try:
+        return aead.decrypt(nonce, ciphertext, associatedData)
+    except InvalidTag:
+        return None
 
-    # Remove padding
-    pad = '0x' + plaintext[-1:].decode()
-    numpadding = -1 * (int(pad, 16) + 1)
+def AEAD_stream_encrypt(aead, prefix, plaintext, segmentSize=AEAD_SEGMENT_SIZE):
+    ''' (AESGCM/ChaCha20Poly1305, bytes, bytes, int) -> bytes
 
-    plaintext = plaintext[:numpadding]
+        Encrypts plaintext as a stream of segments. The nonce of each segment is the
+        prefix (AEAD_STREAM_PREFIX_SIZE bytes), the segment number and a flag marking the
+        last segment, so segments can not be reordered, dropped or cut off without the
+        stream failing authentication. A prefix must never be used twice with the same key
+    '''
+    view = memoryview(plaintext)
+    count = max(1, -(-len(view) // segmentSize))
+    segments = []
+    for i in range(count):
+        nonce = AEAD_stream_nonce(prefix, i, i == count - 1)
+        segments.append(aead.encrypt(nonce, view[i * segmentSize:(i + 1) * segmentSize], None))
+    return b''.join(segments)
+
+def AEAD_stream_decrypt(aead, prefix, ciphertext, segmentSize=AEAD_SEGMENT_SIZE):
+    ''' (AESGCM/ChaCha20Poly1305, bytes, bytes, int) -> bytes
+        (AESGCM/ChaCha20Poly1305, bytes, bytes, int) -> None
+
+        Decrypts a stream made by AEAD_stream_encrypt, returning None if any segment
+        fails authentication
+    '''
+    view = memoryview(ciphertext)
+    size = segmentSize + AEAD_TAG_SIZE
+    count = max(1, -(-len(view) // size))
+    segments = []
+    try:
+        for i in range(count):
+            nonce = AEAD_stream_nonce(prefix, i, i == count - 1)
+            segments.append(aead.decrypt(nonce, view[i * size:(i + 1) * size], None))
+    except InvalidTag:
+        return None
+    return b''.join(segments)
 
-    # Return plaintext string
-    return plaintext
+def AEAD_stream_nonce(prefix, segment, last):
+    return prefix + segment.to_bytes(4, 'big') + (b'\1' if last else b'\0')
 # ================================================================================================================
 
 # ===================================================== RSA ======================================================
+# Number of parsed public keys kept by a KeyRing
+KEY_RING_SIZE = 1024
+
+# Seconds between checks of whether a KeyRing's key file has changed
+KEY_RING_CHECK_INTERVAL = 1
 
 def RSA_gen_priv_key():
     # Generate RSA private key
@@ -220,23 +386,106 @@ def RSA_get_key_from_bytes(pbytes):
     pubkey = serialization.load_der_public_key(pbytes)
     return pubkey
 
-def RSA_get_keys():
+def RSA_get_keys(private_path='data/RSAPRIVATEKEY.pem', public_path='data/RSAPUBLICKEY.pem'):
     ''' () -> (cryptography.hazmat.primitives.asymmetric.rsa.RSAPublicKey, cryptography.hazmat.primitives.asymmetric.rsa.RSAPrivateKey)
 
         Reads the RSA private and public key from files and returns them. If no RSA public or private keys exist, this will
         create an RSA public/private key pair, store them, and return them
     '''
-    priv = RSA_load_private_key()
+    priv = RSA_load_private_key(private_path)
     if priv is not None:
         pub = RSA_get_pub_from_priv(priv)
         return pub, priv
     else:
         print('Creating key pair')
         pub, priv = RSA_gen_key_pair()
-        RSA_store_private_key(priv)
-        RSA_store_public_key(pub)
+        RSA_store_private_key(priv, private_path)
+        RSA_store_public_key(pub, public_path)
         return pub, priv
 
+class KeyRing:
+    ''' Keeps this user's RSA key pair and the public keys of other users in memory, so
+        that encrypting or decrypting a message does not read or parse a key:
+
+            pubKey, privKey = ring.keys()
+            rcvPub = ring.public_key(pubkeyBytes)
+
+        The key pair is loaded (or created) by RSA_get_keys() the first time it is used
+        and is loaded again only when the private key file changes. The file is checked
+        at most once every KEY_RING_CHECK_INTERVAL seconds. Public keys are parsed from
+        their DER encoding (as stored in the chat database and sent by the server) once
+        and kept in a least-recently-used cache.
+    '''
+    def __init__(self, private_path='data/RSAPRIVATEKEY.pem', public_path='data/RSAPUBLICKEY.pem',
+                 identity_path='data/ED25519PRIVATEKEY.pem', size=KEY_RING_SIZE):
+        self.private_path = private_path
+        self.public_path = public_path
+        self.identity_path = identity_path
+        self.pair = None # (public key, private key)
+        self.identity_key = None # Ed25519 private key, used by the X25519 handshake
+        self.binding = None # (RSA private key, its signature of the identity key)
+        self.version = None # key_file_version() of the loaded private key file
+        self.checked = 0 # time.monotonic() of the last check of the file
+        self.lock = Lock()
+        self.public_key = lru_cache(maxsize=size)(RSA_get_key_from_bytes)
+
+    def keys(self):
+        # Returns (public key, private key), loading them if the key file has changed
+        now = time.monotonic()
+        if self.pair is not None and now - self.checked < KEY_RING_CHECK_INTERVAL:
+            return self.pair
+        with self.lock:
+            if self.pair is None:
+                self.pair = RSA_get_keys(self.private_path, self.public_path)
+                self.version = key_file_version(self.private_path)
+            elif now - self.checked >= KEY_RING_CHECK_INTERVAL:
+                version = key_file_version(self.private_path)
+                if version is not None and version != self.version: # Key file was replaced
+                    self.reload(version)
+            self.checked = now
+        return self.pair
+
+    def reload(self, version):
+        # Load the changed key file. The old keys are kept if it cannot be read
+        try:
+            priv = RSA_load_private_key(self.private_path)
+        except ValueError as e: # File is still being written, try again at the next check
+            print('Key Error: {}'.format(e))
+            return None
+        if priv is not None:
+            self.pair = (RSA_get_pub_from_priv(priv), priv)
+            self.version = version
+        return None
+
+    def private_key(self):
+        return self.keys()[1]
+
+    def identity(self, privKey=None):
+        ''' (RSAPrivateKey) -> (Ed25519PrivateKey, bytes)
+
+            Returns the Ed25519 identity key (loaded or created on first use) and the
+            signature of it made with the RSA private key, by default the ring's. The
+            server checks the signature to link the identity key to the RSA key the
+            account is registered with. It is made once per RSA key
+        '''
+        if privKey is None:
+            privKey = self.private_key()
+        with self.lock:
+            if self.identity_key is None:
+                self.identity_key = Ed25519_get_key(self.identity_path)
+            if self.binding is None or self.binding[0] is not privKey:
+                identity = Ed25519_get_bytes_from_key(self.identity_key.public_key())
+                self.binding = (privKey, RSA_sign(identity_binding_message(identity), privKey))
+            return self.identity_key, self.binding[1]
+
+def key_file_version(path):
+    # Identifies the contents of a key file without reading it. None if it does not exist
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return (info.st_ino, info.st_size, info.st_mtime_ns)
+
 def RSA_public_key_encrypt(message, pubKey):
     ''' (string/bytes, cryptography.hazmat.primitives.asymmetric.rsa.RSAPublicKey) -> bytes
 
@@ -322,129 +571,221 @@ def RSA_decrypt(ciphert, signature, sndPub, rcvPriv):
 
     plaintext = RSA_private_key_decrypt(ciphert, rcvPriv)
     return plaintext
+
+def RSA_max_message_size(pubKey):
+    # Largest message RSA_public_key_encrypt can encrypt with pubKey (190 bytes for 2048 bit keys)
+    return pubKey.key_size // 8 - 2 * hashes.SHA256.digest_size - 2
+
+def RSA_hybrid_encrypt(message, pubKey):
+    ''' (string/bytes, cryptography.hazmat.primitives.asymmetric.rsa.RSAPublicKey) -> (bytes, bytes, bytes)
+
+        Encrypts a message of any length for the owner of pubKey. The message is encrypted
+        with a new AES-GCM key as a stream of segments, and only that key is encrypted
+        with RSA. Returns the encrypted key, the stream's nonce prefix and the encrypted
+        message
+    '''
+    if type(message) == str:
+        message = message.encode()
+    key = AESGCM.generate_key(256)
+    prefix = os.urandom(AEAD_STREAM_PREFIX_SIZE)
+    return RSA_public_key_encrypt(key, pubKey), prefix, AEAD_stream_encrypt(AESGCM(key), prefix, message)
+
+def RSA_hybrid_decrypt(encKey, prefix, ciphertext, privKey):
+    ''' (bytes, bytes, bytes, cryptography.hazmat.primitives.asymmetric.rsa.RSAPrivateKey) -> bytes
+        (bytes, bytes, bytes, cryptography.hazmat.primitives.asymmetric.rsa.RSAPrivateKey) -> None
+
+        Decrypts a message encrypted with RSA_hybrid_encrypt: one RSA operation for the
+        key, then AES-GCM for the message. Returns None if the key was not encrypted for
+        privKey or the message fails authentication
+    '''
+    try:
+        key = RSA_private_key_decrypt(encKey, privKey)
+    except ValueError:
+        return None
+    if len(key) != 32 or len(prefix) != AEAD_STREAM_PREFIX_SIZE:
+        return None
+    return AEAD_stream_decrypt(AESGCM(key), prefix, ciphertext)
+# ================================================================================================================
+
+# ================================================ Ed25519 / X25519 ==============================================
+# Prefix of the message an RSA key signs to vouch for an Ed25519 identity key
+IDENTITY_BINDING_LABEL = b'Ed25519 identity\0'
+
+def Ed25519_gen_key():
+    # Generate Ed25519 private key
+    return ed25519.Ed25519PrivateKey.generate()
+
+def Ed25519_store_private_key(privKey, path='data/ED25519PRIVATEKEY.pem'):
+    # Store Ed25519 private key in .pem file on disk
+    pem = privKey.private_bytes(encoding=serialization.Encoding.PEM,
+                             format=serialization.PrivateFormat.PKCS8,
+                             encryption_algorithm=serialization.NoEncryption()
+                             )
+    with open(path, 'wb+') as key_file:
+        key_file.write(pem)
+    return None
+
+def Ed25519_load_private_key(key_path='data/ED25519PRIVATEKEY.pem'):
+    # Retrieves Ed25519 private key from .pem file on disk
+    priv = None
+    try:
+        with open(key_path, 'rb') as key_file:
+            priv = serialization.load_pem_private_key(key_file.read(), password=None)
+    except FileNotFoundError:
+        print('Key: \'{}\' does not exist'.format(key_path))
+
+    return priv
+
+def Ed25519_get_key(key_path='data/ED25519PRIVATEKEY.pem'):
+    ''' (string) -> cryptography.hazmat.primitives.asymmetric.ed25519.Ed25519PrivateKey
+
+        Reads the Ed25519 private key from a file, creating and storing one if it does
+        not exist. Generating a key takes microseconds, unlike an RSA key pair
+    '''
+    priv = Ed25519_load_private_key(key_path)
+    if priv is None:
+        print('Creating Ed25519 key')
+        priv = Ed25519_gen_key()
+        Ed25519_store_private_key(priv, key_path)
+    return priv
+
+def Ed25519_get_bytes_from_key(pubkey):
+    # Raw 32 byte encoding of an Ed25519 (or X25519) public key
+    return pubkey.public_bytes(encoding=serialization.Encoding.Raw,
+                               format=serialization.PublicFormat.Raw
+                               )
+
+def Ed25519_sign(message, privKey):
+    # 64 byte Ed25519 signature of message
+    return privKey.sign(message)
+
+def Ed25519_verify(signature, message, pubkeyBytes):
+    ''' (bytes, bytes, bytes) -> bool
+
+        Verifies an Ed25519 signature with a raw public key received from a peer
+    '''
+    try:
+        ed25519.Ed25519PublicKey.from_public_bytes(pubkeyBytes).verify(signature, message)
+    except (InvalidSignature, ValueError):
+        return False
+    return True
+
+def identity_binding_message(identityBytes):
+    # Message signed with an RSA key to show that it owns an Ed25519 identity key
+    return IDENTITY_BINDING_LABEL + identityBytes
+
+def X25519_gen_key():
+    ''' () -> (cryptography.hazmat.primitives.asymmetric.x25519.X25519PrivateKey, bytes)
+
+        Generates an ephemeral X25519 key for one handshake. Returns the private key
+        and the raw public key to send to the peer
+    '''
+    priv = x25519.X25519PrivateKey.generate()
+    return priv, Ed25519_get_bytes_from_key(priv.public_key())
+
+def X25519_exchange(privKey, peerBytes):
+    ''' (X25519PrivateKey, bytes) -> bytes
+
+        Shared secret of a private key and the peer's raw public key. Raises ValueError
+        if the peer's key is invalid
+    '''
+    return privKey.exchange(x25519.X25519PublicKey.from_public_bytes(peerBytes))
+
 # ================================================================================================================
 
 # ===================================================== Vigenere =================================================
 enc_key = "test"
 dec_key = enc_key
 
+# Translation tables used to take the text apart. VIG_MASK turns every character that
+# is not a letter into '\0', VIG_LETTERS_ONLY deletes them and VIG_SEPARATORS_ONLY
+# deletes the letters
+VIG_LETTERS = plain_alpha + plain_alpha.upper()
+VIG_MASK = {i: 0 for i in range(128) if chr(i) not in VIG_LETTERS}
+VIG_LETTERS_ONLY = dict.fromkeys(VIG_MASK)
+VIG_SEPARATORS_ONLY = dict.fromkeys(map(ord, VIG_LETTERS))
+
 # encryption method for vigenere
 def vig_encrypt(input_str):
-    enc_str = ""
-
-    # length of input string
-    string_length = len(input_str)
-
-    # expand encryption key to make it longer than input string
-    expanded_key = enc_key
-    expanded_key_length = len(expanded_key)
-    while expanded_key_length < string_length:
-        expanded_key = expanded_key + enc_key
-        expanded_key_length = len(expanded_key)
-
-    key_pos = 0
-
-    for i in range(string_length):
-        cur = input_str[i]
-        # handle case where current character is uppercase
-        if cur.isalpha() and cur.isupper():
-            # convert current character to lowercase
-            cur = cur.lower()
-        
-            # find position of letter in alphabet
-            letter_pos = plain_alpha.find(cur)
-            key_char = expanded_key[key_pos]
-            key_char_pos = plain_alpha.find(key_char)
-            key_pos = key_pos + 1
-
-            # change original of input string character
-            new_pos = letter_pos + key_char_pos
-            if new_pos >= 26:
-                new_pos = new_pos - 26
-            
-            # convert new character to uppercase
-            new_char = plain_alpha[new_pos].upper()
-            enc_str = enc_str + new_char
-
-        # handle case where current character is lowercase
-        elif cur.isalpha() and cur.islower():
-            # find position of letter in alphabet
-            letter_pos = plain_alpha.find(cur)
-            key_char = expanded_key[key_pos]
-            key_char_pos = plain_alpha.find(key_char)
-            key_pos = key_pos + 1
-
-            # change original of input string character
-            new_pos = letter_pos + key_char_pos
-            if new_pos >= 26:
-                new_pos = new_pos - 26
-            new_char = plain_alpha[new_pos]
-            enc_str = enc_str + new_char
-
-        # handle case where current character is not a letter
-        else:
-            enc_str = enc_str + cur
-
-    return enc_str
+    return vig_translate(input_str, enc_key, False)
 
 # decryption method for vigenere
 def vig_decrypt(input_str):
-    dec_str = ""
-
-    # length of input string
-    string_length = len(input_str)
-
-    # expand decryption key to make it longer than input string
-    expanded_key = dec_key
-    expanded_key_length = len(expanded_key)
-    while expanded_key_length < string_length:
-        expanded_key = expanded_key + dec_key
-        expanded_key_length = len(expanded_key)
-
-    key_pos = 0
-
-    for i in range(string_length):
-        cur = input_str[i]
-        # handle case where current character is uppercase
-        if cur.isalpha() and cur.isupper():
-            # convert current character to lowercase
-            cur = cur.lower()
-        
-            # find position of letter in alphabet
-            letter_pos = plain_alpha.find(cur)
-            key_char = expanded_key[key_pos]
-            key_char_pos = plain_alpha.find(key_char)
-            key_pos = key_pos + 1
-
-            # change original of input string character
-            new_pos = letter_pos - key_char_pos
-            if new_pos >= 26:
-                new_pos = new_pos + 26
-            
-            # convert new character to uppercase
-            new_char = plain_alpha[new_pos].upper()
-            dec_str = dec_str + new_char
-
-        # handle case where current character is lowercase
-        elif cur.isalpha() and cur.islower():
-            # find position of letter in alphabet
-            letter_pos = plain_alpha.find(cur)
-            key_char = expanded_key[key_pos]
-            key_char_pos = plain_alpha.find(key_char)
-            key_pos = key_pos + 1
-
-            # change original of input string character
-            new_pos = letter_pos - key_char_pos
-            if new_pos >= 26:
-                new_pos = new_pos + 26
-            new_char = plain_alpha[new_pos]
-            dec_str = dec_str + new_char
-
-        # handle case where current character is not a letter
-        else:
-            dec_str = dec_str + cur
+    return vig_translate(input_str, dec_key, True)
+
+def vig_translate(text, key, decrypt):
+    ''' (string, string, bool) -> string
+
+        Encrypts (or decrypts) text with the vigenere key. Characters that are not
+        letters are unchanged and do not use up a key character, so the i-th letter of
+        the text is shifted by key[i % len(key)]. Instead of going through the text one
+        character at a time, the letters are collected into one string and every
+        len(key)-th letter is translated with the table for its key character
+    '''
+    tables = vig_tables(key, decrypt)
+    mask, letters_only, separators_only = VIG_MASK, VIG_LETTERS_ONLY, VIG_SEPARATORS_ONLY
+    if not text.isascii():
+        # Extend the tables with the non-ASCII characters of the text. Non-ASCII letters
+        # use up a key character too
+        others = [cur for cur in set(text) if not cur.isascii()]
+        extra = [ord(cur) for cur in others if vig_letter(cur)]
+        not_letters = [ord(cur) for cur in others if not vig_letter(cur)]
+        tables = [dict(table) for table in tables]
+        for table, key_char in zip(tables, key):
+            table.update({i: vig_shift(chr(i), key_char, decrypt) for i in extra})
+        mask = {**mask, **dict.fromkeys(not_letters, 0)}
+        letters_only = {**letters_only, **dict.fromkeys(not_letters)}
+        separators_only = {**separators_only, **dict.fromkeys(extra)}
+
+    # Lengths of the runs of letters between the other characters
+    lengths = list(map(len, text.translate(mask).split('\0')))
+    letters = text.translate(letters_only)
+
+    # Every letter is shifted to an ASCII letter, so the shifted letters can be put back
+    # together with slice assignment on bytes
+    period = len(key)
+    shifted = bytearray(len(letters))
+    for i in range(period):
+        shifted[i::period] = letters[i::period].translate(tables[i]).encode('ascii')
+    shifted = shifted.decode('ascii')
+
+    # Put the shifted letters back between the other characters
+    runs = [None] * (2 * len(lengths) - 1)
+    runs[0::2] = [shifted[i:j] for i, j in zip(chain((0,), accumulate(lengths)), accumulate(lengths))]
+    runs[1::2] = text.translate(separators_only)
+    return ''.join(runs)
+
+@lru_cache(maxsize=16)
+def vig_tables(key, decrypt):
+    # Translation tables of the ASCII letters, one for each key character
+    letters = plain_alpha + plain_alpha.upper()
+    return tuple({ord(cur): vig_shift(cur, key_char, decrypt) for cur in letters} for key_char in key)
+
+def vig_letter(cur):
+    # Check if a character uses up a key character (uppercase and lowercase letters)
+    return cur.isalpha() and (cur.isupper() or cur.islower())
+
+def vig_shift(cur, key_char, decrypt):
+    # Shift a single letter by a key character. Letters that are not in the alphabet
+    # are treated as if they were at position -1
+    if cur.isupper():
+        letter_pos = plain_alpha.find(cur.lower())
+    else:
+        letter_pos = plain_alpha.find(cur)
+    key_char_pos = plain_alpha.find(key_char)
 
-    return dec_str
+    if decrypt:
+        new_pos = letter_pos - key_char_pos # negative positions wrap around to the end of the alphabet
+    else:
+        new_pos = letter_pos + key_char_pos
+        if new_pos >= 26:
+            new_pos = new_pos - 26
+    new_char = plain_alpha[new_pos]
+
+    # keep the case of the original letter
+    if cur.isupper():
+        return new_char.upper()
+    return new_char
 # ================================================================================================================
 
 # ===================================================== Hash =====================================================
@@ -463,6 +804,142 @@ def hashPassword(password, ntimes=10):
 
     return p
 
+def HMAC_sign(message, key):
+    ''' (bytes, bytes) -> bytes
+
+        HMAC-SHA256 of message. Used to prove knowledge of a shared secret
+    '''
+    return hmac.new(key, message, hashlib.sha256).digest()
+
+def HMAC_verify(tag, message, key):
+    # Constant time check of an HMAC-SHA256 tag
+    return hmac.compare_digest(tag, HMAC_sign(message, key))
+
+def derive_key(secret, label, context):
+    ''' (bytes, bytes, bytes) -> bytes
+
+        Derives a 32 byte key from a shared secret for the given purpose (label) and
+        context, e.g. the nonces of a resumed session
+    '''
+    return HMAC_sign(label + b'\0' + context, secret)
+
+# ================================================================================================================
+
+# ================================================= Hash Ratchet =================================================
+# A chain key is shared once (wrapped with the recipient's RSA key) and then stepped
+# forward with HMAC-SHA256 for every message, giving each message its own AES-GCM key.
+# Chain keys are replaced as they are used, so a key taken from a device later cannot
+# decrypt earlier messages
+RATCHET_ID_SIZE = 16
+RATCHET_HEADER_SIZE = RATCHET_ID_SIZE + 8
+RATCHET_EXCHANGE_LABEL = b'ratchet exchange\0'
+
+# Largest number of messages a received message may skip ahead of the chain, and the
+# number of skipped message keys kept for messages that arrive late
+RATCHET_MAX_SKIP = 1000
+
+# Every message key encrypts exactly one message, so the nonce can be fixed
+RATCHET_NONCE = bytes(AEAD_NONCE_SIZE)
+
+class HashRatchet:
+    ''' One direction of a ratchet chain: a random chain ID, the index of the next
+        message and the chain key for it. step() returns the next message key:
+
+            chain = HashRatchet()
+            header = chain.header() # Sent with the message
+            encMessage = ratchet_encrypt(message, chain.step(), header)
+    '''
+    def __init__(self, chainKey=None, chainID=None, index=0):
+        self.chainKey = chainKey if chainKey is not None else os.urandom(32)
+        self.chainID = chainID if chainID is not None else os.urandom(RATCHET_ID_SIZE)
+        self.index = index
+
+    def step(self):
+        # Key for message self.index. Moves the chain to the next message
+        messageKey = HMAC_sign(b'\1', self.chainKey)
+        self.chainKey = HMAC_sign(b'\2', self.chainKey)
+        self.index += 1
+        return messageKey
+
+    def copy(self):
+        return HashRatchet(self.chainKey, self.chainID, self.index)
+
+    def header(self):
+        # Identifies the chain and the message's place in it
+        return self.chainID + self.index.to_bytes(8, 'big')
+
+    def to_bytes(self):
+        return self.header() + self.chainKey
+
+    @staticmethod
+    def from_bytes(data):
+        # Chain stored with to_bytes(), or None if data is not one
+        if data is None or len(data) != RATCHET_HEADER_SIZE + 32:
+            return None
+        chainID, index = ratchet_parse_header(data[:RATCHET_HEADER_SIZE])
+        return HashRatchet(data[RATCHET_HEADER_SIZE:], chainID, index)
+
+class ReceivingRatchet:
+    ''' The receiving end of a chain. Messages may arrive out of order: the keys of
+        messages that were skipped are kept (up to RATCHET_MAX_SKIP of them) until the
+        message arrives, and every key is used once, so a replayed message is rejected.
+        The chain only moves forward once a message has been authenticated
+    '''
+    def __init__(self, chain):
+        self.chain = chain
+        self.skipped = {} # Message index -> message key, oldest first
+
+    def open(self, index, header, ciphertext):
+        ''' (int, bytes, bytes) -> bytes
+            (int, bytes, bytes) -> None
+
+            Decrypts message number index of the chain. Returns None if the message is
+            not authentic, was already received or is too far ahead of the chain
+        '''
+        if index < self.chain.index: # Skipped earlier, or a replay
+            messageKey = self.skipped.get(index)
+            if messageKey is None:
+                return None
+            plaintext = ratchet_decrypt(ciphertext, messageKey, header)
+            if plaintext is not None:
+                del self.skipped[index]
+            return plaintext
+
+        if index - self.chain.index > RATCHET_MAX_SKIP:
+            return None
+        chain = self.chain.copy()
+        skipped = []
+        while chain.index < index:
+            skipped.append((chain.index, chain.step()))
+        plaintext = ratchet_decrypt(ciphertext, chain.step(), header)
+        if plaintext is None:
+            return None
+
+        self.chain = chain
+        self.skipped.update(skipped)
+        while len(self.skipped) > RATCHET_MAX_SKIP:
+            del self.skipped[next(iter(self.skipped))]
+        return plaintext
+
+def ratchet_parse_header(header):
+    ''' (bytes) -> (bytes, int)
+        (bytes) -> None
+
+        Splits a message header into the chain ID and message index
+    '''
+    if len(header) != RATCHET_HEADER_SIZE:
+        return None
+    return header[:RATCHET_ID_SIZE], int.from_bytes(header[RATCHET_ID_SIZE:], 'big')
+
+def ratchet_encrypt(plaintext, messageKey, header):
+    # AES-GCM with a message key. The header is authenticated along with the message
+    if type(plaintext) == str:
+        plaintext = plaintext.encode()
+    return AEAD_encrypt(AESGCM(messageKey), RATCHET_NONCE, plaintext, header)
+
+def ratchet_decrypt(ciphertext, messageKey, header):
+    # Plaintext bytes, or None if the message or its header was modified
+    return AEAD_decrypt(AESGCM(messageKey), RATCHET_NONCE, ciphertext, header)
 # ================================================================================================================
 
 # ===================================================== Main =====================================================
@@ -0,0 +1,352 @@
+'''
+    Secure Messenger Application Wire Protocol
+
+    Authors: Hans Prieto, Joshua Fawcett
+
+    This module implements the framing used by the client and the server. Every message
+    on the wire is a frame: a fixed size header followed by a list of length-prefixed
+    fields, so messages of any size (and fields containing any bytes) can be sent and
+    several frames can be received with a single recv call.
+
+    Frame layout (all integers are big endian):
+            magic (1 byte) | version (1 byte) | frame type (1 byte) | field count (1 byte) |
+            body length (4 bytes) | body
+
+    The body is the concatenation of the fields, each written as a 4 byte length followed
+    by the field bytes. Session frames carry two fields, the AES initialization vector
+    and the ciphertext, and the plaintext is itself a list of fields encoded the same way.
+
+    A session is encrypted with one of the transports below, chosen by the client during
+    the handshake from the transports the server offers. CBC sessions use the session key
+    itself and FRAME_SESSION frames. AEAD sessions (AES-GCM or ChaCha20-Poly1305) use an
+    AEADSession and FRAME_AEAD frames, which carry the nonce and the authenticated
+    ciphertext. Clients and servers that do not know about transports use CBC.
+
+    The fourth field of the client hello selects the handshake. HANDSHAKE_RSA is the
+    original three message handshake: both hellos are signed with RSA and the client
+    sends the session key encrypted with the server's RSA key. HANDSHAKE_X25519 takes
+    one round trip: the client hello carries an ephemeral X25519 key and is signed with
+    the client's Ed25519 identity key (which its RSA key vouches for), and the server
+    hello carries the server's ephemeral key and the transport it chose, signed with the
+    server's Ed25519 key. The session key is derived from the X25519 shared secret and
+    both hellos. Servers that only know the RSA handshake close the connection when
+    they receive an X25519 hello, and the client then runs the RSA handshake.
+
+    After the handshake the server sends a features frame (code b'130') listing the
+    optional requests it handles. With FEATURE_BATCH a client may send several requests
+    in one batch request (code b'250'), whose second field holds the packed requests;
+    the server handles each of them as if it had been sent on its own and answers with
+    a batch reply (also code b'250') holding the packed reply to each request. Clients
+    that do not know the features frame ignore it.
+'''
+
+import struct
+import hashlib
+from itertools import count
+from cipher import AES_encrypt, AES_decrypt, AEAD_cipher, AEAD_encrypt, AEAD_decrypt, AEAD_NONCE_SIZE, derive_key
+
+FRAME_MAGIC = 0xA5
+PROTOCOL_VERSION = 1
+
+# Frame types
+FRAME_HANDSHAKE = 1 # Handshake messages, sent before a session key exists
+FRAME_SESSION = 2   # Fields encrypted with the client/server session key
+FRAME_PLAIN = 3     # Unencrypted server replies (status codes and public keys)
+FRAME_AEAD = 4      # Fields sealed with an AEAD session
+
+# Session transports
+TRANSPORT_CBC = b'0'      # AES-CBC, used with peers that do not offer a transport
+TRANSPORT_AESGCM = b'1'
+TRANSPORT_CHACHA20 = b'2'
+
+# AEAD transports in order of preference, and the algorithm (in cipher.py) of each
+AEAD_TRANSPORTS = (TRANSPORT_AESGCM, TRANSPORT_CHACHA20)
+TRANSPORT_ALGORITHMS = {TRANSPORT_AESGCM: 'AES-GCM', TRANSPORT_CHACHA20: 'ChaCha20-Poly1305'}
+TRANSPORT_NAMES = {'cbc': TRANSPORT_CBC, 'aes-gcm': TRANSPORT_AESGCM, 'chacha20': TRANSPORT_CHACHA20}
+
+# Handshakes, selected by the fourth field of the client hello
+HANDSHAKE_RSA = b'0'    # RSA signatures and RSA key transport, used by older clients
+HANDSHAKE_X25519 = b'1' # Ephemeral X25519 key agreement with Ed25519 signatures
+
+# Optional requests a server announces in its features frame
+FEATURE_BATCH = b'batch' # Batch requests carrying several requests in one frame
+
+# Number of nonces below the highest one received that an AEAD session still accepts
+# (once each). Frames for one connection may be encrypted by several server threads
+# and sent slightly out of order
+REPLAY_WINDOW = 1024
+REPLAY_MASK = (1 << REPLAY_WINDOW) - 1
+
+FRAME_HEADER = struct.Struct('!BBBBI')
+FIELD_LENGTH = struct.Struct('!I')
+
+# Size of the random nonces exchanged when a session is resumed with a ticket
+NONCE_SIZE = 16
+
+MAX_FIELDS = 255
+MAX_FRAME_SIZE = 16 * 1024 * 1024 # Largest frame body accepted by the decoder
+
+# ================================================================================================================
+
+# =============================================== Protocol Errors ================================================
+class ProtocolError(Exception):
+    # Raised when received data is not a valid frame. The connection cannot be
+    # resynchronised after this and should be closed
+    pass
+# ================================================================================================================
+
+# =============================================== Helper Functions ===============================================
+def packFields(fields):
+    ''' (list) -> bytes
+
+        Encodes a list of fields (bytes or string) as length-prefixed fields
+    '''
+    parts = []
+    for field in fields:
+        if type(field) == str:
+            field = field.encode()
+        parts.append(FIELD_LENGTH.pack(len(field)))
+        parts.append(field)
+    return b''.join(parts)
+
+def unpackFields(data, start=0, end=None, count=None):
+    ''' (bytes, int, int, int) -> list
+
+        Decodes length-prefixed fields from data[start:end]. If count is given exactly
+        that many fields must be present. Raises ProtocolError on malformed data
+    '''
+    if end is None:
+        end = len(data)
+    fields = []
+    pos = start
+    while pos < end:
+        if pos + FIELD_LENGTH.size > end:
+            raise ProtocolError('truncated field length')
+        length, = FIELD_LENGTH.unpack_from(data, pos)
+        pos += FIELD_LENGTH.size
+        if pos + length > end:
+            raise ProtocolError('truncated field')
+        fields.append(bytes(data[pos:pos + length]))
+        pos += length
+
+    if count is not None and len(fields) != count:
+        raise ProtocolError('expected {} fields, got {}'.format(count, len(fields)))
+    return fields
+
+def encodeFrame(frameType, fields):
+    ''' (int, list) -> bytes
+
+        Creates a frame of the given type carrying fields
+    '''
+    if len(fields) > MAX_FIELDS:
+        raise ProtocolError('too many fields')
+    body = packFields(fields)
+    header = FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION, frameType, len(fields), len(body))
+    return header + body
+
+def encodeSessionFrame(fields, sessionKey):
+    ''' (list, bytes/AEADSession) -> bytes
+
+        Encrypts fields with the session key (or AEAD session) and returns the
+        session frame
+    '''
+    if type(sessionKey) == AEADSession:
+        return sessionKey.seal(fields)
+    ciphertext, iv = AES_encrypt(packFields(fields), sessionKey)
+    return encodeFrame(FRAME_SESSION, [iv, ciphertext])
+
+def decodeSessionFrame(frameFields, sessionKey):
+    ''' (list, bytes/AEADSession) -> list
+        (list, bytes/AEADSession) -> None
+
+        Decrypts the fields of a session frame. Returns None if the frame can not
+        be decrypted or does not contain valid fields. The caller checks that the
+        frame type is sessionFrameType(sessionKey)
+    '''
+    if type(sessionKey) == AEADSession:
+        return sessionKey.open(frameFields)
+    if len(frameFields) != 2:
+        return None
+    iv, ciphertext = frameFields
+    try:
+        plaintext = AES_decrypt(ciphertext, iv, sessionKey)
+        return unpackFields(plaintext)
+    except (ValueError, ProtocolError): # Wrong key or corrupted ciphertext
+        return None
+
+def createSession(sessionKey, transport, initiator):
+    ''' (bytes, bytes, bool) -> bytes/AEADSession
+
+        Returns what encodeSessionFrame and decodeSessionFrame use for a session with
+        the given key and transport: the key itself for CBC, otherwise an AEADSession.
+        initiator is True on the client side of the connection
+    '''
+    if transport == TRANSPORT_CBC:
+        return sessionKey
+    return AEADSession(sessionKey, transport, initiator)
+
+def sessionTransport(sessionKey):
+    # Transport of a session key (or AEAD session)
+    if type(sessionKey) == AEADSession:
+        return sessionKey.transport
+    return TRANSPORT_CBC
+
+def sessionFrameType(sessionKey):
+    # Type of the frames encrypted with a session key (or AEAD session)
+    if type(sessionKey) == AEADSession:
+        return FRAME_AEAD
+    return FRAME_SESSION
+
+def handshakeSessionKey(sharedSecret, transcript):
+    ''' (bytes, bytes) -> bytes
+
+        Session key of an X25519 handshake, derived from the shared secret and a hash of
+        both hellos (transcript), so the two sides only agree on a key if they received
+        the same messages
+    '''
+    return derive_key(sharedSecret, b'x25519 session', hashlib.sha256(transcript).digest())
+# ================================================================================================================
+
+# ================================================= AEAD Session =================================================
+class AEADSession:
+    ''' State of a session using an AEAD transport. Every frame is encrypted and
+        authenticated in one pass with a nonce made of the sender's direction and a
+        counter, so nonces never repeat and a frame can not be reflected back to its
+        sender. The nonce is sent with the frame, and each nonce is accepted once:
+        replayed frames, and frames more than REPLAY_WINDOW behind the newest one, are
+        dropped. Frames that fail authentication are dropped before their fields are
+        parsed.
+
+        seal() may be called by several threads at once. open() is only called by the
+        thread receiving from the connection.
+    '''
+    def __init__(self, key, transport, initiator):
+        self.transport = transport
+        self.aead = AEAD_cipher(TRANSPORT_ALGORITHMS[transport], key)
+        # The client's frames start with direction 1 and the server's with direction 2
+        client, server = (1).to_bytes(4, 'big'), (2).to_bytes(4, 'big')
+        self.sendPrefix, self.receivePrefix = (client, server) if initiator else (server, client)
+        self.counter = count() # Nonces of sent frames
+        self.highest = -1 # Highest counter received
+        self.received = 0 # Bit i is set if counter highest - i has been received
+
+    def seal(self, fields):
+        # Returns an AEAD frame carrying fields
+        nonce = self.sendPrefix + next(self.counter).to_bytes(AEAD_NONCE_SIZE - 4, 'big')
+        return encodeFrame(FRAME_AEAD, [nonce, AEAD_encrypt(self.aead, nonce, packFields(fields))])
+
+    def open(self, frameFields):
+        ''' (list) -> list
+            (list) -> None
+
+            Returns the fields of an AEAD frame, or None if the frame was modified,
+            replayed, or not sent by the other side of this session
+        '''
+        if len(frameFields) != 2:
+            return None
+        nonce, ciphertext = frameFields
+        if len(nonce) != AEAD_NONCE_SIZE or nonce[:4] != self.receivePrefix:
+            return None
+        counter = int.from_bytes(nonce[4:], 'big')
+        offset = self.highest - counter
+        if offset >= REPLAY_WINDOW or (offset >= 0 and self.received >> offset & 1):
+            return None # Replayed or too old
+
+        plaintext = AEAD_decrypt(self.aead, nonce, ciphertext)
+        if plaintext is None:
+            return None
+
+        # Record the counter only once the frame is authentic
+        if offset < 0: # Newest frame so far
+            self.received = ((self.received << -offset) | 1) & REPLAY_MASK
+            self.highest = counter
+        else:
+            self.received |= 1 << offset
+        try:
+            return unpackFields(plaintext)
+        except ProtocolError:
+            return None
+# ================================================================================================================
+
+# ================================================ Frame Decoder =================================================
+class FrameDecoder:
+    ''' Incremental decoder for a stream of frames. Data is received into a reusable
+        buffer with recv_into and appended to the pending bytes; complete frames are
+        then read out with nextFrame() or frames(). Partial frames stay buffered until
+        the rest of the frame arrives.
+    '''
+    def __init__(self, bufferSize=65536):
+        self.chunk = bytearray(bufferSize) # Reusable receive buffer
+        self.view = memoryview(self.chunk)
+        self.buffer = bytearray() # Received bytes that have not been decoded yet
+        self.start = 0 # Offset of the first undecoded byte in buffer
+
+    def recvFrom(self, sock):
+        ''' Receives once from sock and returns the number of bytes read (0 if the
+            peer closed the connection). Socket exceptions are passed to the caller
+        '''
+        n = sock.recv_into(self.chunk)
+        self.feed(self.view[:n])
+        return n
+
+    def feed(self, data):
+        # Add received bytes to the decoder
+        if self.start > 0: # Drop frames that were already decoded
+            del self.buffer[:self.start]
+            self.start = 0
+        self.buffer += data
+        return None
+
+    def pending(self):
+        # Number of buffered bytes that have not been decoded
+        return len(self.buffer) - self.start
+
+    def nextFrame(self):
+        ''' () -> (int, list)
+            () -> None
+
+            Returns the type and fields of the next complete frame, or None if no
+            complete frame has been received
+        '''
+        buf = self.buffer
+        if len(buf) - self.start < FRAME_HEADER.size:
+            return None
+
+        magic, version, frameType, count, length = FRAME_HEADER.unpack_from(buf, self.start)
+        if magic != FRAME_MAGIC:
+            raise ProtocolError('bad frame magic')
+        if version > PROTOCOL_VERSION:
+            raise ProtocolError('unsupported protocol version {}'.format(version))
+        if length > MAX_FRAME_SIZE:
+            raise ProtocolError('frame too large: {} bytes'.format(length))
+
+        begin = self.start + FRAME_HEADER.size
+        end = begin + length
+        if end > len(buf): # Rest of the frame has not arrived yet
+            return None
+
+        fields = unpackFields(buf, begin, end, count)
+        self.start = end
+        return frameType, fields
+
+    def frames(self):
+        # Yields (frame type, fields) for every complete frame that has been received
+        frame = self.nextFrame()
+        while frame is not None:
+            yield frame
+            frame = self.nextFrame()
+
+def recvFrame(sock, decoder):
+    ''' (socket, FrameDecoder) -> (int, list)
+        (socket, FrameDecoder) -> None
+
+        Blocks until a complete frame has been received from sock. Returns None if
+        the connection is closed first
+    '''
+    frame = decoder.nextFrame()
+    while frame is None:
+        if decoder.recvFrom(sock) == 0:
+            return None
+        frame = decoder.nextFrame()
+    return frame
+# ================================================================================================================
@@ -8,54 +8,112 @@
     module was designed to run on an AWS t2.micro instance to provide continuous service to clients
     and allow for NAT traversal between two hosts that may be hidden behind NAT. 
 '''
+import os
 import sys
+import time
+import queue
+import argparse
+import selectors
+from collections import deque, OrderedDict
 from cipher import *
+from protocol import *
 from socket import *
-from UserDatabase import UserDataBase
-from threading import Thread
+from UserDatabase import UserDataBasePool
+from Outbox import Outbox
+from Stats import Stats, NO_STATS, STATS_PORT, STATS_PATH, STATS_INTERVAL
+from threading import Thread, Lock, RLock
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 serverPort = 12000
 
-serverSocket = socket(AF_INET, SOCK_STREAM)
-serverSocket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
-serverSocket.bind(('', serverPort))
-
-serverSocket.listen(1)
-
 # Load from file (or create) server RSA keys (Implemented in cipher.py)
 PUBLICKEY, PRIVATEKEY = RSA_get_keys()
 
+# Server Ed25519 key, which signs the server hello of the X25519 handshake
+IDENTITYKEY = Ed25519_get_key()
+IDENTITY = Ed25519_get_bytes_from_key(IDENTITYKEY.public_key())
+
+# Seconds a client has to complete each step of the handshake
+HANDSHAKE_TIMEOUT = 2
+
+# Default listen backlog and number of handshake worker threads
+LISTEN_BACKLOG = 128
+HANDSHAKE_WORKERS = min(32, (os.cpu_count() or 1) + 4)
+
+# Number of user database connections kept open by the server
+DATABASE_CONNECTIONS = 4
+
+# Number of usernames whose public keys are kept in memory
+KEY_CACHE_SIZE = 10000
+
+# Number of group chats whose member lists are kept in memory
+GROUP_CACHE_SIZE = 1000
+
+# Number of stored messages sent to a reconnecting client per send call. Kept well
+# inside the client's replay window, so frames sent by other threads between two
+# batches never push a batch's frames out of it
+OUTBOX_BATCH = REPLAY_WINDOW // 8
+
+# Number of threads delivering group chat messages to members
+FANOUT_LANES = 4
+
+# Bytes waiting to be sent to a client at which new frames are refused, and the level the
+# queue must drain to before frames are accepted again
+OUTBOUND_HIGH_WATER = 1024 * 1024
+OUTBOUND_LOW_WATER = 256 * 1024
+
+# What happens to a frame refused by a full queue: 'spill' stores messages in the outbox
+# until the client catches up, 'drop' discards them, 'disconnect' closes the connection
+OVERFLOW_POLICIES = ('spill', 'drop', 'disconnect')
+OVERFLOW_POLICY = 'spill'
+
+# Seconds a session resumption ticket can be used for after it is issued
+TICKET_LIFETIME = 3600
+
+# Key encrypting resumption tickets. It is created at startup, so tickets issued before
+# a restart are rejected and those clients run the full handshake
+TICKET_KEY = Fernet_generate_key()
+
+# Optional requests announced to clients after the handshake (see protocol.py)
+SERVER_FEATURES = [FEATURE_BATCH]
+
+# Signed server hello, created on first use. The message does not depend on the client
+# so it only has to be signed once
+SERVER_HELLO = None
+
 # ================================================================================================================
 
 # =============================================== Helper Functions ===============================================
+def createServerSocket(port=serverPort, backlog=LISTEN_BACKLOG):
+    # Create the listening socket clients connect to
+    serverSocket = socket(AF_INET, SOCK_STREAM)
+    serverSocket.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    serverSocket.bind(('', port))
+
+    serverSocket.listen(backlog)
+    return serverSocket
+
 def valid_IP(IP):
     octets = IP.split('.')
     if len(octets) != 4:
         return False
     return True
 
-def unpackMessage(message, sessionKey):
-    ''' Decrypt a message and split into header fields
+def unpackMessage(frameType, frameFields, sessionKey):
+    ''' Decrypt a session frame and return its header fields
     '''
-    try:
-        if len(message) > 0:
-            fields = message.split(b'\r\n') # Split message into IV and ciphertext
-            if len(fields) != 2:
-                return None
-            iv = fields[0] # Initialization vector for AES decryption
-            ct = fields[1] # Cipher text to be decrypted
-
-            pt = AES_decrypt(ct, iv, sessionKey) # Decrypt
-        else:
-            return None
-    except timeout:
+    if frameType != sessionFrameType(sessionKey):
         return None
 
-    fields = pt.split(b'\r\n') # Split plaintext into header fields
+    fields = decodeSessionFrame(frameFields, sessionKey) # Decrypt
+    if fields is None:
+        print('Error in unpackMessage: decrypt failure')
+        return None
 
-    # Valid messages have either 5 or 7 fields
-    if len(fields) != 5 and len(fields) != 7:
+    # Valid messages have either 5 or 7 fields, plus an optional request ID
+    if len(fields) < 5 or len(fields) > 8:
         print('Error in unpackMessage: invalid field size')
         return None
 
@@ -74,181 +132,733 @@ def getTimeStamp():
         hour -= 12
     timeStamp = '{}/{}/{} {}:{}:{}'.format(month, day, year - 2000, hour, minute, second)
     return timeStamp
+
+def sendReply(client, fields, requestID=None, replies=None):
+    ''' Sends a status reply to client. Replies to requests that carried a request ID
+        echo the ID and are encrypted with the client's session key, so the client can
+        match them to the request. Other replies are sent unencrypted. If replies (a
+        list) is given, a reply with a request ID is added to it instead, to be sent in
+        one batch reply with the others
+    '''
+    if requestID is None:
+        return client.send(encodeFrame(FRAME_PLAIN, fields))
+    if replies is not None:
+        replies.append(packFields(fields + [requestID]))
+        return True
+    return client.sendFields(fields + [requestID])
+
+def removeRoute(index, key, client):
+    # Remove a connection from one of the RoutingTable indices
+    routes = tuple(c for c in index.get(key, ()) if c is not client)
+    if len(routes) > 0:
+        index[key] = routes
+    else:
+        index.pop(key, None)
+    return None
 # ================================================================================================================
 
-# =============================================== Thread Targets  ================================================
-def connectionThread(serverSocket, addClientCallback, status):
-    ''' Thread target to asynchronously wait for client connections, verify/accept
-        clients, establish session key, and create client_connection objects. 
+# ================================================== Handshake ===================================================
+def verifyClientHello(frame, addr):
+    ''' ((int, list), tuple) -> (string, RSAPublicKey)
+        ((int, list), tuple) -> None
+
+        Validates the first handshake message from a client. Returns the client's IP
+        and public key on success and None if the handshake is invalid
     '''
-    while not status.terminate:
-        connection, addr = serverSocket.accept()
-        print('Connection: {}'.format(addr))
-        connection.settimeout(2)
-        try:
-            # Receive handshake message from client
-            handshake = connection.recv(4096)
+    frameType, headerFields = frame
 
-            # Split handshake message into fields
-            headerFields = handshake.split(b'\r\n')
+    if frameType != FRAME_HANDSHAKE or len(headerFields) != 5:
+        print('Connection: {} Invalid:\nHeader Error: {}'.format(addr, headerFields))
+        return None
 
-            if len(headerFields) != 5:
-                print('Connection: {} Invalid:\nHeader Error: {}'.format(addr, headerFields))
-                connection.close()
-                continue
+    # Extract client IP and public key from header fields
+    try:
+        IP = headerFields[1].decode()
+        senderPubKey = RSA_get_key_from_bytes(headerFields[2])
+    except ValueError:
+        print('Connection: {} Invalid:\nPublic Key Error'.format(addr))
+        return None
 
-            # Extract client IP and public key from header fields
-            IP = headerFields[1].decode()
-            senderPubKey = RSA_get_key_from_bytes(headerFields[2])
+    if not valid_IP(IP):
+        print('Connection: {} Invalid:\nIP Error: {}'.format(addr, IP))
+        return None
 
-            if not valid_IP(IP):
-                print('Connection: {} Invalid:\nIP Error: {}'.format(addr, IP))
-                connection.close()
-                continue
+    # Retrieve and remove signature from header fields
+    signature = headerFields.pop(-1)
 
-            # Retrieve and remove signature from header fields
-            signature = headerFields.pop(-1)
+    # Pack header fields into bytes to test signature
+    message = packFields(headerFields)
 
-            # Join header fields into bytes to test signature
-            message = b'\r\n'.join(headerFields)
+    # Test validity of signature
+    if not RSA_verify(signature, message, senderPubKey):
+        print('Connection: {} Invalid:\nSignature Error'.format(addr))
+        return None
 
-            # Test validity of signature
-            if not RSA_verify(signature, message, senderPubKey):
-                print('Connection: {} Invalid:\nSignature Error')
-                connection.close()
-                continue
+    return IP, senderPubKey
 
-            # Convert server public key object into bytes for transmission to client
-            pubkeyBytes = RSA_get_bytes_from_key(PUBLICKEY)
+def createServerHello():
+    ''' () -> bytes
 
-            # Construct handshake message to send server public key to client
-            handshakeMessage = b'100\r\n' + pubkeyBytes + b'\r\n0'
-            signature = RSA_sign(handshakeMessage, PRIVATEKEY)
+        Returns the signed handshake message carrying the server public key
+    '''
+    global SERVER_HELLO
+    if SERVER_HELLO is not None:
+        return SERVER_HELLO
 
-            newHandshake = handshakeMessage + b'\r\n' + signature
+    # Convert server public key object into bytes for transmission to client
+    pubkeyBytes = RSA_get_bytes_from_key(PUBLICKEY)
 
-            # Send server handshake message to client
-            connection.send(newHandshake)
+    # Construct handshake message to send server public key to client, with the AEAD
+    # transports the client may choose from
+    handshakeFields = [b'100', pubkeyBytes, packFields(AEAD_TRANSPORTS)]
+    signature = RSA_sign(packFields(handshakeFields), PRIVATEKEY)
 
-            # Receive client response with encrypted session key
-            enc_response = connection.recv(4096)
+    SERVER_HELLO = encodeFrame(FRAME_HANDSHAKE, handshakeFields + [signature])
+    return SERVER_HELLO
 
-            # Split header fields from signature
-            fields = enc_response.split(b'\r\n')
+def readSessionKey(frame, senderPubKey):
+    ''' ((int, list), RSAPublicKey) -> bytes/AEADSession
+        ((int, list), RSAPublicKey) -> None
 
-            if len(fields) != 2:
-                print('Invalid session key response')
-                continue
+        Decrypts the client's final handshake message and returns the session key, or
+        an AEADSession if the client chose an AEAD transport
+    '''
+    frameType, fields = frame
 
-            message, signature = fields
+    # Encrypted header fields and signature
+    if frameType != FRAME_HANDSHAKE or len(fields) != 2:
+        print('Invalid session key response')
+        return None
 
-            # Decrypt header fields with server private key and verify validity of message with client public key
-            plain_response = RSA_decrypt(message, signature, senderPubKey, PRIVATEKEY)
+    message, signature = fields
 
-            if plain_response is None:
-                print('session key decrypt failure')
-                continue
+    # Decrypt header fields with server private key and verify validity of message with client public key
+    try:
+        plain_response = RSA_decrypt(message, signature, senderPubKey, PRIVATEKEY)
+    except ValueError:
+        plain_response = None
 
-            # Extract status code, sequence number, and session key from header fields
-            code, sequence, sessionKey = plain_response.split(b'\r\n')
+    if plain_response is None:
+        print('session key decrypt failure')
+        return None
 
-            connection.settimeout(None)
+    # Extract status code, transport, and session key from header fields. Clients that
+    # do not know about transports send b'0' (CBC)
+    try:
+        fields = unpackFields(plain_response, count=3)
+    except ProtocolError:
+        print('Invalid session key response')
+        return None
 
-            # Create client connection object
-            addClientCallback(connection, addr, IP, senderPubKey, sessionKey)
-        except timeout:
-            print("timeout")
-            connection.close()
-            continue
-            
-    return None
+    code, transport, sessionKey = fields
+    if transport != TRANSPORT_CBC and transport not in AEAD_TRANSPORTS:
+        print('Invalid transport: {}'.format(transport))
+        return None
+    return createSession(sessionKey, transport, initiator=False)
 
-def receivingThread(client, bufferSize, rThreadInstance):
-    ''' Thread target to listen for messages from clients and
-        attempt to forward those messages to the appropriate destination
+def createTicket(IP, pubkeyBytes, transport=TRANSPORT_CBC):
+    ''' (string, bytes, bytes) -> (bytes, bytes)
+
+        Returns a resumption ticket for a client and the secret it is bound to. The
+        ticket holds the client's IP, public key, the secret and the session's
+        transport, encrypted and authenticated with the server's ticket key, so the
+        server keeps no state
     '''
-    connection = client.socket
-    address = client.address
+    secret = os.urandom(32)
+    ticket = Fernet_encrypt(packFields([IP, pubkeyBytes, secret, transport]), TICKET_KEY)
+    return ticket, secret
+
+def resumeSession(frame, addr):
+    ''' ((int, list), tuple) -> (string, RSAPublicKey, bytes, bytes)
+        ((int, list), tuple) -> None
+
+        Validates a request to resume a session with a ticket. Returns the client's IP,
+        public key, the new session key (an AEADSession if the ticket's session used an
+        AEAD transport) and the reply to send to the client, or None if
+        the ticket is invalid or expired. Only symmetric operations are used: the client
+        proves it knows the ticket's secret and the new session key is derived from the
+        secret and both sides' nonces
+    '''
+    frameType, fields = frame
+    if frameType != FRAME_HANDSHAKE or len(fields) != 4:
+        return None
+    code, ticket, clientNonce, proof = fields
 
-    client_session_key = client.sessionKey
+    plain = Fernet_decrypt_token(ticket, TICKET_KEY, TICKET_LIFETIME)
+    if plain is None:
+        print('Connection: {} Invalid:\nTicket expired or invalid'.format(addr))
+        return None
 
-    connection.settimeout(2)
-    while not rThreadInstance.status.terminate:
-        try: # Attempt to receive message from client
-            packet = connection.recv(bufferSize)
-        except ConnectionResetError: # Connection with client was lost
-            print('Lost connection with: {}'.format(client))
-            rThreadInstance.disconnect()
+    try:
+        IP, pubkeyBytes, secret, transport = unpackFields(plain, count=4)
+        senderPubKey = RSA_get_key_from_bytes(pubkeyBytes)
+    except (ProtocolError, ValueError):
+        return None
+
+    # Client must prove it knows the secret, otherwise the ticket may have been stolen
+    if len(clientNonce) != NONCE_SIZE or not HMAC_verify(proof, packFields(fields[:3]), secret):
+        print('Connection: {} Invalid:\nTicket proof error'.format(addr))
+        return None
+
+    serverNonce = os.urandom(NONCE_SIZE)
+    sessionKey = createSession(derive_key(secret, b'session', clientNonce + serverNonce), transport, initiator=False)
+
+    # The reply proves to the client that the server could open the ticket
+    replyFields = [b'121', clientNonce, serverNonce]
+    reply = encodeFrame(FRAME_HANDSHAKE, [b'121', serverNonce, HMAC_sign(packFields(replyFields), secret)])
+    return IP.decode(), senderPubKey, sessionKey, reply
+
+def isResumption(frame):
+    # True if frame is a request to resume a session with a ticket
+    frameType, fields = frame
+    return frameType == FRAME_HANDSHAKE and len(fields) > 0 and fields[0] == b'120'
+
+def isX25519Hello(frame):
+    # True if frame is the client hello of an X25519 handshake
+    frameType, fields = frame
+    return frameType == FRAME_HANDSHAKE and len(fields) == 9 and fields[3] == HANDSHAKE_X25519
+
+def acceptX25519Hello(frame, addr):
+    ''' ((int, list), tuple) -> (string, RSAPublicKey, bytes/AEADSession, bytes)
+        ((int, list), tuple) -> None
+
+        Handles the client hello of an X25519 handshake, which completes the handshake.
+        Returns the client's IP, public key, the session key (an AEADSession for AEAD
+        transports) and the server hello to send, or None if the hello is invalid. The
+        hello must be signed with the client's Ed25519 identity key, and the identity
+        key signed with the client's RSA key
+    '''
+    frameType, fields = frame
+    code, IP, pubkeyBytes, version, identity, binding, clientEphemeral, transports, signature = fields
+    try:
+        IP = IP.decode()
+        senderPubKey = RSA_get_key_from_bytes(pubkeyBytes)
+        offered = unpackFields(transports)
+    except (ValueError, ProtocolError):
+        print('Connection: {} Invalid:\nHeader Error: {}'.format(addr, fields[:4]))
+        return None
+
+    if not valid_IP(IP):
+        print('Connection: {} Invalid:\nIP Error: {}'.format(addr, IP))
+        return None
+
+    # The hello is signed with the identity key, and the identity key with the RSA key
+    if not Ed25519_verify(signature, packFields(fields[:-1]), identity) or not verifyIdentity(pubkeyBytes, identity, binding):
+        print('Connection: {} Invalid:\nSignature Error'.format(addr))
+        return None
+
+    # Use the first transport in the client's order of preference that this server has
+    transport = TRANSPORT_CBC
+    for t in offered:
+        if t in AEAD_TRANSPORTS:
+            transport = t
             break
-        except Exception: # Timeout or other error
-            continue
 
-        # Decrypt with client's session key and split header fields
-        fields = unpackMessage(packet, client_session_key)
-        if fields is None:
-            continue
+    ephemeralKey, serverEphemeral = X25519_gen_key()
+    try:
+        sharedSecret = X25519_exchange(ephemeralKey, clientEphemeral)
+    except ValueError:
+        print('Connection: {} Invalid:\nKey Exchange Error'.format(addr))
+        return None
 
-        # Client is disconnecting
-        if fields[0] == b'0':
-            rThreadInstance.disconnect()
+    # The server signs both hellos, which proves to the client that it holds the
+    # server key and received the client's ephemeral key unchanged
+    replyFields = [b'100', IDENTITY, serverEphemeral, transport]
+    transcript = packFields(fields + replyFields)
+    reply = encodeFrame(FRAME_HANDSHAKE, replyFields + [Ed25519_sign(transcript, IDENTITYKEY)])
+
+    sessionKey = createSession(handshakeSessionKey(sharedSecret, transcript), transport, initiator=False)
+    return IP, senderPubKey, sessionKey, reply
+
+def findUserName(userDB, publicKey):
+    # Username of the account that owns an RSA public key, or None if it has no account
+    with userDB.connection() as db:
+        return db.getUserName(RSA_get_bytes_from_key(publicKey))
+
+def finishHandshake(userDB, publicKey, func, *args):
+    ''' Handshake pool target that runs func, the last step of a handshake, and then looks
+        up the username of the client's account, so the event loop never waits on the
+        user database. func returns the session key, or (IP, public key, session key,
+        reply) when publicKey is None. Returns (result of func, username), or None if
+        func fails
+    '''
+    result = func(*args)
+    if result is None:
+        return None
+    if publicKey is None:
+        publicKey = result[1]
+    return result, findUserName(userDB, publicKey)
+
+@lru_cache(maxsize=KEY_CACHE_SIZE)
+def verifyIdentity(pubkeyBytes, identity, binding):
+    # Check that an RSA public key signed an Ed25519 identity key. A client sends the
+    # same signature with every connection, so the result is cached
+    try:
+        return RSA_verify(binding, identity_binding_message(identity), RSA_get_key_from_bytes(pubkeyBytes))
+    except ValueError:
+        return False
+# ================================================================================================================
+
+# =============================================== Packet Handling ================================================
+# Errors raised while handling a malformed request, e.g. a field that is not UTF-8 or
+# a missing field. They disconnect the client that sent it, never the server
+REQUEST_ERRORS = (ProtocolError, ValueError, IndexError)
+
+def handlePacket(server, client, frame):
+    ''' Processes one frame received from a connected client: account creation,
+        public key lookup, forwarding a message to its destination, or a batch of
+        these requests. Returns False
+        if the client is disconnecting and True otherwise
+    '''
+    fields = readPacket(server, client, frame)
+    if fields is None:
+        return True
+    if fields[0] == b'250': # Several requests sent as one frame
+        return handleBatch(server, client, unpackBatch(server, fields))
+    return handleRequest(server, client, fields)
+
+def readPacket(server, client, frame):
+    # Decrypt a frame with the client's session key. Returns its fields, or None if the
+    # frame is dropped
+    stats = server.stats
+    stats.count('frames_in')
+
+    start = stats.clock()
+    fields = unpackMessage(frame[0], frame[1], client.sessionKey)
+    stats.record('decrypt', start)
+    if fields is None:
+        stats.count('dropped_frames')
+    return fields
+
+def usesDatabase(server, fields):
+    ''' True if handling the decrypted fields of a request may query the user database:
+        creating an account or a group, or looking up a public key or group that is not
+        cached
+    '''
+    code = fields[0]
+    if code == b'10' or code == b'30':
+        return True
+    if code == b'20' and len(fields) > 1:
+        return not server.keyCache.contains(fields[1].decode())
+    if code == b'300' and len(fields) > 1:
+        return not server.groups.contains(fields[1].decode())
+    return False
+
+def unpackBatch(server, fields):
+    # Returns the requests carried by a batch request. Requests that would be dropped if
+    # sent on their own are left out, and batches can not be nested
+    stats = server.stats
+    try:
+        requests = [unpackFields(packet) for packet in unpackFields(fields[1])]
+    except ProtocolError:
+        stats.count('dropped_frames')
+        return []
+    stats.count('batched_requests', len(requests))
+
+    valid = [request for request in requests if 5 <= len(request) <= 8 and request[0] != b'250']
+    if len(valid) < len(requests):
+        stats.count('dropped_frames', len(requests) - len(valid))
+    return valid
+
+def handleBatch(server, client, requests):
+    ''' Handles the requests of a batch request (see unpackBatch) in order. Each request
+        is answered as if it had been sent on its own, but the replies are sent together
+        in one batch reply once the whole batch has been handled. Returns False if the
+        client is disconnecting and True otherwise
+    '''
+    replies = []
+    connected = True
+    for request in requests:
+        if not handleRequest(server, client, request, replies):
+            connected = False
             break
-        elif fields[0] == b'10': # Create user account
-            db = UserDataBase()
-            username = fields[1].decode()
-            hashedPass = fields[2]
-            IP = client.IP
-            pubkeybytes = RSA_get_bytes_from_key(client.publicKey)
+    if len(replies) > 0:
+        client.sendFields([b'250', packFields(replies)])
+    return connected
+
+def handleRequest(server, client, fields, replies=None):
+    ''' Handles the decrypted fields of one request. Replies are sent to the client,
+        or added to replies if it is given. Returns False if the client is
+        disconnecting and True otherwise
+    '''
+    stats = server.stats
+
+    # Requests may end with a request ID chosen by the client, echoed in the reply
+    requestID = None
+    if len(fields) == 6 or len(fields) == 8:
+        requestID = fields.pop()
+
+    # Client is disconnecting
+    if fields[0] == b'0':
+        return False
+    elif fields[0] == b'10': # Create user account
+        username = fields[1].decode()
+        hashedPass = fields[2]
+        IP = client.IP
+        pubkeybytes = RSA_get_bytes_from_key(client.publicKey)
+        with server.userDB.connection() as db:
             success = db.addUser(username, IP, pubkeybytes, hashedPass)
-            if success:
-                connection.send(b'50') # Successful account creation code
+        if success:
+            server.keyCache.put(username, pubkeybytes)
+            server.routes.bindName(client, username)
+            sendReply(client, [b'50'], requestID, replies) # Successful account creation code
+        else:
+            sendReply(client, [b'55'], requestID, replies) # Account creation failure code
+        return True
+    elif fields[0] == b'20': # Get a user's public key
+        username = fields[1] # Username of desired user's public key
+        IP = fields[2] # IP address of desired user's public key
+
+        # Check the key cache, then the user database, for the public key
+        pubkeybytes = server.keyCache.get(username.decode())
+        if pubkeybytes is None:
+            with server.userDB.connection() as db:
+                pubkeybytes = db.getUserPublicKey(username.decode())
+            if pubkeybytes is not None:
+                server.keyCache.put(username.decode(), pubkeybytes)
+        if pubkeybytes is not None: # User exists and public key is ready to send
+            # Send public key
+            sendReply(client, [b'20', pubkeybytes, b'0'], requestID, replies)
+        elif requestID is not None: # Tell the client now instead of letting the request time out
+            sendReply(client, [b'55'], requestID, replies)
+        return True
+    elif fields[0] == b'30': # Create a group chat
+        groupID = fields[1].decode()
+        try:
+            # Member usernames and the group key encrypted with each member's public key
+            names = [n.decode() for n in unpackFields(fields[2])]
+            groupKeys = unpackFields(fields[3])
+        except (ProtocolError, ValueError):
+            names, groupKeys = [], []
+
+        success = False
+        if len(names) > 0 and len(names) == len(groupKeys) and client.userName in names:
+            with server.userDB.connection() as db:
+                success = db.createGroup(groupID, list(zip(names, groupKeys)))
+            server.groups.invalidate(groupID) # Members are read from the database when next used
+        sendReply(client, [b'50' if success else b'55'], requestID, replies)
+        return True
+    elif fields[0] == b'300': # Message to a group chat
+        if len(fields) != 7:
+            stats.count('dropped_frames')
+            sendReply(client, [b'55'], requestID, replies)
+            return True
+        # The fan-out lanes decode the sender's name and the encryption type. A malformed
+        # message fails here instead, before it is acknowledged
+        fields[2].decode(), fields[3].decode()
+        members = server.getGroup(fields[1].decode())
+        if members is None or client.userName not in [name for name, groupKey in members]:
+            sendReply(client, [b'55'], requestID, replies) # Not a member of this group
+            return True
+        server.fanOut.submit(server, client, members, fields)
+        stats.count('group_messages')
+        sendReply(client, [b'50'], requestID, replies)
+        return True
+
+    if len(fields) != 7:
+        stats.count('dropped_frames')
+        return True
+
+    # Extract info from fields
+    receiverIP = fields[1].decode() # Destination IP address
+    name = fields[2].decode()
+    eType = fields[3].decode()
+    senderIV = fields[4]
+    senderEncKey = fields[5]
+    message = fields[6]
+
+    # Reconstruct packet to send to destination client
+    newPacket = [name, client.IP, eType, senderIV, senderEncKey, message]
+
+    # Look up the connections registered for the destination IP. A message is never
+    # sent back to the connection it came from
+    start = stats.clock()
+    routes = [conn for conn in server.routes.lookupIP(receiverIP) if conn.address != client.address]
+    stats.record('route', start)
+    if len(routes) == 0:
+        # Recipient is offline. Store the message until they connect
+        server.outbox.enqueue(receiverIP, packFields(newPacket))
+        stats.count('messages_stored')
+        sendReply(client, [b'51'], requestID, replies) # Message stored code
+        return True
+
+    # One reply for the message: ACK if any of the recipient's connections got it,
+    # dropped if they all refused it, failure otherwise
+    delivered = dropped = False
+    for conn in routes:
+        try:
+            if deliver(server, conn, newPacket):
+                delivered = True
             else:
-                connection.send(b'55') # Account creation failure code
-            db.disconnect()
-            continue
-        elif fields[0] == b'20': # Get a user's public key
-            username = fields[1] # Username of desired user's public key
-            IP = fields[2] # IP address of desired user's public key
-
-            # Access user database to check for public key
-            db = UserDataBase()
-            pubkeybytes = db.getUserPublicKey(username.decode())
-            if pubkeybytes is not None: # User exists and public key is ready to send
-                # Send public key
-                connection.send(b'20\r\n' + pubkeybytes + b'\r\n0')
-            db.disconnect() # Disconnect from database
+                dropped = True
+        except Exception as e:
+            stats.count('send_errors')
+            print('Message to {} failed: {}'.format(conn, e))
+    if delivered:
+        sendReply(client, [b'50'], requestID, replies)
+    else:
+        sendReply(client, [b'52' if dropped else b'55'], requestID, replies) # Message dropped code
+    return True
+
+def deliver(server, conn, packet):
+    ''' Encrypts packet (a list of fields) with conn's session key and sends it. While
+        stored messages are being delivered to conn the packet is stored behind them
+        instead, so the recipient gets messages in order. Returns True if the packet was
+        sent, queued or stored, or False if conn refused it and it was dropped
+    '''
+    stats = server.stats
+    with conn.flushLock:
+        if conn.flushing:
+            server.outbox.enqueue(conn.IP, packFields(packet))
+            stats.count('messages_stored')
+        else:
+            # Forward message to destination, encrypted with its session key
+            if conn.sendFields(packet):
+                stats.count('messages_forwarded')
+            elif conn.outbound is not None and conn.outbound.overflow == 'spill':
+                # Client is not keeping up. Store this and later messages until its
+                # queue drains, then deliver them from the outbox in order
+                server.outbox.enqueue(conn.IP, packFields(packet))
+                conn.flushing = True
+                stats.count('messages_stored')
+            else:
+                return False # Dropped by the overflow policy, or the connection is lost
+    return True
+
+def fanOutLane(server, sender, members, fields):
+    ''' Fan-out lane target that delivers a group message to some of the group's
+        members. Each member receives the group key encrypted with their own public key
+        in place of the sender's key field. Members that are offline get the message
+        stored in the outbox
+    '''
+    groupID = fields[1]
+    name = fields[2].decode()
+    eType = fields[3].decode()
+    senderIV = fields[4]
+    message = fields[6]
+
+    stats = server.stats
+    for member, groupKey in members:
+        # Reconstruct packet to send to the member
+        newPacket = [name, sender.IP, eType, senderIV, groupKey, message, groupID]
+
+        start = stats.clock()
+        routes = server.routes.lookupName(member)
+        stats.record('route', start)
+        if len(routes) == 0: # Member is offline
+            with server.userDB.connection() as db:
+                IP = db.getUserIP(member)
+            if IP is not None:
+                server.outbox.enqueue(IP, packFields(newPacket))
+                stats.count('messages_stored')
             continue
 
-        # Extract info from fields
-        receiverIP = fields[1].decode() # Destination IP address
-        name = fields[2].decode()
-        eType = fields[3].decode()
-        senderIV = fields[4]
-        senderEncKey = fields[5]
-        message = fields[6]
-
-        # Get list of client connections 
-        connectionsList = rThreadInstance.parent.connections
-
-        # Search for destination in client connections list
-        for conn in connectionsList:
-            IP = conn.IP
-            if IP == receiverIP: #Destination IP matches client IP
-                if conn.address != address: # Prevent client from sending a message to themself
-                    try:
-                        # Reconstruct packet to send to destination client
-                        newPacket = '{}\r\n{}\r\n{}\r\n'.format(name, client.IP, eType).encode()
-                        #newPacket = '{}\r\n{}\r\n{}\r\n{}'.format(name, message, client.IP, eType)
-                        newPacket += senderIV + b'\r\n' + senderEncKey + b'\r\n' + message
-                        # Encrypt new packet with destination client's session key
-                        enc, iv = AES_encrypt(newPacket, conn.sessionKey)
-                        packetENC = iv + '\r\n'.encode() + enc
-                        # Forward message to destination
-                        conn.socket.send(packetENC)
-                        # Send ACK to original client
-                        connection.send('50'.encode())
+        for conn in routes:
+            if conn.address == sender.address: # Do not send a message back to its sender
+                continue
+            try:
+                deliver(server, conn, newPacket)
+            except Exception as e:
+                stats.count('send_errors')
+                print('Group message to {} failed: {}'.format(conn, e))
+    return None
+
+def startFlush(server, client):
+    # Start delivering the client's stored messages, unless a flush is already running
+    with client.flushLock:
+        if not client.flushing or client.flushScheduled:
+            return None
+        client.flushScheduled = True
+    server.flushPool.submit(flushOutbox, server, client)
+    return None
+
+def flushOutbox(server, client):
+    ''' Outbox worker target that delivers the messages stored for a client that has
+        just connected, or whose outbound queue overflowed. Messages are encrypted with
+        the client's session key and sent in batches of OUTBOX_BATCH frames per send
+        call. A batch is only deleted from the outbox once the client's queue has taken
+        it. If the queue fills up again the rest stay stored, and the flush is restarted
+        when the queue drains
+    '''
+    outbox = server.outbox
+    try:
+        while True:
+            with client.flushLock:
+                rows = outbox.take(client.IP, OUTBOX_BATCH)
+                if len(rows) == 0: # Backlog delivered, forward new messages directly
+                    client.flushing = False
+                    client.flushScheduled = False
+                    return None
+
+            if not client.sendFields(*[unpackFields(message) for mID, message in rows]): # Queue is full, wait for it to drain
+                with client.flushLock:
+                    client.flushScheduled = False
+                if not client.outbound.congested: # Drained before the flag was cleared
+                    startFlush(server, client)
+                return None
+            outbox.delete(client.IP, [mID for mID, message in rows])
+            server.stats.count('messages_delivered_from_outbox', len(rows))
+            print('Delivered {} stored messages to {}'.format(len(rows), client))
+    except (OSError, ProtocolError) as e:
+        print('Outbox delivery to {} failed: {}'.format(client, e))
+        with client.flushLock:
+            client.flushScheduled = False
+    return None
+# ================================================================================================================
+
+# =============================================== Thread Targets  ================================================
+def outboundWriterThread(writer):
+    ''' Thread target that writes queued data to clients whose sockets are writable
+    '''
+    selector = writer.selector
+    watched = {} # OutboundQueue -> socket registered for it
+    while writer.running:
+        for key, mask in selector.select():
+            if key.data is None: # Wake up: register queues that have data waiting
+                try:
+                    while len(writer.wakeupSocket.recv(4096)) > 0:
+                        pass
+                except BlockingIOError:
+                    pass
+                while not writer.requests.empty():
+                    outbound = writer.requests.get()
+                    if outbound is None:
                         continue
-                    except Exception:
-                        break
+                    if outbound.closed:
+                        if outbound in watched:
+                            selector.unregister(watched.pop(outbound))
+                    elif outbound not in watched and outbound.queued > 0:
+                        try:
+                            selector.register(outbound.socket, selectors.EVENT_WRITE, outbound)
+                            watched[outbound] = outbound.socket
+                        except (ValueError, KeyError, OSError): # Socket already closed
+                            pass
+            elif key.data.flush(): # Queue is empty, stop watching
+                selector.unregister(watched.pop(key.data))
+    return None
+
+def connectionThread(serverSocket, addClientCallback, status, handshakePool, stats=NO_STATS):
+    ''' Thread target to asynchronously wait for client connections and hand them to
+        the handshake worker pool
+    '''
+    while not status.terminate:
+        connection, addr = serverSocket.accept()
+        print('Connection: {}'.format(addr))
+        stats.count('connections')
+        handshakePool.executor.submit(handshakeWorker, connection, addr, addClientCallback, stats)
+    return None
+
+def handshakeWorker(connection, addr, addClientCallback, stats=NO_STATS):
+    ''' Handshake pool target used by the threaded server to verify/accept a client,
+        establish session key, and create the client_connection object
+    '''
+    start = stats.clock(always=True)
+    connection.settimeout(HANDSHAKE_TIMEOUT)
+    decoder = FrameDecoder()
+    try:
+        # Receive handshake message from client and validate it
+        frame = recvFrame(connection, decoder)
+        if frame is not None and isResumption(frame): # Client has a ticket
+            resumed = resumeSession(frame, addr)
+            if resumed is None:
+                stats.count('resumption_failures')
+                connection.sendall(encodeFrame(FRAME_HANDSHAKE, [b'55']))
+                connection.close()
+                return None
+            IP, senderPubKey, sessionKey, reply = resumed
+            connection.sendall(reply)
+            connection.settimeout(None)
+            stats.record('resumption', start)
+            stats.count('resumptions')
+            addClientCallback(connection, addr, IP, senderPubKey, sessionKey, decoder)
+            return None
+
+        if frame is not None and isX25519Hello(frame): # Handshake completes with one message
+            accepted = acceptX25519Hello(frame, addr)
+            if accepted is None:
+                stats.count('handshake_failures')
+                connection.close()
+                return None
+            IP, senderPubKey, sessionKey, reply = accepted
+            connection.sendall(reply)
+            connection.settimeout(None)
+            stats.record('handshake', start)
+            stats.count('handshakes')
+            stats.count('x25519_handshakes')
+            addClientCallback(connection, addr, IP, senderPubKey, sessionKey, decoder)
+            return None
+
+        hello = None if frame is None else verifyClientHello(frame, addr)
+        if hello is None:
+            stats.count('handshake_failures')
+            connection.close()
+            return None
+        IP, senderPubKey = hello
+
+        # Send server handshake message to client
+        connection.sendall(createServerHello())
+
+        # Receive client response with encrypted session key
+        frame = recvFrame(connection, decoder)
+        sessionKey = None if frame is None else readSessionKey(frame, senderPubKey)
+        if sessionKey is None:
+            stats.count('handshake_failures')
+            connection.close()
+            return None
+
+        connection.settimeout(None)
+        stats.record('handshake', start)
+        stats.count('handshakes')
+
+        # Create client connection object. Any frames the client sent right after
+        # the handshake stay buffered in its decoder
+        addClientCallback(connection, addr, IP, senderPubKey, sessionKey, decoder)
+    except (timeout, OSError, ProtocolError):
+        print("timeout")
+        stats.count('handshake_failures')
+        connection.close()
+    return None
+
+def receivingThread(client, bufferSize, rThreadInstance):
+    ''' Thread target to listen for messages from clients and
+        attempt to forward those messages to the appropriate destination
+    '''
+    connection = client.socket
+    decoder = client.decoder
+
+    # The socket is non-blocking so that sends to this client never block. Wait for
+    # data with a poll that times out every 2 seconds to check for termination
+    waiter = selectors.PollSelector() if hasattr(selectors, 'PollSelector') else selectors.SelectSelector()
+    waiter.register(connection, selectors.EVENT_READ)
+    connected = True
+    while connected and not rThreadInstance.status.terminate:
+        try:
+            # Handle every complete frame, then attempt to receive more from client
+            for frame in decoder.frames():
+                if not handlePacket(rThreadInstance.parent, client, frame):
+                    connected = False
+                    break
+            else:
+                if len(waiter.select(2)) == 0:
+                    continue # No message yet
+                n = decoder.recvFrom(connection)
+                client.stats.count('bytes_in', n)
+                if n == 0:
+                    print('Lost connection with: {}'.format(client))
+                    connected = False
+        except (timeout, BlockingIOError): # No message yet
+            continue
+        except REQUEST_ERRORS as e: # Client sent invalid data
+            client.stats.count('protocol_errors')
+            print('Protocol Error from {}: {!r}'.format(client, e))
+            connected = False
+        except OSError: # Connection with client was lost
+            print('Lost connection with: {}'.format(client))
+            connected = False
+
+    waiter.close()
+    if not connected:
+        rThreadInstance.disconnect()
     return None
 # ================================================================================================================
 
@@ -258,18 +868,415 @@ class Client_Connection:
         such as client socket, client address, client IP, client session key, and
         a timestamp.
     '''
-    def __init__(self, conn, addr, IP, publicKey, sessionKey=None):
+    def __init__(self, conn, addr, IP, publicKey, sessionKey=None, decoder=None, stats=NO_STATS):
         self.socket = conn
         self.address = addr
         self.IP = IP
         self.sessionKey = sessionKey
         self.publicKey = publicKey
-
+        self.userName = None # Set once the client's account is known
+
+        # Decoder holding frames received from the client that have not been handled yet
+        self.decoder = decoder if decoder is not None else FrameDecoder()
+
+        # Frames can be sent to the client from several threads. Held while frames are
+        # encrypted and sent, so they are sent in the order of their AEAD counters
+        self.sendLock = RLock()
+        # Bounded queue of frames waiting to be sent (see OutboundQueue). Without one,
+        # send() blocks until the whole frame is sent
+        self.outbound = None
+        # True while messages stored in the outbox are being delivered to the client
+        self.flushing = False
+        self.flushScheduled = False # A flushOutbox job is queued or running
+        self.flushLock = Lock()
+        # True while a database worker handles one of the client's requests (select server)
+        self.busy = False
+
+        self.stats = stats
         self.timeStamp = getTimeStamp()
 
     def __repr__(self):
         return 'C:[{}, {}]'.format(self.address, self.IP)
 
+    def send(self, data):
+        ''' Send the whole of data to the client. Returns False if the client's
+            outbound queue is full and the data was refused
+        '''
+        start = self.stats.clock()
+        if self.outbound is not None:
+            sent = self.outbound.send(data)
+        else:
+            with self.sendLock:
+                self.socket.sendall(data)
+            sent = True
+        self.stats.record('send', start)
+        if sent:
+            self.stats.count('bytes_out', len(data))
+        return sent
+
+    def sendFields(self, *packets):
+        ''' Encrypts each packet (a list of fields) with the client's session key and
+            sends the frames in one send() call. Frames are encrypted and sent under
+            sendLock, so the client never receives a frame after one with a later
+            counter sealed by another thread, which could put it behind the client's
+            replay window. Returns False like send()
+        '''
+        with self.sendLock:
+            start = self.stats.clock()
+            data = b''.join(encodeSessionFrame(packet, self.sessionKey) for packet in packets)
+            self.stats.record('encrypt', start)
+            return self.send(data)
+
+    def close(self):
+        if self.outbound is not None:
+            self.outbound.close()
+        try:
+            self.socket.close()
+        except OSError:
+            pass
+
+class OutboundQueue:
+    ''' Bounded queue of frames waiting to be sent to a client over a non-blocking
+        socket. send() writes straight to the socket when nothing is queued; whatever
+        the socket does not accept is queued and written by the OutboundWriter thread
+        as the client reads, so a slow client never blocks the thread sending to it.
+
+        Once highWater bytes are queued new frames are refused until the queue drains
+        to lowWater. The overflow policy says what happens to refused frames: with
+        'spill' the caller stores them (see deliver()), with 'drop' they are discarded
+        and with 'disconnect' the connection is closed. onDrain is called when a
+        congested queue has drained.
+    '''
+    def __init__(self, conn, writer, highWater=OUTBOUND_HIGH_WATER, lowWater=OUTBOUND_LOW_WATER,
+                 overflow=OVERFLOW_POLICY, stats=NO_STATS):
+        self.socket = conn
+        self.writer = writer
+        self.highWater = highWater
+        self.lowWater = lowWater
+        self.overflow = overflow
+        self.stats = stats
+        self.onDrain = None
+
+        self.frames = deque() # Unsent data, the first item may be partly sent
+        self.queued = 0 # Bytes in frames
+        self.congested = False # Refusing frames until the queue drains to lowWater
+        self.closed = False
+        self.lock = Lock()
+
+    def send(self, data):
+        with self.lock:
+            if self.closed:
+                return False
+            if self.congested or self.queued >= self.highWater:
+                self.congested = True
+                self.stats.count('outbound_refused')
+                refused = True
+            else:
+                refused = False
+                if self.queued == 0: # Nothing queued, try to send now
+                    try:
+                        n = self.socket.send(data)
+                    except (BlockingIOError, InterruptedError):
+                        n = 0
+                    except OSError:
+                        return False # Connection lost, noticed by the receive path
+                    if n == len(data):
+                        return True
+                    data = memoryview(data)[n:]
+                self.frames.append(data)
+                self.queued += len(data)
+                if self.queued == len(data): # Queue was empty
+                    self.writer.watch(self)
+
+        if refused and self.overflow == 'disconnect':
+            self.stats.count('overflow_disconnects')
+            try:
+                self.socket.shutdown(SHUT_RDWR) # Receive path sees the connection close
+            except OSError:
+                pass
+        elif refused and self.overflow == 'drop':
+            self.stats.count('outbound_dropped')
+        return not refused
+
+    def flush(self):
+        ''' Writes queued data until the socket stops accepting it. Returns True once
+            the queue is empty (or the connection is gone)
+        '''
+        drained = False
+        with self.lock:
+            while len(self.frames) > 0:
+                data = self.frames[0]
+                try:
+                    n = self.socket.send(data)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError:
+                    self.frames.clear()
+                    self.queued = 0
+                    self.closed = True
+                    break
+                self.queued -= n
+                if n < len(data):
+                    self.frames[0] = memoryview(data)[n:]
+                    break
+                self.frames.popleft()
+
+            if self.congested and self.queued <= self.lowWater:
+                self.congested = False
+                drained = True
+            empty = len(self.frames) == 0
+
+        if drained and self.onDrain is not None:
+            self.onDrain()
+        return empty
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.frames.clear()
+            self.queued = 0
+        self.writer.watch(self) # Let the writer forget the socket
+
+class OutboundWriter:
+    ''' Thread that writes the data queued in OutboundQueues. Queues with data are
+        watched for the socket to become writable; a socket pair wakes the thread up
+        when a queue starts waiting, in the same way as HandshakePool.
+    '''
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.requests = queue.SimpleQueue() # Queues to start (or stop) watching
+        self.wakeupSocket, self.notifySocket = socketpair()
+        self.wakeupSocket.setblocking(False)
+        self.notifySocket.setblocking(False)
+        self.selector.register(self.wakeupSocket, selectors.EVENT_READ, None)
+
+        self.running = True
+        self.thread = Thread(target=outboundWriterThread, args=(self,), daemon=True)
+        self.thread.start()
+
+    def watch(self, outbound):
+        self.requests.put(outbound)
+        try:
+            self.notifySocket.send(b'\0')
+        except (BlockingIOError, OSError): # Writer already has wake ups waiting
+            pass
+
+    def close(self):
+        self.running = False
+        self.watch(None)
+        self.thread.join(1)
+        self.selector.close()
+        self.wakeupSocket.close()
+        self.notifySocket.close()
+
+class RoutingTable:
+    ''' Registry of connected clients indexed by IP address and by username, used to
+        find the destination of a forwarded message without scanning every connection.
+
+        Each index maps a key to a tuple of connections. Writers hold a lock and replace
+        the tuple instead of modifying it, so readers can look up routes without locking
+        while connections are added and removed by other threads.
+    '''
+    def __init__(self):
+        self.lock = Lock()
+        self.byIP = {}
+        self.byName = {}
+        self.clients = {} # All registered connections, keyed by socket address
+
+    def __len__(self):
+        return len(self.clients)
+
+    def __iter__(self):
+        return iter(list(self.clients.values()))
+
+    def add(self, client):
+        with self.lock:
+            self.clients[client.address] = client
+            self.byIP[client.IP] = self.byIP.get(client.IP, ()) + (client,)
+            if client.userName is not None:
+                self.byName[client.userName] = self.byName.get(client.userName, ()) + (client,)
+        return None
+
+    def bindName(self, client, username):
+        # Register a username for a connection, e.g. after the client creates an account
+        with self.lock:
+            if client.userName is not None:
+                removeRoute(self.byName, client.userName, client)
+            client.userName = username
+            if client.address in self.clients:
+                self.byName[username] = self.byName.get(username, ()) + (client,)
+        return None
+
+    def remove(self, client):
+        # Returns False if the client was not registered
+        with self.lock:
+            if self.clients.pop(client.address, None) is None:
+                return False
+            removeRoute(self.byIP, client.IP, client)
+            if client.userName is not None:
+                removeRoute(self.byName, client.userName, client)
+        return True
+
+    def lookupIP(self, IP):
+        return self.byIP.get(IP, ())
+
+    def lookupName(self, username):
+        return self.byName.get(username, ())
+
+class PublicKeyCache:
+    ''' Bounded least-recently-used cache mapping usernames to DER encoded public keys,
+        so popular public key lookups do not query the user database. Keys are added
+        when an account is created or looked up. Accounts are never changed or removed,
+        so a cached key stays valid. Its size, hits and misses are reported by the
+        server's stats as the key_cache gauge.
+    '''
+    def __init__(self, size=KEY_CACHE_SIZE):
+        self.size = size
+        self.keys = OrderedDict()
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username):
+        # Returns the cached key bytes, or None if the user is not cached
+        with self.lock:
+            pubkeyBytes = self.keys.get(username)
+            if pubkeyBytes is None:
+                self.misses += 1
+                return None
+            self.keys.move_to_end(username)
+            self.hits += 1
+            return pubkeyBytes
+
+    def contains(self, username):
+        # True if the user is cached. Not counted as a hit or miss
+        return username in self.keys
+
+    def put(self, username, pubkeyBytes):
+        with self.lock:
+            self.keys[username] = pubkeyBytes
+            self.keys.move_to_end(username)
+            if len(self.keys) > self.size: # Evict least recently used user
+                self.keys.popitem(last=False)
+        return None
+
+    def stats(self):
+        return {'size': len(self.keys), 'hits': self.hits, 'misses': self.misses}
+
+class GroupCache(PublicKeyCache):
+    ''' Bounded least-recently-used cache mapping group IDs to their member lists
+        ((username, encrypted group key) pairs), so group messages do not query the user
+        database. An entry is invalidated whenever its group is written to the database.
+    '''
+    def __init__(self, size=GROUP_CACHE_SIZE):
+        PublicKeyCache.__init__(self, size)
+
+    def invalidate(self, groupID):
+        with self.lock:
+            self.keys.pop(groupID, None)
+        return None
+
+class FanOutPool:
+    ''' Lanes of single worker threads that deliver group chat messages. A member is
+        always served by the same lane, and each lane handles its jobs in order, so
+        the members of a group are served in parallel while every member still gets
+        the group's messages in the order they were sent.
+    '''
+    def __init__(self, lanes=FANOUT_LANES):
+        self.lanes = [ThreadPoolExecutor(max_workers=1, thread_name_prefix='fanout') for i in range(lanes)]
+
+    def submit(self, server, sender, members, fields):
+        # Split the members between the lanes and deliver the group message
+        laneMembers = [[] for lane in self.lanes]
+        for member in members:
+            laneMembers[hash(member[0]) % len(self.lanes)].append(member)
+
+        futures = []
+        for lane, assigned in zip(self.lanes, laneMembers):
+            if len(assigned) > 0:
+                futures.append(lane.submit(fanOutLane, server, sender, assigned, fields))
+        return futures
+
+    def close(self):
+        for lane in self.lanes:
+            lane.shutdown(wait=False)
+        return None
+
+class PendingConnection:
+    ''' Container for a socket accepted by the event loop that has not finished the
+        handshake yet. The handshake is advanced one message at a time as the socket
+        becomes readable, so a slow client never blocks the loop.
+    '''
+    def __init__(self, conn, addr):
+        self.socket = conn
+        self.address = addr
+        self.IP = None
+        self.publicKey = None
+        self.decoder = FrameDecoder()
+
+        self.stage = 0 # 0: waiting for client hello, 1: waiting for session key, 2: X25519 hello being handled
+        self.busy = False # A handshake worker is processing this connection's last message
+        self.deadline = time.monotonic() + HANDSHAKE_TIMEOUT
+        self.started = 0 # Stats clock value when the connection was accepted
+
+    def __repr__(self):
+        return 'P:[{}, stage {}]'.format(self.address, self.stage)
+
+class HandshakePool:
+    ''' Pool of worker threads that run the RSA operations of the handshake so that the
+        thread accepting connections is never blocked by them. The cryptography module
+        releases the GIL during RSA operations, so the workers run in parallel.
+
+        The event loop submits a job with submit(); when the job finishes its result is
+        queued and a byte is written to a socket pair that the event loop watches, so the
+        loop wakes up and collects finished jobs with completed(). The select server also
+        uses a pool to handle requests that query the user database.
+    '''
+    def __init__(self, workers=HANDSHAKE_WORKERS, name='handshake'):
+        self.name = name
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        self.finished = queue.SimpleQueue()
+
+        self.wakeupSocket, self.notifySocket = socketpair()
+        self.wakeupSocket.setblocking(False)
+        self.notifySocket.setblocking(False)
+
+    def submit(self, pending, func, *args):
+        future = self.executor.submit(func, *args)
+        future.add_done_callback(lambda f: self.notify(pending, f))
+        return None
+
+    def notify(self, pending, future):
+        try:
+            result = future.result()
+        except Exception as e:
+            print('{} Error: {!r}'.format(self.name.capitalize(), e))
+            result = None
+        self.finished.put((pending, result))
+        try:
+            self.notifySocket.send(b'\0')
+        except BlockingIOError: # Event loop already has wake ups waiting
+            pass
+
+    def completed(self):
+        # Returns (pending connection, result) for every finished job
+        try:
+            while len(self.wakeupSocket.recv(4096)) > 0:
+                pass
+        except BlockingIOError:
+            pass
+
+        results = []
+        while not self.finished.empty():
+            results.append(self.finished.get())
+        return results
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.wakeupSocket.close()
+        self.notifySocket.close()
+
 class TStatus:
     ''' Thread status class used for thread execution. Determines
         if a thread is still running and is used to terminate a thread
@@ -289,15 +1296,16 @@ class ConnectionThread:
         self.socket = self.parent.socket
 
         self.status = TStatus()
-        self.thread = Thread(target=connectionThread, args=(self.socket, self.parent.addClient, self.status))
+        self.thread = Thread(target=connectionThread, args=(self.socket, self.parent.acceptClient, self.status, self.parent.handshakePool, self.parent.stats), daemon=True)
         self.thread.start()
 
     def __repr__(self):
         return 'CT[{}]'.format(self.thread.name)
 
     def close(self):
+        # The thread is blocked in accept(), so it is not joined here. It is a daemon
+        # thread and exits with the process
         self.status.terminate = True
-        self.thread.join()
 
 class ReceivingThread:
     ''' This class is a container to store a receiving thread for a particular client
@@ -328,61 +1336,425 @@ class ReceivingThread:
 class Server:
     ''' This class stores and manages all data necessary for the execution of
         the server. 
+
+        Two modes are supported. In 'select' mode (the default) every client socket is
+        multiplexed by a single event loop on the main thread. In 'threaded' mode each
+        client gets its own receiving thread and a separate thread accepts connections.
+        In both modes the handshake RSA operations run on a pool of handshake workers.
+
+        Counters and stage latencies are recorded in stats (see Stats.py). Pass
+        NO_STATS to disable them.
     '''
-    def __init__(self, serverSocket):
+    def __init__(self, serverSocket, mode='select', handshakeWorkers=HANDSHAKE_WORKERS, stats=None,
+                 highWater=OUTBOUND_HIGH_WATER, lowWater=OUTBOUND_LOW_WATER, overflow=OVERFLOW_POLICY):
         self.socket = serverSocket
+        self.mode = mode
+
+        self.stats = stats if stats is not None else Stats()
+
+        self.handshakePool = HandshakePool(handshakeWorkers)
+
+        # Long-lived connections to the user database
+        self.userDB = UserDataBasePool(DATABASE_CONNECTIONS)
+        # Recently used public keys
+        self.keyCache = PublicKeyCache(KEY_CACHE_SIZE)
+
+        # Messages waiting for offline recipients, and the threads that deliver them
+        self.outbox = Outbox()
+        self.flushPool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='outbox')
+
+        # Group chat members by group ID, loaded from the user database when first used
+        self.groups = GroupCache(GROUP_CACHE_SIZE)
+        self.fanOut = FanOutPool(FANOUT_LANES)
+
+        # Frames for clients that are not reading fast enough are queued and written
+        # by the outbound writer
+        self.outboundWriter = OutboundWriter()
+        self.outboundLimits = (highWater, lowWater, overflow)
 
-        # List of connected clients (client_connection objects)
-        self.connections = []
-        # Connection thread to accept incoming connections
-        self.connectionThread = ConnectionThread(self)
+        # Connected clients (client_connection objects) indexed for message routing
+        self.routes = RoutingTable()
 
         self.receivingThreads = []
+        # Receiving threads that have finished and are waiting to be joined
+        self.finishedThreads = queue.Queue()
 
-    def addClient(self, connection, address, IP, pubkey, sKey):
-        client = Client_Connection(connection, address, IP, pubkey, sKey)
-        self.connections.append(client)
+        self.stats.gauge('connected_clients', lambda: len(self.routes))
+        self.stats.gauge('outbox_messages', lambda: sum(self.outbox.counts.values()))
+        self.stats.gauge('key_cache', self.keyCache.stats)
+        self.stats.gauge('group_cache', self.groups.stats)
+
+        self.status = TStatus()
+        if self.mode == 'threaded':
+            # Connection thread to accept incoming connections
+            self.connectionThread = ConnectionThread(self)
+        else:
+            self.connectionThread = None
+            self.selector = selectors.DefaultSelector()
+            # Sockets that are still in the middle of the handshake
+            self.pending = {}
+            # Workers for requests that query the user database, so the event loop never waits on it
+            self.databasePool = HandshakePool(DATABASE_CONNECTIONS, 'database')
+
+    def acceptClient(self, connection, address, IP, pubkey, sKey, decoder=None):
+        # Called by the threaded server's handshake workers, which look up the username
+        # of the client's account before handing over the connection
+        return self.addClient(connection, address, IP, pubkey, sKey, decoder, findUserName(self.userDB, pubkey))
+
+    def addClient(self, connection, address, IP, pubkey, sKey, decoder=None, userName=None):
+        # userName is the name of the account that owns pubkey, found by the handshake workers
+        client = Client_Connection(connection, address, IP, pubkey, sKey, decoder, self.stats)
+        client.userName = userName
+        connection.setblocking(False)
+        highWater, lowWater, overflow = self.outboundLimits
+        client.outbound = OutboundQueue(connection, self.outboundWriter, highWater, lowWater, overflow, self.stats)
+        client.outbound.onDrain = lambda: startFlush(self, client)
+
+        pubkeyBytes = RSA_get_bytes_from_key(pubkey)
+
+        # Give the client a ticket so it can reconnect without the RSA handshake
+        ticket, secret = createTicket(IP, pubkeyBytes, sessionTransport(sKey))
+        try:
+            client.sendFields([b'110', ticket, secret, str(TICKET_LIFETIME)])
+            # Optional requests this server handles
+            client.sendFields([b'130', packFields(SERVER_FEATURES)])
+        except OSError:
+            pass # Lost connection is noticed by the receive path
+
+        # Messages stored while the client was offline are delivered before any new ones
+        client.flushing = self.outbox.pending(IP) > 0
+
+        self.routes.add(client)
         print('New Connection: {} at time: {}'.format(client, getTimeStamp()))
 
-        rThread = ReceivingThread(self, client)
-        self.receivingThreads.append(rThread)
+        if client.flushing:
+            startFlush(self, client)
 
-    def removeClient(self, client, rt):
-        try:
-            self.connections.remove(client)
+        if self.mode == 'threaded':
+            rThread = ReceivingThread(self, client)
+            self.receivingThreads.append(rThread)
+        else:
+            self.selector.register(connection, selectors.EVENT_READ, client)
+            if client.decoder.pending() > 0: # Frames sent together with the handshake
+                self.handleFrames(client)
+        return client
+
+    def getGroup(self, groupID):
+        # Returns the list of (username, encrypted group key) for a group, or None
+        members = self.groups.get(groupID)
+        if members is None:
+            with self.userDB.connection() as db:
+                members = db.getGroupMembers(groupID)
+            if members is not None:
+                self.groups.put(groupID, members)
+        return members
+
+    def removeClient(self, client, rt=None):
+        self.stats.count('disconnects')
+        if self.routes.remove(client):
             print('Client: {} Disconnected at: {}'.format(client, getTimeStamp()))
-        except Exception:
+        else:
             print("Remove Client Error: {} not in list".format(client))
 
+        if rt is not None: # Let run() join the receiving thread
+            self.finishedThreads.put(rt)
+        else:
+            self.selector.unregister(client.socket)
+            client.close()
+
     def run(self):
         try:
-            while True:
-                for rt in self.receivingThreads:
-                    if rt.status.terminate:
-                        self.receivingThreads.remove(rt)
-                        rt.close()
+            if self.mode == 'threaded':
+                self.runThreaded()
+            else:
+                self.runEventLoop()
         finally:
             self.exit()
 
+    def runThreaded(self):
+        # Block until a receiving thread finishes, then join it
+        while not self.status.terminate:
+            rt = self.finishedThreads.get()
+            if rt in self.receivingThreads:
+                self.receivingThreads.remove(rt)
+            rt.close()
+            rt.client.close()
+
+    def runEventLoop(self):
+        self.socket.setblocking(False)
+        self.selector.register(self.socket, selectors.EVENT_READ, None)
+        self.selector.register(self.handshakePool.wakeupSocket, selectors.EVENT_READ, self.handshakePool)
+        self.selector.register(self.databasePool.wakeupSocket, selectors.EVENT_READ, self.databasePool)
+
+        while not self.status.terminate:
+            # Block until a socket is ready. Only wake up on a timer while a handshake
+            # is pending so that it can be expired
+            wait = None
+            if len(self.pending) > 0:
+                wait = max(0, min(p.deadline for p in self.pending.values()) - time.monotonic())
+
+            for key, mask in self.selector.select(wait):
+                if key.data is None:
+                    self.acceptClients()
+                elif key.data is self.handshakePool:
+                    self.finishHandshakes()
+                elif key.data is self.databasePool:
+                    self.finishRequests()
+                elif isinstance(key.data, PendingConnection):
+                    self.advanceHandshake(key.data)
+                else:
+                    self.readClient(key.data)
+
+            self.expireHandshakes()
+
+    def acceptClients(self):
+        # Accept every connection waiting in the listen backlog
+        while True:
+            try:
+                connection, addr = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return None
+            print('Connection: {}'.format(addr))
+            self.stats.count('connections')
+            connection.settimeout(HANDSHAKE_TIMEOUT)
+            pending = PendingConnection(connection, addr)
+            pending.started = self.stats.clock(always=True)
+            self.pending[connection] = pending
+            self.selector.register(connection, selectors.EVENT_READ, pending)
+
+    def advanceHandshake(self, pending):
+        # Receive handshake data from a socket that is ready to read
+        try:
+            n = pending.decoder.recvFrom(pending.socket)
+            self.stats.count('bytes_in', n)
+            if n == 0: # Client closed the connection
+                self.closePending(pending)
+                return None
+            self.startHandshakeStep(pending)
+        except (OSError, ProtocolError):
+            self.closePending(pending)
+
+    def startHandshakeStep(self, pending):
+        # Hand the next complete handshake message to the handshake workers
+        if pending.busy: # Previous message is still being processed
+            return None
+        frame = pending.decoder.nextFrame()
+        if frame is None: # Rest of the handshake message has not arrived yet
+            return None
+
+        # The last step of every handshake also looks up the client's username
+        pending.busy = True
+        if pending.stage == 0 and isResumption(frame):
+            pending.stage = 3
+            self.handshakePool.submit(pending, finishHandshake, self.userDB, None, resumeSession, frame, pending.address)
+        elif pending.stage == 0 and isX25519Hello(frame):
+            pending.stage = 2
+            self.handshakePool.submit(pending, finishHandshake, self.userDB, None, acceptX25519Hello, frame, pending.address)
+        elif pending.stage == 0:
+            self.handshakePool.submit(pending, verifyClientHello, frame, pending.address)
+        else:
+            self.handshakePool.submit(pending, finishHandshake, self.userDB, pending.publicKey, readSessionKey, frame, pending.publicKey)
+
+    def finishHandshakes(self):
+        # Run the next step of the handshake for connections whose worker job finished
+        for pending, result in self.handshakePool.completed():
+            if self.pending.get(pending.socket) is not pending: # Timed out while in the pool
+                continue
+            pending.busy = False
+            if result is None and pending.stage == 3: # Ticket invalid or expired
+                self.stats.count('resumption_failures')
+                try:
+                    pending.socket.sendall(encodeFrame(FRAME_HANDSHAKE, [b'55']))
+                except OSError:
+                    pass
+                self.closePending(pending)
+                continue
+            elif result is None:
+                self.stats.count('handshake_failures')
+                self.closePending(pending)
+                continue
+
+            connection = pending.socket
+            try:
+                if pending.stage == 0:
+                    pending.IP, pending.publicKey = result
+                    connection.sendall(createServerHello())
+                    pending.stage = 1
+                    pending.deadline = time.monotonic() + HANDSHAKE_TIMEOUT
+                    self.startHandshakeStep(pending)
+                elif pending.stage == 3: # Resumed with a ticket
+                    (IP, publicKey, sessionKey, reply), userName = result
+                    connection.sendall(reply)
+                    self.closePending(pending, close=False)
+                    self.stats.record('resumption', pending.started)
+                    self.stats.count('resumptions')
+                    self.addClient(connection, pending.address, IP, publicKey, sessionKey, pending.decoder, userName)
+                elif pending.stage == 2: # X25519 handshake, completed by the client hello
+                    (IP, publicKey, sessionKey, reply), userName = result
+                    connection.sendall(reply)
+                    self.closePending(pending, close=False)
+                    self.stats.record('handshake', pending.started)
+                    self.stats.count('handshakes')
+                    self.stats.count('x25519_handshakes')
+                    self.addClient(connection, pending.address, IP, publicKey, sessionKey, pending.decoder, userName)
+                else:
+                    sessionKey, userName = result
+                    self.closePending(pending, close=False)
+                    self.stats.record('handshake', pending.started)
+                    self.stats.count('handshakes')
+                    self.addClient(connection, pending.address, pending.IP, pending.publicKey, sessionKey, pending.decoder, userName)
+            except (OSError, ProtocolError):
+                self.stats.count('handshake_failures')
+                self.closePending(pending)
+
+    def expireHandshakes(self):
+        now = time.monotonic()
+        for pending in [p for p in self.pending.values() if p.deadline <= now]:
+            print("timeout")
+            self.stats.count('handshake_timeouts')
+            self.closePending(pending)
+
+    def closePending(self, pending, close=True):
+        del self.pending[pending.socket]
+        self.selector.unregister(pending.socket)
+        if close:
+            pending.socket.close()
+
+    def readClient(self, client):
+        # Receive data from a connected client and handle every complete frame
+        try:
+            n = client.decoder.recvFrom(client.socket)
+        except (BlockingIOError, InterruptedError, timeout):
+            return None
+        except OSError:
+            n = 0
+        self.stats.count('bytes_in', n)
+
+        if n == 0:
+            print('Lost connection with: {}'.format(client))
+            self.removeClient(client)
+        else:
+            self.handleFrames(client)
+
+    def handleFrames(self, client):
+        # Handle the client's complete frames in order. A request that may query the user
+        # database is handed to the database workers, and the client's later frames wait
+        # until it has been handled (see finishRequests)
+        try:
+            while not client.busy:
+                frame = client.decoder.nextFrame()
+                if frame is None:
+                    return None
+                fields = readPacket(self, client, frame)
+                if fields is None:
+                    continue
+                if fields[0] == b'250': # Several requests sent as one frame
+                    handler, requests = handleBatch, unpackBatch(self, fields)
+                    queryDB = any(usesDatabase(self, request) for request in requests)
+                else:
+                    handler, requests = handleRequest, fields
+                    queryDB = usesDatabase(self, fields)
+
+                if queryDB:
+                    client.busy = True
+                    self.databasePool.submit(client, handler, self, client, requests)
+                elif not handler(self, client, requests):
+                    self.removeClient(client)
+                    return None
+        except REQUEST_ERRORS as e:
+            print('Protocol Error from {}: {!r}'.format(client, e))
+            self.stats.count('protocol_errors')
+            self.removeClient(client)
+
+    def finishRequests(self):
+        # Carry on with the frames of clients whose database request has been handled
+        for client, connected in self.databasePool.completed():
+            client.busy = False
+            if client.socket.fileno() < 0: # Disconnected while the request was handled
+                continue
+            if connected is None: # Request was malformed
+                self.stats.count('protocol_errors')
+                self.removeClient(client)
+            elif not connected:
+                self.removeClient(client)
+            else:
+                self.handleFrames(client)
+
     def exit(self):
-        self.connectionThread.close()
+        self.status.terminate = True
+        if self.connectionThread is not None:
+            self.connectionThread.close()
         
         for rThread in self.receivingThreads:
-            rThread.close()
+            rThread.status.terminate = True
 
-        for conn in self.connections:
+        for conn in self.routes:
             conn.close()
+
+        for rThread in self.receivingThreads:
+            rThread.thread.join()
+
+        self.handshakePool.close()
+        if self.mode != 'threaded':
+            self.databasePool.close()
+        self.flushPool.shutdown(wait=False)
+        self.fanOut.close()
+        self.outboundWriter.close()
+        self.outbox.close()
+        self.userDB.close()
+        self.stats.close()
 # ================================================================================================================
 
 # ===================================================== Main =====================================================
-def startServer():
+def startServer(mode='select', backlog=LISTEN_BACKLOG, handshakeWorkers=HANDSHAKE_WORKERS,
+                stats=True, statsPort=STATS_PORT, statsInterval=STATS_INTERVAL, statsPath=STATS_PATH,
+                port=serverPort, highWater=OUTBOUND_HIGH_WATER, lowWater=OUTBOUND_LOW_WATER,
+                overflow=OVERFLOW_POLICY):
+    serverSocket = createServerSocket(port, backlog)
+
+    serverStats = NO_STATS
+    if stats:
+        serverStats = Stats()
+        if statsPort > 0: # Local-only stats socket
+            print('Stats available at 127.0.0.1:{}'.format(serverStats.serve(statsPort)))
+        if statsInterval > 0: # Periodic JSON dump
+            serverStats.dump(statsPath, statsInterval)
+
     print('Server is ready')
-    s = Server(serverSocket)
+    s = Server(serverSocket, mode, handshakeWorkers, serverStats, highWater, lowWater, overflow)
     s.run()
     return None
 
 def main():
-    startServer()
+    parser = argparse.ArgumentParser(description='Secure messenger server')
+    parser.add_argument('--threaded', action='store_true',
+                        help='use one thread per client instead of the event loop')
+    parser.add_argument('--port', type=int, default=serverPort,
+                        help='port clients connect to')
+    parser.add_argument('--backlog', type=int, default=LISTEN_BACKLOG,
+                        help='listen backlog for pending connections')
+    parser.add_argument('--handshake-workers', type=int, default=HANDSHAKE_WORKERS,
+                        help='number of threads running handshakes')
+    parser.add_argument('--high-water', type=int, default=OUTBOUND_HIGH_WATER,
+                        help='bytes queued for a client before new frames are refused')
+    parser.add_argument('--low-water', type=int, default=OUTBOUND_LOW_WATER,
+                        help='bytes a full queue must drain to before frames are accepted again')
+    parser.add_argument('--overflow', choices=OVERFLOW_POLICIES, default=OVERFLOW_POLICY,
+                        help='what to do with messages for a client whose queue is full')
+    parser.add_argument('--no-stats', action='store_true',
+                        help='do not collect statistics')
+    parser.add_argument('--stats-port', type=int, default=STATS_PORT,
+                        help='local port serving statistics as JSON (0 to disable)')
+    parser.add_argument('--stats-interval', type=int, default=STATS_INTERVAL,
+                        help='seconds between writes of the statistics file (0 to disable)')
+    parser.add_argument('--stats-file', default=STATS_PATH,
+                        help='file the statistics are written to')
+    args = parser.parse_args()
+
+    mode = 'threaded' if args.threaded else 'select'
+    startServer(mode, args.backlog, args.handshake_workers,
+                not args.no_stats, args.stats_port, args.stats_interval, args.stats_file, args.port,
+                args.high_water, args.low_water, args.overflow)
     return None
 
 if __name__ == "__main__":
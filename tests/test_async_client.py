@@ -0,0 +1,49 @@
+'''
+    Tests for the asyncio client (AsyncClient.py): the reader task ending the connection
+    cleanly when handling a frame fails.
+
+    Run from the repository root with:
+
+            python -m pytest tests
+'''
+
+import asyncio
+import os
+import unittest
+from socket import socketpair
+
+from AsyncClient import *
+
+# ================================================================================================================
+
+# ================================================= Reader Task ==================================================
+class ReceiveTaskTest(unittest.TestCase):
+    def test_unexpected_error_ends_connection(self):
+        # Requests waiting for a reply fail, and the decrypt task ends, instead of the
+        # reader task stopping without a word
+        async def run():
+            key = os.urandom(32)
+            clientSocket, serverSocket = socketpair()
+            with serverSocket:
+                client = AsyncClient(address=('127.0.0.1', 1))
+                client.reader, client.writer = await asyncio.open_connection(sock=clientSocket)
+                client.sessionKey = AEADSession(key, TRANSPORT_AESGCM, initiator=True)
+                client.connected = True
+                client.status = None # Handling any reply fails
+                requestID, future = client.pending.add(b'200')
+
+                received = asyncio.Queue()
+                task = asyncio.get_running_loop().create_task(client.receive(FrameDecoder(), received))
+                serverSession = AEADSession(key, TRANSPORT_AESGCM, initiator=False)
+                serverSocket.sendall(encodeSessionFrame([b'50', requestID], serverSession))
+                await asyncio.wait_for(task, 5)
+
+                self.assertFalse(client.connected)
+                self.assertIsNone(received.get_nowait())
+                self.assertIsInstance(future.exception(0), ConnectionError)
+                self.assertEqual(serverSocket.recv(1), b'') # Connection closed
+        asyncio.run(run())
+# ================================================================================================================
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+'''
+    Tests for the message ciphers (cipher.py): the hash ratchet and hybrid RSA encryption.
+
+    Run from the repository root with:
+
+            python -m pytest tests
+'''
+
+import os
+import unittest
+
+from cipher import *
+
+# ================================================================================================================
+
+# ================================================= Hash Ratchet =================================================
+def chainPair():
+    # Sending chain and the receiving end of the same chain
+    chain = HashRatchet()
+    return chain, ReceivingRatchet(HashRatchet.from_bytes(chain.to_bytes()))
+
+def sendMessage(chain, message):
+    # (index, header, ciphertext) of the chain's next message
+    index, header = chain.index, chain.header()
+    return index, header, ratchet_encrypt(message, chain.step(), header)
+
+class HashRatchetTest(unittest.TestCase):
+    def test_in_order(self):
+        chain, receiver = chainPair()
+        for i in range(10):
+            self.assertEqual(receiver.open(*sendMessage(chain, 'm{}'.format(i))), 'm{}'.format(i).encode())
+        self.assertEqual(receiver.chain.index, 10)
+        self.assertEqual(receiver.skipped, {})
+
+    def test_every_message_key_differs(self):
+        chain = HashRatchet()
+        keys = [chain.step() for i in range(100)]
+        self.assertEqual(len(set(keys)), 100)
+
+    def test_out_of_order(self):
+        chain, receiver = chainPair()
+        messages = [sendMessage(chain, str(i)) for i in range(6)]
+        for i in (4, 0, 5, 2, 1, 3):
+            self.assertEqual(receiver.open(*messages[i]), str(i).encode())
+        self.assertEqual(receiver.skipped, {})
+
+    def test_skipped_message_arrives_late(self):
+        chain, receiver = chainPair()
+        messages = [sendMessage(chain, str(i)) for i in range(4)]
+        self.assertEqual(receiver.open(*messages[3]), b'3')
+        self.assertEqual(sorted(receiver.skipped), [0, 1, 2])
+        self.assertEqual(receiver.open(*messages[1]), b'1')
+        self.assertEqual(sorted(receiver.skipped), [0, 2])
+
+    def test_replay(self):
+        chain, receiver = chainPair()
+        messages = [sendMessage(chain, str(i)) for i in range(3)]
+        self.assertEqual(receiver.open(*messages[2]), b'2')
+        self.assertEqual(receiver.open(*messages[0]), b'0')
+        self.assertIsNone(receiver.open(*messages[2])) # Newest message
+        self.assertIsNone(receiver.open(*messages[0])) # Skipped message, already received
+
+    def test_too_far_ahead(self):
+        chain, receiver = chainPair()
+        messages = [sendMessage(chain, str(i)) for i in range(RATCHET_MAX_SKIP + 2)]
+        self.assertIsNone(receiver.open(*messages[RATCHET_MAX_SKIP + 1]))
+        self.assertEqual(receiver.chain.index, 0)
+        self.assertEqual(receiver.open(*messages[RATCHET_MAX_SKIP]), str(RATCHET_MAX_SKIP).encode())
+
+    def test_skipped_keys_are_bounded(self):
+        chain, receiver = chainPair()
+        messages = [sendMessage(chain, str(i)) for i in range(RATCHET_MAX_SKIP + 11)]
+        receiver.open(*messages[RATCHET_MAX_SKIP])
+        receiver.open(*messages[-1]) # Skips 10 more messages
+        self.assertEqual(len(receiver.skipped), RATCHET_MAX_SKIP)
+        self.assertIsNone(receiver.open(*messages[0])) # Oldest skipped keys were dropped
+        self.assertEqual(receiver.open(*messages[10]), b'10')
+
+    def test_forged_message_does_not_move_chain(self):
+        chain, receiver = chainPair()
+        index, header, ciphertext = sendMessage(chain, 'genuine')
+        forged = bytearray(ciphertext)
+        forged[0] ^= 1
+        self.assertIsNone(receiver.open(index + 5, header, bytes(forged)))
+        self.assertIsNone(receiver.open(index, header, bytes(forged)))
+        self.assertEqual((receiver.chain.index, receiver.skipped), (0, {}))
+        self.assertEqual(receiver.open(index, header, ciphertext), b'genuine')
+
+    def test_header_is_authenticated(self):
+        chain, receiver = chainPair()
+        index, header, ciphertext = sendMessage(chain, 'message')
+        other = HashRatchet(chainID=bytes(RATCHET_ID_SIZE)).header()
+        self.assertIsNone(receiver.open(index, other, ciphertext))
+        self.assertEqual(receiver.open(index, header, ciphertext), b'message')
+
+    def test_chain_serialization(self):
+        chain = HashRatchet()
+        chain.step()
+        copy = HashRatchet.from_bytes(chain.to_bytes())
+        self.assertEqual((copy.chainKey, copy.chainID, copy.index), (chain.chainKey, chain.chainID, 1))
+        self.assertEqual(ratchet_parse_header(chain.header()), (chain.chainID, 1))
+        self.assertIsNone(HashRatchet.from_bytes(None))
+        self.assertIsNone(HashRatchet.from_bytes(chain.to_bytes()[:-1]))
+        self.assertIsNone(ratchet_parse_header(chain.header()[:-1]))
+# ================================================================================================================
+
+# ================================================= Hybrid RSA ===================================================
+SEGMENT = AEAD_SEGMENT_SIZE + AEAD_TAG_SIZE # Size of one encrypted segment
+
+class HybridRSATest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.privKey = RSA_gen_priv_key()
+        cls.pubKey = RSA_get_pub_from_priv(cls.privKey)
+        cls.otherKey = RSA_gen_priv_key()
+
+    def test_round_trip(self):
+        # Empty, longer than one RSA block, and one or more segments long
+        sizes = (0, 1, RSA_max_message_size(self.pubKey) + 1, AEAD_SEGMENT_SIZE, AEAD_SEGMENT_SIZE + 1, 3 * AEAD_SEGMENT_SIZE + 5)
+        for size in sizes:
+            message = os.urandom(size)
+            encKey, prefix, ciphertext = RSA_hybrid_encrypt(message, self.pubKey)
+            self.assertEqual(len(ciphertext), size + max(1, -(-size // AEAD_SEGMENT_SIZE)) * AEAD_TAG_SIZE)
+            self.assertEqual(RSA_hybrid_decrypt(encKey, prefix, ciphertext, self.privKey), message)
+
+    def test_string_message(self):
+        encrypted = RSA_hybrid_encrypt('héllo' * 100, self.pubKey)
+        self.assertEqual(RSA_hybrid_decrypt(*encrypted, self.privKey), 'héllo'.encode() * 100)
+
+    def test_tampered_message(self):
+        encKey, prefix, ciphertext = RSA_hybrid_encrypt(os.urandom(2 * AEAD_SEGMENT_SIZE + 10), self.pubKey)
+        for position in (0, SEGMENT - 1, SEGMENT + 5, len(ciphertext) - 1):
+            tampered = bytearray(ciphertext)
+            tampered[position] ^= 1
+            self.assertIsNone(RSA_hybrid_decrypt(encKey, prefix, bytes(tampered), self.privKey))
+
+    def test_segments_cut_or_reordered(self):
+        encKey, prefix, ciphertext = RSA_hybrid_encrypt(os.urandom(3 * AEAD_SEGMENT_SIZE), self.pubKey)
+        segments = [ciphertext[i:i + SEGMENT] for i in range(0, len(ciphertext), SEGMENT)]
+        self.assertEqual(len(segments), 3)
+        for altered in (segments[:2], segments[1:], [segments[1], segments[0], segments[2]], segments + segments[2:]):
+            self.assertIsNone(RSA_hybrid_decrypt(encKey, prefix, b''.join(altered), self.privKey))
+
+    def test_wrong_key_or_prefix(self):
+        encKey, prefix, ciphertext = RSA_hybrid_encrypt(b'message', self.pubKey)
+        self.assertIsNone(RSA_hybrid_decrypt(encKey, prefix, ciphertext, self.otherKey))
+        tamperedKey = bytearray(encKey)
+        tamperedKey[10] ^= 1
+        self.assertIsNone(RSA_hybrid_decrypt(bytes(tamperedKey), prefix, ciphertext, self.privKey))
+        self.assertIsNone(RSA_hybrid_decrypt(encKey, bytes(AEAD_STREAM_PREFIX_SIZE), ciphertext, self.privKey))
+        self.assertIsNone(RSA_hybrid_decrypt(encKey, prefix[:-1], ciphertext, self.privKey))
+
+    def test_key_for_another_size(self):
+        # A key that is not 32 bytes, encrypted with the right public key, is rejected
+        encKey, prefix, ciphertext = RSA_hybrid_encrypt(b'message', self.pubKey)
+        self.assertIsNone(RSA_hybrid_decrypt(RSA_public_key_encrypt(bytes(16), self.pubKey), prefix, ciphertext, self.privKey))
+# ================================================================================================================
+
+if __name__ == '__main__':
+    unittest.main()
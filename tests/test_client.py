@@ -0,0 +1,281 @@
+'''
+    Tests for the client (Client.py): replies matched to requests, batching of sent
+    requests and the fallback to the RSA handshake.
+
+    Run from the repository root with:
+
+            python -m pytest tests
+'''
+
+import os
+import tempfile
+import time
+import unittest
+from socket import socketpair
+from threading import Thread
+
+from Client import *
+
+# ================================================================================================================
+
+# =============================================== Pending Requests ===============================================
+class PendingRequestsTest(unittest.TestCase):
+    def test_reply_completes_request(self):
+        pending = PendingRequests()
+        requestID, future = pending.add(b'200')
+        self.assertFalse(future.done())
+        self.assertTrue(pending.complete(requestID, [b'50']))
+        self.assertIs(future.result(0), True)
+        self.assertEqual(pending.requests, {})
+
+    def test_reply_results(self):
+        pending = PendingRequests()
+        results = []
+        replies = [(b'200', [b'51']), (b'200', [b'52']), (b'10', [b'55']), (b'20', [b'20', b'key', b'0']), (b'20', [b'55'])]
+        for requestType, reply in replies:
+            requestID, future = pending.add(requestType)
+            pending.complete(requestID, reply)
+            results.append(future.result(0))
+        self.assertEqual(results, [True, False, False, b'key', None])
+
+    def test_ids_are_unique(self):
+        pending = PendingRequests()
+        ids = [pending.add(b'200')[0] for i in range(1000)]
+        self.assertEqual(len(set(ids)), 1000)
+
+    def test_unexpected_reply(self):
+        # A reply must echo a known ID and have a code its request's type expects
+        pending = PendingRequests()
+        requestID, future = pending.add(b'200')
+        self.assertFalse(pending.complete(b'not an ID', [b'50']))
+        self.assertFalse(pending.complete(requestID, [b'20', b'key', b'0']))
+        self.assertFalse(pending.complete(requestID, []))
+        self.assertFalse(future.done())
+        self.assertTrue(pending.complete(requestID, [b'50']))
+        self.assertFalse(pending.complete(requestID, [b'50'])) # Completed once
+
+    def test_timeout(self):
+        pending = PendingRequests()
+        expiredID, expired = pending.add(b'200', timeout=0)
+        waitingID, waiting = pending.add(b'200', timeout=60)
+        pending.expire()
+        with self.assertRaises(TimeoutError):
+            expired.result(0)
+        self.assertFalse(waiting.done())
+        self.assertFalse(pending.complete(expiredID, [b'50'])) # Reply arrived too late
+        self.assertTrue(pending.complete(waitingID, [b'50']))
+
+    def test_expiry_checks_are_limited(self):
+        pending = PendingRequests()
+        pending.expire()
+        requestID, future = pending.add(b'200', timeout=0)
+        pending.expire() # Checked less than half a second ago
+        self.assertFalse(future.done())
+        pending.nextExpiry = 0
+        pending.expire()
+        self.assertTrue(future.done())
+
+    def test_fail_all(self):
+        pending = PendingRequests()
+        futures = [pending.add(b'200')[1] for i in range(3)]
+        pending.failAll(ConnectionError('closed'))
+        for future in futures:
+            with self.assertRaises(ConnectionError):
+                future.result(0)
+        self.assertEqual(pending.requests, {})
+# ================================================================================================================
+
+# ================================================== Send Queue ==================================================
+def messagePacket(i, pending):
+    # Message request registered with pending, and its Future
+    requestID, future = pending.add(b'200')
+    return [b'200', b'1.2.3.4', b'bob', b'0', b'0', b'0', str(i).encode(), requestID], requestID, future
+
+class SendQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.clientSocket, self.serverSocket = socketpair()
+        self.serverSocket.settimeout(5)
+        key = os.urandom(32)
+        self.clientSession = AEADSession(key, TRANSPORT_AESGCM, initiator=True)
+        self.serverSession = AEADSession(key, TRANSPORT_AESGCM, initiator=False)
+        self.decoder = FrameDecoder()
+
+        self.status = RThreadStatus()
+        self.status.pending = PendingRequests()
+        self.status.features = {FEATURE_BATCH}
+        self.queues = []
+
+    def tearDown(self):
+        for queue in self.queues:
+            queue.close()
+        self.clientSocket.close()
+        self.serverSocket.close()
+
+    def sendQueue(self, window=0.05, limit=SEND_BATCH_BYTES):
+        queue = SendQueue(self.clientSocket, self.clientSession, self.status, window, limit)
+        self.queues.append(queue)
+        return queue
+
+    def receive(self):
+        # Fields of the next frame the server receives
+        frame = recvFrame(self.serverSocket, self.decoder)
+        return self.serverSession.open(frame[1])
+
+    def batchRequests(self, fields):
+        # Requests carried by a batch request
+        self.assertEqual(fields[0], b'250')
+        return [unpackFields(packet) for packet in unpackFields(fields[1])]
+
+    def test_idle_sends_immediately(self):
+        queue = self.sendQueue(window=60)
+        packet, requestID, future = messagePacket(0, self.status.pending)
+        queue.queue(packet, requestID, future)
+        self.assertEqual(self.receive(), packet)
+
+    def test_batch_while_in_flight(self):
+        queue = self.sendQueue()
+        packets = [messagePacket(i, self.status.pending) for i in range(6)]
+        for packet, requestID, future in packets:
+            queue.queue(packet, requestID, future)
+        self.assertEqual(self.receive(), packets[0][0]) # Nothing was in flight
+        self.assertEqual(self.batchRequests(self.receive()), [packet for packet, requestID, future in packets[1:]])
+
+    def test_sent_alone_once_acknowledged(self):
+        queue = self.sendQueue(window=60)
+        first, requestID, future = messagePacket(0, self.status.pending)
+        queue.queue(first, requestID, future)
+        self.status.pending.complete(requestID, [b'50'])
+        second, requestID, future = messagePacket(1, self.status.pending)
+        queue.queue(second, requestID, future)
+        self.assertEqual([self.receive(), self.receive()], [first, second])
+
+    def test_batch_limit(self):
+        # A full batch is sent without waiting for the window to end
+        queue = self.sendQueue(window=60, limit=200)
+        packets = [messagePacket(i, self.status.pending) for i in range(10)]
+        start = time.monotonic()
+        for packet, requestID, future in packets:
+            queue.queue(packet, requestID, future)
+        self.receive()
+        requests = self.batchRequests(self.receive())
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertGreater(sum(len(packFields(request)) for request in requests), 200 - len(packFields(packets[1][0])))
+        self.assertEqual(requests, [packet for packet, requestID, future in packets[1:1 + len(requests)]])
+
+    def test_large_message_sent_alone_in_order(self):
+        queue = self.sendQueue(window=60)
+        first, second = messagePacket(0, self.status.pending), messagePacket(1, self.status.pending)
+        large, requestID, future = messagePacket(2, self.status.pending)
+        large[6] = b'x' * SEND_BATCH_BYTES
+        for packet in (first, second, (large, requestID, future)):
+            queue.queue(*packet)
+        # Queued messages are flushed before the large message
+        self.assertEqual([self.receive(), self.receive(), self.receive()], [first[0], second[0], large])
+
+    def test_other_requests_sent_after_queued_messages(self):
+        # A request sent while messages are queued does not overtake them
+        queue = self.sendQueue(window=60)
+        packets = [messagePacket(i, self.status.pending) for i in range(3)]
+        for packet, requestID, future in packets:
+            queue.queue(packet, requestID, future)
+        requestID, future = self.status.pending.add(b'20')
+        request = public_key_packet(b'bob', b'1.2.3.4', requestID)
+        self.assertTrue(queue.send(request))
+        self.assertEqual(self.receive(), packets[0][0])
+        self.assertEqual(self.batchRequests(self.receive()), [packet for packet, requestID, future in packets[1:]])
+        self.assertEqual(self.receive(), request)
+
+    def test_server_without_batches(self):
+        self.status.features = set()
+        queue = self.sendQueue()
+        packets = [messagePacket(i, self.status.pending) for i in range(3)]
+        for packet, requestID, future in packets:
+            queue.queue(packet, requestID, future)
+        self.assertEqual([self.receive() for i in range(3)], [packet for packet, requestID, future in packets])
+
+    def test_close_sends_queued_requests(self):
+        queue = self.sendQueue(window=60)
+        packets = [messagePacket(i, self.status.pending) for i in range(3)]
+        for packet, requestID, future in packets:
+            queue.queue(packet, requestID, future)
+        queue.close()
+        self.receive()
+        self.assertEqual(len(self.batchRequests(self.receive())), 2)
+
+    def test_send_failure_fails_requests(self):
+        queue = self.sendQueue()
+        self.serverSocket.close()
+        packets = [messagePacket(i, self.status.pending) for i in range(3)]
+        for packet, requestID, future in packets:
+            queue.queue(packet, requestID, future)
+        self.assertEqual([future.result(5) for packet, requestID, future in packets], [False] * 3)
+# ================================================================================================================
+
+# ============================================== Handshake Fallback ==============================================
+def closingServer():
+    # Listening socket whose connections are closed once the client's hello is received
+    listener = socket(AF_INET, SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen()
+    def run():
+        while True:
+            try:
+                conn, address = listener.accept()
+            except OSError: # Listener closed
+                return None
+            conn.recv(65536)
+            conn.close()
+    Thread(target=run, daemon=True).start()
+    return listener
+
+class HandshakeFallbackTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.cwd = os.getcwd()
+        os.chdir(cls.directory.name) # Keys are created in the temporary directory
+        os.mkdir('data')
+        cls.keys = KEY_RING.keys()
+        KEY_RING.identity(cls.keys[1])
+
+    @classmethod
+    def tearDownClass(cls):
+        os.chdir(cls.cwd)
+        cls.directory.cleanup()
+
+    def x25519Handshake(self, reply):
+        # Result of an X25519 hello answered with reply before the server closes the connection
+        clientSocket, serverSocket = socketpair()
+        self.addCleanup(clientSocket.close)
+        with serverSocket:
+            serverSocket.sendall(reply)
+            serverSocket.shutdown(SHUT_WR)
+            clientSocket.settimeout(5)
+            return x25519_handshake(clientSocket, FrameDecoder(), '10.0.0.1', self.keys, AEAD_TRANSPORTS)
+
+    def test_closed_without_reply(self):
+        self.assertIs(self.x25519Handshake(b''), False)
+
+    def test_closed_during_reply(self):
+        self.assertIsNone(self.x25519Handshake(encodeFrame(FRAME_HANDSHAKE, [b'101'])[:3]))
+
+    def test_not_pinned_when_rsa_fails(self):
+        # A server that closes every connection is not taken for an RSA-only server
+        listener = closingServer()
+        self.addCleanup(listener.close)
+        address = listener.getsockname()
+        self.assertIsNone(connectToServer(address, '10.0.0.1', self.keys))
+        self.assertNotIn(address, RSA_ONLY_SERVERS)
+        self.assertEqual(first_handshake(address, HANDSHAKE_X25519), HANDSHAKE_X25519)
+
+    def test_pin_expires(self):
+        address = ('127.0.0.1', 1)
+        self.addCleanup(RSA_ONLY_SERVERS.pop, address, None)
+        pin_rsa_only(address)
+        self.assertEqual(first_handshake(address, HANDSHAKE_X25519), HANDSHAKE_RSA)
+        RSA_ONLY_SERVERS[address] = time.monotonic() - 1
+        self.assertEqual(first_handshake(address, HANDSHAKE_X25519), HANDSHAKE_X25519)
+# ================================================================================================================
+
+if __name__ == '__main__':
+    unittest.main()
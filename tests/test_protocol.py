@@ -0,0 +1,179 @@
+'''
+    Tests for the wire protocol (protocol.py): frame decoding and AEAD sessions.
+
+    Run from the repository root with:
+
+            python -m pytest tests
+'''
+
+import os
+import socket
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from protocol import *
+
+# ================================================================================================================
+
+# ================================================= Frame Decoder ================================================
+class FrameDecoderTest(unittest.TestCase):
+    def test_fields_round_trip(self):
+        decoder = FrameDecoder()
+        decoder.feed(encodeFrame(FRAME_PLAIN, [b'50', 'name', b'', b'\x00' * 300]))
+        self.assertEqual(decoder.nextFrame(), (FRAME_PLAIN, [b'50', b'name', b'', b'\x00' * 300]))
+        self.assertIsNone(decoder.nextFrame())
+        self.assertEqual(decoder.pending(), 0)
+
+    def test_partial_reads(self):
+        # Frames split at every byte boundary are only returned once complete
+        data = encodeFrame(FRAME_PLAIN, [b'20', b'key']) + encodeFrame(FRAME_HANDSHAKE, [b'x' * 1000])
+        decoder = FrameDecoder()
+        frames = []
+        for i in range(len(data)):
+            decoder.feed(data[i:i + 1])
+            frames.extend(decoder.frames())
+        self.assertEqual(frames, [(FRAME_PLAIN, [b'20', b'key']), (FRAME_HANDSHAKE, [b'x' * 1000])])
+
+    def test_several_frames_in_one_read(self):
+        data = b''.join(encodeFrame(FRAME_PLAIN, [str(i)]) for i in range(50))
+        decoder = FrameDecoder()
+        decoder.feed(data[:-3]) # Last frame incomplete
+        self.assertEqual([fields[0] for t, fields in decoder.frames()], [str(i).encode() for i in range(49)])
+        decoder.feed(data[-3:])
+        self.assertEqual(list(decoder.frames()), [(FRAME_PLAIN, [b'49'])])
+
+    def test_recv_from_socket(self):
+        a, b = socket.socketpair()
+        try:
+            frame = encodeFrame(FRAME_PLAIN, [b'50'])
+            decoder = FrameDecoder(bufferSize=4) # Smaller than a frame
+            a.sendall(frame[:6])
+            self.assertEqual(decoder.recvFrom(b), 4)
+            self.assertIsNone(decoder.nextFrame())
+            a.sendall(frame[6:])
+            self.assertEqual(recvFrame(b, decoder), (FRAME_PLAIN, [b'50']))
+            a.close()
+            self.assertIsNone(recvFrame(b, decoder)) # Closed before another frame
+        finally:
+            a.close()
+            b.close()
+
+    def test_bad_magic(self):
+        data = bytearray(encodeFrame(FRAME_PLAIN, [b'50']))
+        data[0] ^= 0xFF
+        decoder = FrameDecoder()
+        decoder.feed(data)
+        with self.assertRaises(ProtocolError):
+            decoder.nextFrame()
+
+    def test_newer_version(self):
+        data = bytearray(encodeFrame(FRAME_PLAIN, [b'50']))
+        data[1] = PROTOCOL_VERSION + 1
+        decoder = FrameDecoder()
+        decoder.feed(data)
+        with self.assertRaises(ProtocolError):
+            decoder.nextFrame()
+
+    def test_frame_too_large(self):
+        # Rejected from the header alone, before the body arrives
+        decoder = FrameDecoder()
+        decoder.feed(FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION, FRAME_PLAIN, 1, MAX_FRAME_SIZE + 1))
+        with self.assertRaises(ProtocolError):
+            decoder.nextFrame()
+
+    def test_field_longer_than_body(self):
+        body = FIELD_LENGTH.pack(100) + b'short'
+        decoder = FrameDecoder()
+        decoder.feed(FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION, FRAME_PLAIN, 1, len(body)) + body)
+        with self.assertRaises(ProtocolError):
+            decoder.nextFrame()
+
+    def test_wrong_field_count(self):
+        body = packFields([b'a', b'b'])
+        decoder = FrameDecoder()
+        decoder.feed(FRAME_HEADER.pack(FRAME_MAGIC, PROTOCOL_VERSION, FRAME_PLAIN, 3, len(body)) + body)
+        with self.assertRaises(ProtocolError):
+            decoder.nextFrame()
+
+    def test_unpack_fields_count(self):
+        data = packFields([b'a', b'b', b'c'])
+        self.assertEqual(unpackFields(data, count=3), [b'a', b'b', b'c'])
+        with self.assertRaises(ProtocolError):
+            unpackFields(data, count=2)
+        with self.assertRaises(ProtocolError):
+            unpackFields(data[:-1])
+# ================================================================================================================
+
+# ================================================= AEAD Session =================================================
+def sessionPair(transport=TRANSPORT_AESGCM):
+    # Client and server ends of one AEAD session
+    key = os.urandom(32)
+    return AEADSession(key, transport, initiator=True), AEADSession(key, transport, initiator=False)
+
+def frameFields(frame):
+    # Fields of an encoded frame
+    decoder = FrameDecoder()
+    decoder.feed(frame)
+    frameType, fields = decoder.nextFrame()
+    return fields
+
+class AEADSessionTest(unittest.TestCase):
+    def test_round_trip(self):
+        for transport in AEAD_TRANSPORTS:
+            client, server = sessionPair(transport)
+            self.assertEqual(server.open(frameFields(client.seal([b'200', 'hello']))), [b'200', b'hello'])
+            self.assertEqual(client.open(frameFields(server.seal([b'50']))), [b'50'])
+
+    def test_nonces_never_repeat(self):
+        # seal() may be called from several threads at once
+        client, server = sessionPair()
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            frames = list(pool.map(lambda i: frameFields(client.seal([str(i)])), range(2000)))
+        nonces = [fields[0] for fields in frames]
+        self.assertEqual(len(set(nonces)), len(nonces))
+        serverNonce = frameFields(server.seal([b'50']))[0]
+        self.assertNotIn(serverNonce, nonces) # Directions use different nonces
+
+    def test_reflected_frame(self):
+        # A frame sent back to its sender is not accepted
+        client, server = sessionPair()
+        self.assertIsNone(client.open(frameFields(client.seal([b'200']))))
+
+    def test_replayed_frame(self):
+        client, server = sessionPair()
+        fields = frameFields(client.seal([b'200']))
+        self.assertEqual(server.open(fields), [b'200'])
+        self.assertIsNone(server.open(fields))
+
+    def test_out_of_order_within_window(self):
+        client, server = sessionPair()
+        frames = [frameFields(client.seal([str(i)])) for i in range(100)]
+        opened = [server.open(fields) for fields in reversed(frames)]
+        self.assertEqual(opened, [[str(i).encode()] for i in reversed(range(100))])
+        self.assertEqual([server.open(fields) for fields in frames], [None] * 100) # Each once
+
+    def test_replay_window_edge(self):
+        client, server = sessionPair()
+        frames = [frameFields(client.seal([str(i)])) for i in range(REPLAY_WINDOW + 1)]
+        self.assertIsNotNone(server.open(frames[-1]))
+        self.assertIsNone(server.open(frames[0])) # REPLAY_WINDOW behind the newest frame
+        self.assertEqual(server.open(frames[1]), [b'1']) # Oldest frame still in the window
+
+    def test_tampered_frame(self):
+        client, server = sessionPair()
+        nonce, ciphertext = frameFields(client.seal([b'200', b'message']))
+        tampered = bytearray(ciphertext)
+        tampered[-1] ^= 1
+        self.assertIsNone(server.open([nonce, bytes(tampered)]))
+        # The rejected frame does not use up its nonce
+        self.assertEqual(server.open([nonce, ciphertext]), [b'200', b'message'])
+
+    def test_bad_nonce(self):
+        client, server = sessionPair()
+        nonce, ciphertext = frameFields(client.seal([b'200']))
+        self.assertIsNone(server.open([nonce[:-1], ciphertext]))
+        self.assertIsNone(server.open([nonce]))
+# ================================================================================================================
+
+if __name__ == '__main__':
+    unittest.main()
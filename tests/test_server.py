@@ -0,0 +1,185 @@
+'''
+    Tests for the server (server.py): a select-mode server handling malformed requests,
+    and frames sent to one client from several threads. The server runs in a thread and
+    keeps its keys and databases in a temporary directory.
+
+    Run from the repository root with:
+
+            python -m pytest tests
+'''
+
+import os
+import tempfile
+import time
+import unittest
+from socket import socketpair, timeout
+from threading import Barrier, Thread
+
+from protocol import *
+
+# ================================================================================================================
+
+# ================================================ Server Helpers ================================================
+def receiveReply(sock, sessionKey, decoder, requestID, wait=5):
+    # Fields of the server's reply to requestID (without the ID), or None if the
+    # connection is closed first
+    sock.settimeout(wait)
+    deadline = time.monotonic() + wait
+    while time.monotonic() < deadline:
+        frame = recvFrame(sock, decoder)
+        if frame is None:
+            return None
+        fields = decodeSessionFrame(frame[1], sessionKey)
+        if fields is not None and len(fields) > 1 and fields[-1] == requestID:
+            return fields[:-1]
+    return None
+
+def publicKeyRequest(requestID):
+    # Public key request for a user that does not exist
+    return [b'20', b'nobody', b'10.0.0.1', b'0', b'0', requestID]
+
+def connectionClosed(sock, decoder, wait=5):
+    # True once the server closes sock, False if it is still open after wait seconds.
+    # Frames sent before it is closed are skipped
+    sock.settimeout(wait)
+    try:
+        while recvFrame(sock, decoder) is not None:
+            pass
+    except timeout:
+        return False
+    except OSError: # Reset
+        pass
+    return True
+# ================================================================================================================
+
+# ================================================ Select Server =================================================
+class MalformedRequestTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.cwd = os.getcwd()
+        os.chdir(cls.directory.name)
+        os.mkdir('data')
+
+        # Imported here so keys and databases are created in the temporary directory
+        global Client, server
+        import Client
+        import server
+        from cipher import RSA_get_keys
+        cls.keys = RSA_get_keys()
+        cls.server = server.Server(server.createServerSocket(0), 'select')
+        cls.address = ('127.0.0.1', cls.server.socket.getsockname()[1])
+        cls.thread = Thread(target=cls.server.run, daemon=True)
+        cls.thread.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.status.terminate = True
+        Client.connectToServer(cls.address, '10.0.9.9', cls.keys) # Wakes up the event loop
+        cls.thread.join(10)
+        os.chdir(cls.cwd)
+        cls.directory.cleanup()
+
+    def connect(self, IP):
+        connection = Client.connectToServer(self.address, IP, self.keys)
+        self.assertIsNotNone(connection)
+        self.addCleanup(connection[0].close)
+        return connection
+
+    def assertServing(self):
+        # A new client still gets replies
+        sock, sessionKey, decoder = self.connect('10.0.9.2')
+        sock.sendall(encodeSessionFrame(publicKeyRequest(b'1'), sessionKey))
+        self.assertEqual(receiveReply(sock, sessionKey, decoder, b'1'), [b'55']) # No such user
+
+    def test_non_utf8_field(self):
+        other = self.connect('10.0.9.1')
+        sock, sessionKey, decoder = self.connect('10.0.9.3')
+        errors = self.server.stats.snapshot()['counters'].get('protocol_errors', 0)
+        # Message whose receiver IP is not UTF-8
+        sock.sendall(encodeSessionFrame([b'200', b'\xff\xfe', b'name', b'0', b'0', b'0', b'message'], sessionKey))
+        self.assertTrue(connectionClosed(sock, decoder))
+        self.assertEqual(self.server.stats.snapshot()['counters'].get('protocol_errors', 0), errors + 1)
+        self.assertServing()
+
+        # Clients that were already connected are still served
+        otherSock, otherKey, otherDecoder = other
+        otherSock.sendall(encodeSessionFrame(publicKeyRequest(b'2'), otherKey))
+        self.assertEqual(receiveReply(otherSock, otherKey, otherDecoder, b'2'), [b'55'])
+
+    def test_short_group_message(self):
+        # A group message with missing fields is refused, not acknowledged
+        sock, sessionKey, decoder = self.connect('10.0.9.5')
+        requests = [[b'10', b'carol', b'password', b'1', b'0', b'1'],
+                    [b'30', b'group5', packFields([b'carol']), packFields([b'key']), b'0', b'2'],
+                    [b'300', b'group5', b'carol', b'0', b'0', b'3'],
+                    [b'300', b'group5', b'carol', b'0', b'0', b'0', b'message', b'4']]
+        replies = []
+        for request in requests:
+            sock.sendall(encodeSessionFrame(request, sessionKey))
+            replies.append(receiveReply(sock, sessionKey, decoder, request[-1]))
+        self.assertEqual(replies, [[b'50'], [b'50'], [b'55'], [b'50']])
+
+    def test_non_utf8_request_in_database_pool(self):
+        # Public key lookups that miss the key cache are handled by the database workers
+        sock, sessionKey, decoder = self.connect('10.0.9.4')
+        sock.sendall(encodeSessionFrame([b'20', b'\xff', b'10.0.0.1', b'0', b'0', b'3'], sessionKey))
+        self.assertTrue(connectionClosed(sock, decoder))
+        self.assertServing()
+# ================================================================================================================
+
+# ============================================== Client Connection ===============================================
+class ClientConnectionTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.cwd = os.getcwd()
+        os.chdir(cls.directory.name)
+        os.mkdir('data')
+        global server
+        import server # Keys are created in the temporary directory
+        os.chdir(cls.cwd)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.directory.cleanup()
+
+    def test_frames_sent_in_counter_order(self):
+        # Stored message batches and single messages sent by several threads at once
+        # reach the client in the order of their counters, so none are dropped
+        key = os.urandom(32)
+        serverSession = AEADSession(key, TRANSPORT_AESGCM, initiator=False)
+        clientSession = AEADSession(key, TRANSPORT_AESGCM, initiator=True)
+        sock, clientSock = socketpair()
+        self.addCleanup(clientSock.close)
+        client = server.Client_Connection(sock, ('127.0.0.1', 1), '10.0.9.6', None, serverSession)
+        self.addCleanup(client.close)
+
+        threads, batches, messages = 4, 4, 100
+        expected = threads * batches * (server.OUTBOX_BATCH + messages)
+        start = Barrier(threads)
+        def send():
+            start.wait()
+            for i in range(batches):
+                client.sendFields(*[[b'200', b'stored']] * server.OUTBOX_BATCH)
+                for j in range(messages):
+                    client.sendFields([b'200', b'message'])
+        senders = [Thread(target=send) for i in range(threads)]
+        for thread in senders:
+            thread.start()
+
+        decoder = FrameDecoder()
+        clientSock.settimeout(10)
+        counters, opened = [], 0
+        while len(counters) < expected:
+            frameType, fields = recvFrame(clientSock, decoder)
+            counters.append(int.from_bytes(fields[0][4:], 'big'))
+            opened += clientSession.open(fields) is not None
+        for thread in senders:
+            thread.join()
+        self.assertEqual(counters, list(range(expected)))
+        self.assertEqual(opened, expected)
+# ================================================================================================================
+
+if __name__ == '__main__':
+    unittest.main()
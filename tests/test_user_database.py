@@ -0,0 +1,96 @@
+'''
+    Tests for the server's user database (UserDatabase.py): accounts and group chats
+    added by several pooled connections at once.
+
+    Run from the repository root with:
+
+            python -m pytest tests
+'''
+
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from threading import Barrier
+
+from UserDatabase import *
+
+# ================================================================================================================
+
+# ================================================ User Database =================================================
+class UserDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'UserDB.db')
+        self.pool = UserDataBasePool(4, self.path)
+
+    def tearDown(self):
+        self.pool.close()
+        self.directory.cleanup()
+
+    def concurrently(self, func, n=4):
+        # Results of func(i) run by n threads, each with its own pooled connection
+        start = Barrier(n)
+        def run(i):
+            with self.pool.connection() as db:
+                start.wait()
+                return func(db, i)
+        with ThreadPoolExecutor(max_workers=n) as executor:
+            return list(executor.map(run, range(n)))
+
+    def test_same_username(self):
+        results = self.concurrently(lambda db, i: db.addUser('alice', '10.0.0.{}'.format(i), bytes([i]), b'pw'))
+        self.assertEqual(sorted(results), [False, False, False, True])
+        with self.pool.connection() as db:
+            self.assertEqual(db.getUserPublicKey('alice'), bytes([results.index(True)]))
+
+    def test_same_group(self):
+        # A second creator checks for the group while the first has not committed yet.
+        # Only the first creator's members are stored
+        first, second = UserDataBase(self.path), UserDataBase(self.path)
+        try:
+            self.assertTrue(add_group(first.cursor, 'g', [('alice', b'k1')])) # Not committed
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                created = executor.submit(second.createGroup, 'g', [('mallory', b'k2')])
+                time.sleep(0.2) # Second creator waits for the first to commit
+                first.connection.commit()
+                self.assertFalse(created.result(10))
+            self.assertEqual(second.getGroupMembers('g'), [('alice', b'k1')])
+        finally:
+            first.disconnect()
+            second.disconnect()
+
+    def test_same_group_concurrently(self):
+        results = self.concurrently(lambda db, i: db.createGroup('g', [('user{}'.format(i), bytes([i])), ('bob', bytes([i]))]))
+        self.assertEqual(sorted(results), [False, False, False, True])
+        winner = results.index(True)
+        with self.pool.connection() as db:
+            self.assertEqual(sorted(db.getGroupMembers('g')), [('bob', bytes([winner])), ('user{}'.format(winner), bytes([winner]))])
+
+    def test_group_members(self):
+        with self.pool.connection() as db:
+            self.assertIsNone(db.getGroupMembers('g'))
+            self.assertTrue(db.createGroup('g', [('alice', b'k1'), ('bob', b'k2')]))
+            self.assertFalse(db.createGroup('g', [('carol', b'k3')]))
+            self.assertEqual(sorted(db.getGroupMembers('g')), [('alice', b'k1'), ('bob', b'k2')])
+            self.assertTrue(db.addUser('carol', '10.0.0.3', b'key', b'pw')) # Connection still usable
+
+    def test_existing_groups_are_kept_unique(self):
+        # Groups stored before group IDs had their own table can not be created again
+        con = sqlite3.connect(os.path.join(self.directory.name, 'Old.db'))
+        con.execute('CREATE TABLE groups (groupID TEXT, uName TEXT, groupKey BLOB)')
+        con.execute("INSERT INTO groups VALUES ('old', 'alice', x'01')")
+        con.commit()
+        con.close()
+        db = UserDataBase(os.path.join(self.directory.name, 'Old.db'))
+        try:
+            self.assertFalse(db.createGroup('old', [('mallory', b'k')]))
+            self.assertEqual(db.getGroupMembers('old'), [('alice', b'\x01')])
+        finally:
+            db.disconnect()
+# ================================================================================================================
+
+if __name__ == '__main__':
+    unittest.main()